@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+    Load benchmark of the Redmox server against the fake Proxmox VE API
+
+    Starts benchmarks/fakepve.py in process, serves the real Redmox app on a
+    local port with waitress or the async server, then drives each scenario
+    with concurrent keep-alive clients and reports the throughput, the
+    p50/p90/p99 latencies and the Proxmox API calls per request.
+
+    Scenarios: sessions (POST Sessions), systems (GET Systems), system (GET
+    Systems/<id>), virtualmedia (GET Managers/1/VirtualMedia), reset (POST
+    ComputerSystem.Reset On).
+
+    Usage: python benchmarks/bench_load.py [--scenarios systems,system] [--requests N]
+                                           [--concurrency N] [--server waitress|async]
+                                           [--threads N] [--json] [fake cluster options]
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import logging
+import argparse
+import threading
+import requests
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(BENCH, "..", "src")
+sys.path.insert(0, SRC)
+sys.path.insert(0, BENCH)
+from fakepve import FakePVE, arguments
+
+SCENARIOS = [ "sessions", "systems", "system", "virtualmedia", "reset" ]
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def start_redmox(fake, args):
+    """
+        Function to serve the Redmox app in this process, returns its base URL
+    """
+    # The app resolves its templates from the working directory, like redmox.py run from src
+    os.chdir(SRC)
+    with open("configs.yaml", "r") as f:
+        configs = yaml.safe_load(f)
+    configs["proxmox"] = { "host": "127.0.0.1", "port": fake.port }
+    configs["redfish"]["vmid"] = min(fake.vms)
+    configs["cache"]["poll_interval"] = args.poll
+    configs["upstream"]["coalesce"] = not args.no_coalesce
+    configs["tracing"] = dict(configs.get("tracing") or {}, log=False)
+    from libs.apilib import RedmoxAPI
+    rdx_api = RedmoxAPI(configs)
+    rdx_api.app.logger.setLevel(logging.ERROR)
+    logging.getLogger("waitress.queue").setLevel(logging.ERROR)
+    rdx_api.start()
+    port = free_port()
+    if args.server == "async":
+        from libs.aioapi import AsyncServer
+        server = AsyncServer(rdx_api, [ ("127.0.0.1", port) ], threads=args.threads, connections=args.connections)
+        target = server.run
+    else:
+        from waitress.server import create_server
+        server = create_server(rdx_api.app, host="127.0.0.1", port=port, threads=args.threads)
+        target = server.run
+    threading.Thread(target=target, name="redmox", daemon=True).start()
+    base = f"http://127.0.0.1:{port}"
+    for attempt in range(50):
+        try:
+            requests.get(base + "/redfish", timeout=1)
+            break
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    return base
+
+def login(session, base):
+    response = session.post(base + "/redfish/v1/SessionService/Sessions", json={ "UserName": "root@pam", "Password": "bench" })
+    response.raise_for_status()
+    token = response.headers.get("X-Auth-Token")
+    if token is None:
+        token = response.text.split("X-Auth-Token: ")[1].split()[0]
+    return token
+
+def request(scenario, session, base, vmids):
+    if scenario == "sessions":
+        return session.post(base + "/redfish/v1/SessionService/Sessions", json={ "UserName": "root@pam", "Password": "bench" })
+    if scenario == "systems":
+        return session.get(base + "/redfish/v1/Systems")
+    if scenario == "system":
+        return session.get(base + f"/redfish/v1/Systems/{random.choice(vmids)}")
+    if scenario == "virtualmedia":
+        return session.get(base + "/redfish/v1/Managers/1/VirtualMedia")
+    if scenario == "reset":
+        return session.post(base + f"/redfish/v1/Systems/{random.choice(vmids)}/Actions/ComputerSystem.Reset", json={ "ResetType": "On" })
+    raise ValueError(f"Unknown scenario {scenario}")
+
+def run(scenario, base, token, vmids, fake, args):
+    """
+        Function to send the requests of a scenario from concurrent clients, returns its statistics
+    """
+    counter = iter(range(args.requests))
+    lock = threading.Lock()
+    latencies = []
+    errors = []
+
+    def client():
+        session = requests.Session()
+        session.headers["X-Auth-Token"] = token
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            start = time.perf_counter()
+            try:
+                response = request(scenario, session, base, vmids)
+                ok = response.status_code < 400
+                error = None if ok else str(response.status_code)
+            except requests.RequestException as e:
+                error = type(e).__name__
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if error:
+                    errors.append(error)
+
+    warmup = requests.Session()
+    warmup.headers["X-Auth-Token"] = token
+    for attempt in range(min(args.warmup, args.requests)):
+        request(scenario, warmup, base, vmids)
+    fake.reset_calls()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for worker in range(args.concurrency):
+            executor.submit(client)
+    duration = time.perf_counter() - start
+    calls = fake.reset_calls()
+    latencies.sort()
+    return {
+        "scenario": scenario,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "seconds": round(duration, 3),
+        "throughput": round(len(latencies) / duration, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p90_ms": round(percentile(latencies, 0.90) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0,
+        "upstream_per_request": round(sum(calls.values()) / max(len(latencies), 1), 2),
+        "upstream": { f"{method} {path}": count for (method, path), count in calls.most_common() }
+    }
+
+if __name__ == "__main__":
+    parser = arguments(argparse.ArgumentParser(description="Redmox load benchmark"))
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated scenarios")
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent clients")
+    parser.add_argument("--warmup", type=int, default=5, help="requests before measuring each scenario")
+    parser.add_argument("--server", choices=[ "waitress", "async" ], default="waitress", help="Redmox server")
+    parser.add_argument("--threads", type=int, default=8, help="Redmox server threads")
+    parser.add_argument("--connections", type=int, default=10, help="upstream connections per client in async mode")
+    parser.add_argument("--poll", type=float, default=0, help="inventory poll interval, 0 to disable")
+    parser.add_argument("--no-coalesce", action="store_true", help="send every identical Proxmox GET upstream")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON lines")
+    args = parser.parse_args()
+    scenarios = [ scenario for scenario in args.scenarios.split(",") if scenario ]
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            parser.error(f"unknown scenario {scenario}, expected some of {','.join(SCENARIOS)}")
+
+    fake = FakePVE(args.nodes, args.vms, args.storages, args.isos, args.latency, args.jitter).start()
+    base = start_redmox(fake, args)
+    token = login(requests.Session(), base)
+    vmids = sorted(fake.vms)
+
+    if not args.json:
+        print(f"{args.server}, {args.threads} threads, {args.concurrency} clients, {len(fake.nodes)} nodes, "
+              f"{len(fake.vms)} VMs, {args.latency * 1000:.0f}ms upstream latency")
+        print(f"{'scenario':<14}{'req/s':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'errors':>8}{'PVE/req':>9}")
+    for scenario in scenarios:
+        result = run(scenario, base, token, vmids, fake, args)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(f"{scenario:<14}{result['throughput']:>10}{result['p50_ms']:>10}{result['p90_ms']:>10}"
+                  f"{result['p99_ms']:>10}{result['max_ms']:>10}{result['errors']:>8}{result['upstream_per_request']:>9}")
+    fake.stop()
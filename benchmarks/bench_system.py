@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+    Benchmark of the per-request CPU spent building /redfish/v1/Systems/<id>
+
+    Compares the former Flask/Jinja rendering of system.json with the
+    precompiled resource builder, both as a dict encoded once and as
+    pre-encoded fragments.
+
+    Usage: python benchmarks/bench_system.py [iterations]
+"""
+import os
+import re
+import sys
+import json
+import time
+from flask import Flask, render_template
+from jinja2 import DictLoader
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+from libs.resources import Resources
+
+VALUES = {
+    "id": "107",
+    "tags": "k8s,worker",
+    "manufacturer": "Proxmox VE 8.2.4",
+    "vm_name": "worker-107",
+    "sys_type": "[qemu] Virtual Machine",
+    "vmgenid": "c2f9a7a4-64a3-4b5e-9d1c-7e0c6b0b9a11",
+    "state": "Enabled",
+    "power_state": "On",
+    "bootsourceoverride_enabled": "None",
+    "bootsourceoverride_target": "None",
+    "bootsourceoverride_mode": "None",
+    "cpu_count": 8,
+    "total_gb": 16.0
+}
+
+def measure(func, iterations):
+    start = time.process_time()
+    for _ in range(iterations):
+        func()
+    return (time.process_time() - start) / iterations * 1e6
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    with open(os.path.join(SRC, "templates", "system.json"), "r") as f:
+        skeleton = f.read()
+    # The former template held the same document with unquoted placeholders
+    app = Flask("bench")
+    app.jinja_loader = DictLoader({
+        "system.json": re.sub(r'"(\{\{ \w+ \}\})"', r'\1', skeleton)
+    })
+    resources = Resources(os.path.join(SRC, "templates"))
+
+    def render():
+        return render_template("system.json", **VALUES)
+
+    def build():
+        return json.dumps(resources.build("system.json", **VALUES))
+
+    def encode():
+        return resources.encode("system.json", **VALUES)
+
+    with app.app_context():
+        render_us = measure(render, iterations)
+    build_us = measure(build, iterations)
+    encode_us = measure(encode, iterations)
+    print(f"render_template (former):  {render_us:8.2f} us/request")
+    print(f"build + json.dumps:        {build_us:8.2f} us/request")
+    print(f"encode:                    {encode_us:8.2f} us/request")
+    print(f"CPU saved by encode:       {render_us - encode_us:8.2f} us/request ({(1 - encode_us / render_us) * 100:.0f}%)")
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+    Micro-benchmark of the VM model against the former get_vm_info dict builder
+
+    Usage: python benchmarks/bench_vm_model.py [iterations]
+"""
+import os
+import sys
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+from libs.vmmodel import VM
+
+RECORD = {
+    "vmid": 107, "name": "worker-107", "status": "running", "node": "pve3", "type": "qemu",
+    "tags": "k8s;worker", "uptime": 86400, "template": 0, "cpu": 0.12, "maxcpu": 8,
+    "mem": 4294967296, "maxmem": 17179869184, "disk": 0, "diskread": 123456, "diskwrite": 654321,
+    "maxdisk": 68719476736, "netin": 1000, "netout": 2000
+}
+CONFIG = {
+    "digest": "5e1b0f4b2a9f0c7d8e6a5b4c3d2e1f0a9b8c7d6e",
+    "vmgenid": "c2f9a7a4-64a3-4b5e-9d1c-7e0c6b0b9a11",
+    "name": "worker-107", "ostype": "l26", "cores": 4, "sockets": 2, "cpu": "host",
+    "memory": "16384", "numa": 0, "boot": "order=scsi0;ide2;net0", "bios": "ovmf",
+    "efidisk0": "local-lvm:vm-107-disk-1,efitype=4m,pre-enrolled-keys=1,size=4M",
+    "ide2": "local:iso/ubuntu-24.04-live-server-amd64.iso,media=cdrom,size=2690412K",
+    "scsi0": "local-lvm:vm-107-disk-0,iothread=1,size=64G,ssd=1",
+    "scsi1": "local-lvm:vm-107-disk-2,iothread=1,size=128G",
+    "unused0": "local-lvm:vm-107-disk-3",
+    "net0": "virtio=BC:24:11:00:00:01,bridge=vmbr0,firewall=1",
+    "net1": "virtio=BC:24:11:00:00:02,bridge=vmbr1,tag=20",
+    "meta": "creation-qemu=8.1.5,ctime=1712345678",
+    "smbios1": "uuid=2d7b6f1e-8f3a-4c1b-9e2d-5a6b7c8d9e0f",
+    "scsihw": "virtio-scsi-single", "agent": "1"
+}
+
+def legacy_vm_info(vmstatus, vmconfig):
+    """
+        The former Proxmox.get_vm_info parsing, kept verbatim as the baseline
+    """
+    json_out = {
+        "id": vmstatus['vmid'],
+        "vmgenid": vmconfig.get('vmgenid', ''),
+        "name": vmstatus.get('name', 'Unknown'),
+        "status": vmstatus.get('status', 'Unknown'),
+        "node": vmstatus.get('node', 'Unknown'),
+        "type": vmstatus.get('type', 'Unknown'),
+        "tags": vmstatus.get('tags', []),
+        "uptime": vmstatus.get('uptime', 0),
+        "template": vmstatus.get('template', 0),
+        "digest": vmconfig.get('digest', ''),
+        "media": vmconfig.get('ide2', ''),
+        "boot": {
+            "order": vmconfig['boot'].replace('order=', '').split(';') if 'boot' in vmconfig else [],
+        },
+        "ostype": vmconfig.get('ostype', 'Unknown'),
+        "cpu": {
+            "usage": {
+                "current": vmstatus.get('cpu', 0),
+                "total": vmstatus.get('maxcpu', 0)
+            },
+            "cores": vmconfig.get('cores', 1),
+            "type": vmconfig.get('cpu', 'Unknown'),
+            "sockets": vmconfig.get('sockets', 1)
+        },
+        "memory": {
+            "usage": {
+                "current": vmstatus.get('mem', 0),
+                "total": vmstatus.get('maxmem', 0)
+            },
+            "assigned_mb": vmconfig.get('memory', 0),
+            "numa": vmconfig.get('numa', 0)
+        },
+        "disk": {
+            "usage": {
+                "current": vmstatus.get('disk', 0),
+                "read": vmstatus.get('diskread', 0),
+                "write": vmstatus.get('diskwrite', 0),
+                "total": vmstatus.get('maxdisk', 0)
+            },
+            "list": []
+        },
+        "network": {
+            "usage": {
+                "in": vmstatus.get('netin', 0),
+                "out": vmstatus.get('netout', 0)
+            }
+        }
+    }
+    for key, value in vmconfig.items():
+        if isinstance(value, str) and "iso/" in value:
+            json_out["cdrom"] = { "mount": key }
+            arr_value = value.split(',')
+            iso_data = arr_value[0].split(':')
+            json_out["cdrom"]["datastore"] = iso_data[0]
+            json_out["cdrom"]["iso"] = iso_data[1].replace('iso/', '')
+            for item in arr_value:
+                if "=" in item:
+                    arr_item = item.split('=')
+                    json_out["cdrom"][arr_item[0]] = arr_item[1]
+        if key == "meta":
+            json_out["meta"] = {}
+            for item in value.split(','):
+                if "=" in item:
+                    arr_item = item.split('=')
+                    json_out["meta"][arr_item[0]] = arr_item[1]
+        if key.startswith("net"):
+            json_out["network"]["interfaces"] = []
+            arr_value = value.split(',')
+            interface = { "name": key }
+            for item in arr_value:
+                if "=" in item:
+                    arr_item = item.split('=')
+                    interface[arr_item[0]] = arr_item[1]
+            json_out["network"]["interfaces"].append(interface)
+        if isinstance(value, str) and "iothread" in value:
+            disk = { 
+                "device": key,
+                "status": "mounted"
+            }
+            arr_value = value.split(',')
+            disk["datastore"] = arr_value[0].split(':')[0]
+            disk["name"] = arr_value[0].split(':')[1]
+            for item in arr_value:
+                if "=" in item:
+                    arr_item = item.split('=')
+                    disk[arr_item[0]] = arr_item[1]
+            json_out["disk"]["list"].append(disk)
+        if "bios" in key:
+            json_out["bios"] = { "name": key }
+            arr_value = value.split(',')
+            for item in arr_value:
+                if "=" in item:
+                    arr_item = item.split('=')
+                    json_out["bios"][arr_item[0]] = arr_item[1]
+        if "unused" in key:
+            disk = { 
+                "device": key,
+                "status": "unused"
+            }
+            arr_value = value.split(',')
+            disk["datastore"] = arr_value[0].split(':')[0]
+            disk["name"] = arr_value[0].split(':')[1]
+            json_out["disk"]["list"].append(disk)
+
+    return json_out
+
+
+def system_fields(vm):
+    return (vm.name, vm.status, vm.cores, vm.sockets, vm.memory_mb, vm.vmgenid)
+
+def measure(func, iterations):
+    start = time.process_time()
+    for _ in range(iterations):
+        func()
+    return (time.process_time() - start) / iterations * 1e6
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    cases = [
+        ("legacy dict builder", lambda: legacy_vm_info(RECORD, CONFIG)),
+        ("model, System fields", lambda: system_fields(VM("107", RECORD, CONFIG))),
+        ("model, full dict", lambda: VM("107", RECORD, CONFIG).to_dict())
+    ]
+    baseline = None
+    for name, func in cases:
+        elapsed = measure(func, iterations)
+        baseline = baseline or elapsed
+        print(f"{name:24} {elapsed:8.2f} us/call  ({baseline / elapsed:5.1f}x)")
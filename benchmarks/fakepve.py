@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+    Local stand-in for the Proxmox VE REST endpoints Redmox uses
+
+    Serves version, access/ticket, cluster/resources, nodes, storage and
+    ISO content listings, qemu config/status/agent and the start, stop and
+    shutdown actions with their task status, over HTTPS with a throwaway
+    self-signed certificate made by the openssl command. The cluster size
+    and the latency of every request are configurable, and every request
+    is counted by method and path so benchmarks can report upstream calls.
+    The VMs a user sees can be restricted, like the permissions of Proxmox.
+
+    Usage: python benchmarks/fakepve.py [--nodes N] [--vms N] [--storages N]
+                                        [--isos N] [--latency S] [--jitter S] [--port P]
+"""
+import os
+import ssl
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import Counter
+from http.cookies import SimpleCookie
+from urllib.parse import urlsplit, parse_qs, unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Path segments followed by an identifier, counted under a placeholder
+PATH_IDS = { "nodes": "{node}", "qemu": "{vmid}", "storage": "{storage}", "content": "{volume}", "tasks": "{upid}" }
+
+def make_certificate(folder):
+    """
+        Function to create a self-signed certificate and its key in folder with the openssl command
+    """
+    cert = os.path.join(folder, "cert.pem")
+    key = os.path.join(folder, "key.pem")
+    subprocess.run(
+        [ "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+          "-subj", "/CN=localhost", "-keyout", key, "-out", cert ],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return cert, key
+
+def path_template(path):
+    parts = path.split("/")
+    for i in range(len(parts) - 1, 0, -1):
+        if parts[i - 1] in PATH_IDS:
+            parts[i] = PATH_IDS[parts[i - 1]]
+    return "/".join(parts)
+
+class QuietServer(ThreadingHTTPServer):
+    """
+        Class to serve the fake API without reporting the clients that hung up, as they do when it is stalled past their timeout
+    """
+    def handle_error(self, request, client_address):
+        if not issubclass(sys.exc_info()[0], (ConnectionError, ssl.SSLError)):
+            super().handle_error(request, client_address)
+
+class FakePVE:
+    """
+        Class to run a fake Proxmox VE cluster of nodes x VMs x storages x ISOs on a local HTTPS port
+    """
+    def __init__(self, nodes=3, vms=100, storages=2, isos=10, latency=0.0, jitter=0.0, host="127.0.0.1", port=0, first_vmid=100):
+        self.nodes = [ f"pve{i + 1}" for i in range(nodes) ]
+        self.storages = [ "local" ] + [ f"store{i}" for i in range(1, storages) ]
+        self.isos = isos
+        self.latency = latency
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        # Users seeing only some VMs, user -> vmids, the others see every VM
+        self.permissions = {}
+        self.vms = {}
+        for index in range(vms):
+            vmid = first_vmid + index
+            self.vms[vmid] = { "node": self.nodes[index % nodes], "status": "running", "digest": 0, "boot": "order=scsi0;ide2;net0", "cdrom": "none,media=cdrom" }
+        self.folder = tempfile.TemporaryDirectory(prefix="fakepve-")
+        cert, key = make_certificate(self.folder.name)
+        self.server = QuietServer((host, port), self.handler())
+        self.server.daemon_threads = True
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fakepve", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.folder.cleanup()
+
+    def reset_calls(self):
+        with self.lock:
+            calls = self.calls
+            self.calls = Counter()
+        return calls
+
+    def record(self, vmid):
+        vm = self.vms[vmid]
+        running = vm["status"] == "running"
+        return {
+            "id": f"qemu/{vmid}", "vmid": vmid, "name": f"vm-{vmid}", "node": vm["node"], "type": "qemu",
+            "status": vm["status"], "tags": "bench;redmox", "template": 0, "uptime": 86400 if running else 0,
+            "cpu": 0.05 if running else 0, "maxcpu": 4, "mem": 2147483648 if running else 0,
+            "maxmem": 8589934592, "disk": 0, "maxdisk": 34359738368
+        }
+
+    def config(self, vmid):
+        vm = self.vms[vmid]
+        return {
+            "digest": f"{vmid:08x}{vm['digest']:032x}", "vmgenid": f"00000000-0000-4000-8000-{vmid:012d}",
+            "name": f"vm-{vmid}", "cores": 2, "sockets": 2, "memory": "8192", "ostype": "l26",
+            "boot": vm["boot"], "ide2": vm["cdrom"], "scsi0": f"local-lvm:vm-{vmid}-disk-0,size=32G",
+            "net0": "virtio=BC:24:11:00:00:01,bridge=vmbr0", "agent": "1", "scsihw": "virtio-scsi-single"
+        }
+
+    def task(self, node, kind, vmid):
+        return f"UPID:{node}:0000{vmid:04X}:00ABCDEF:{int(time.time()):08X}:{kind}:{vmid}:root@pam:"
+
+    def visible(self, user, vmid):
+        return user not in self.permissions or vmid in self.permissions[user]
+
+    def route(self, method, path, params, user="root@pam"):
+        """
+            Function to answer a Proxmox API request of a user, returns the status code and the data
+        """
+        parts = [ unquote(part) for part in path.split("/")[3:] ]
+        if parts == [ "access", "ticket" ] and method == "POST":
+            username = params.get("username", "root@pam")
+            return 200, { "ticket": f"PVE:{username}:65F00000::fake", "CSRFPreventionToken": "65F00000:fake", "username": username }
+        if parts == [ "version" ]:
+            return 200, { "version": "8.2.4", "release": "8.2", "repoid": "fake" }
+        if parts == [ "cluster", "resources" ]:
+            return 200, [ self.record(vmid) for vmid in self.vms if self.visible(user, vmid) ]
+        if parts == [ "nodes" ]:
+            return 200, [ { "node": node, "status": "online", "type": "node" } for node in self.nodes ]
+        if len(parts) < 3 or parts[0] != "nodes" or parts[1] not in self.nodes:
+            return 404, None
+        node = parts[1]
+        if parts[2:] == [ "storage" ]:
+            return 200, [ { "storage": storage, "type": "dir", "content": "iso,vztmpl,backup", "active": 1 } for storage in self.storages ]
+        if len(parts) == 5 and parts[2] == "storage" and parts[4] == "content":
+            return 200, [
+                { "volid": f"{parts[3]}:iso/{node}-{parts[3]}-{i}.iso", "format": "iso", "content": "iso", "size": 1073741824 }
+                for i in range(self.isos)
+            ]
+        if len(parts) == 5 and parts[2] == "tasks" and parts[4] == "status":
+            return 200, { "upid": parts[3], "node": node, "status": "stopped", "exitstatus": "OK" }
+        if len(parts) < 5 or parts[2] != "qemu" or not parts[3].isdigit() or int(parts[3]) not in self.vms:
+            return 404, None
+        vmid = int(parts[3])
+        if not self.visible(user, vmid):
+            return 403, None
+        vm = self.vms[vmid]
+        action = parts[4:]
+        if action == [ "config" ] and method == "GET":
+            return 200, self.config(vmid)
+        if action == [ "config" ] and method == "PUT":
+            with self.lock:
+                if "boot" in params:
+                    vm["boot"] = params["boot"]
+                if "cdrom" in params:
+                    vm["cdrom"] = params["cdrom"] if params["cdrom"] == "none" else f"{params['cdrom']},media=cdrom"
+                vm["digest"] += 1
+            return 200, None
+        if action == [ "status", "current" ]:
+            return 200, dict(self.record(vmid), qmpstatus=vm["status"], agent=1)
+        if action == [ "agent", "get-osinfo" ]:
+            return 200, { "result": { "id": "ubuntu", "name": "Ubuntu", "version": "24.04 LTS", "kernel-release": "6.8.0-31-generic", "machine": "x86_64" } }
+        if len(action) == 2 and action[0] == "status" and action[1] in [ "start", "stop", "shutdown" ] and method == "POST":
+            vm["status"] = "running" if action[1] == "start" else "stopped"
+            return 200, self.task(node, f"qm{action[1]}", vmid)
+        return 404, None
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def answer(self, method):
+                url = urlsplit(self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length).decode() if length else ""
+                params = { key: values[-1] for key, values in parse_qs(url.query or body).items() }
+                with fake.lock:
+                    fake.calls[(method, path_template(url.path))] += 1
+                delay = fake.latency + (random.uniform(0, fake.jitter) if fake.jitter else 0)
+                if delay:
+                    time.sleep(delay)
+                cookie = SimpleCookie(self.headers.get("Cookie", "")).get("PVEAuthCookie")
+                user = cookie.value.split(":")[1] if cookie else "root@pam"
+                status, data = fake.route(method, url.path, params, user)
+                payload = json.dumps({ "data": data }).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json;charset=UTF-8")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_GET(self):
+                self.answer("GET")
+
+            def do_POST(self):
+                self.answer("POST")
+
+            def do_PUT(self):
+                self.answer("PUT")
+
+            def do_DELETE(self):
+                self.answer("DELETE")
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+def arguments(parser=None):
+    parser = parser or argparse.ArgumentParser(description="Fake Proxmox VE API")
+    parser.add_argument("--nodes", type=int, default=3, help="cluster nodes")
+    parser.add_argument("--vms", type=int, default=100, help="VMs spread over the nodes")
+    parser.add_argument("--storages", type=int, default=2, help="ISO storages per node")
+    parser.add_argument("--isos", type=int, default=10, help="ISOs per storage")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra seconds up to this")
+    return parser
+
+if __name__ == "__main__":
+    parser = arguments()
+    parser.add_argument("--port", type=int, default=8006, help="HTTPS port")
+    args = parser.parse_args()
+    fake = FakePVE(args.nodes, args.vms, args.storages, args.isos, args.latency, args.jitter, port=args.port).start()
+    print(f"Fake Proxmox VE on https://127.0.0.1:{fake.port}: {len(fake.nodes)} nodes, {len(fake.vms)} VMs", file=sys.stderr)
+    try:
+        fake.thread.join()
+    except KeyboardInterrupt:
+        fake.stop()
@@ -0,0 +1,402 @@
+"""
+    Module providing the async serving mode: an asyncio HTTP server answering the read-only
+    Redfish views with the non-blocking Proxmox client and the other views through the Flask app
+"""
+
+#!/usr/bin/env python3
+import io
+import sys
+import json
+import time
+import uuid
+import signal
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+from flask import request, make_response
+from werkzeug.exceptions import HTTPException
+from libs.aiopmox import AsyncClientPool
+from libs import tracing
+from libs.apilib import needs_config
+from libs.resources import respond, not_modified, paging, paginate, expansion, selection, project
+
+class AsyncViews:
+    """
+        Class to answer the read-only Redfish views without a thread per request.
+        Views are keyed by the endpoint name of the matching Flask view.
+    """
+    def __init__(self, rdx_api, connections=10):
+        self.rdx_api = rdx_api
+        self.app = rdx_api.app
+        self.resources = rdx_api.resources
+        upstream_configs = rdx_api.configs.get("upstream") or {}
+        self.clients = AsyncClientPool(
+            host=rdx_api.configs["proxmox"]["host"],
+            port=rdx_api.configs["proxmox"]["port"],
+            size=upstream_configs.get("pool_size", 32),
+            idle_timeout=upstream_configs.get("pool_idle", 1800),
+            name=lambda: rdx_api.clients.name,
+            caches=rdx_api.caches,
+            connections=connections,
+            deadline=upstream_configs.get("deadline", 10),
+            timeout=upstream_configs.get("timeout", 5),
+            metrics=rdx_api.metrics,
+            breaker=rdx_api.breaker
+        )
+        self.evict_session = rdx_api.sessions.on_evict
+        rdx_api.sessions.on_evict = self.evict
+        self.views = {
+            "Systems": self.Systems,
+            "System": self.System,
+            "chassis": self.chassis,
+            "man_virtualmedias": self.man_virtualmedias,
+            "man_virtualmedia": self.man_virtualmedia,
+            "vm_virtualmedias": self.vm_virtualmedias,
+            "vm_virtualmedia": self.vm_virtualmedia
+        }
+
+    def evict(self, token):
+        if self.evict_session:
+            self.evict_session(token)
+        self.clients.discard(token)
+
+    async def client(self):
+        """
+            Function to get the non-blocking client of the request session, None when the token is invalid
+        """
+        start = time.perf_counter()
+        token = request.headers.get('x-auth-token')
+        if not token:
+            self.rdx_api.count_auth("missing")
+            return None
+        # The SQLite session backend blocks, look the token up off the event loop
+        session = await asyncio.get_running_loop().run_in_executor(None, self.rdx_api.sessions.get, token)
+        if not session:
+            self.rdx_api.count_auth("invalid")
+            return None
+        self.rdx_api.count_auth("ok")
+        client = await self.clients.get(token, user=session["UserName"], password=session["Ticket"])
+        renewed = self.rdx_api.renewed(session, client)
+        if renewed:
+            await asyncio.get_running_loop().run_in_executor(None, self.rdx_api.sessions.update, token, renewed)
+        tracing.record("auth", "token_required", start, time.perf_counter() - start)
+        return client
+
+    async def dispatch(self, endpoint, args):
+        pmox = await self.client()
+        if pmox is None:
+            self.app.logger.error("No valid token provided")
+            return make_response(json.dumps({"message": "Invalid token!"}, indent=4), 401)
+        return await self.views[endpoint](pmox, **args)
+
+    async def Systems(self, pmox):
+        expand = expansion()
+        top, skip = paging()
+        properties = selection()
+        vmids = [ str(vmid) for vmid in await pmox.get_vms_id() ]
+        page, next_link = paginate(vmids, top, skip)
+        members = []
+        if expand in [ None, "~" ]:
+            for vmid in page:
+                members.append({
+                    "@odata.id": f"/redfish/v1/Systems/{vmid}"
+                })
+        else:
+            errors = {}
+            for vmid, vm in (await pmox.get_vms(page, errors=errors, config=needs_config(properties))).items():
+                if vm is None:
+                    self.app.logger.warning(f"Unable to expand VM {vmid}: {errors.get(vmid)}")
+                    members.append({
+                        "@odata.id": f"/redfish/v1/Systems/{vmid}"
+                    })
+                    continue
+                member = self.resources.build("system.json", **self.rdx_api.system_values(vmid, vm, pmox.name))
+                members.append(project(member, properties) if properties else member)
+        json_out = self.rdx_api.collection("systems.json", members, len(vmids), next_link)
+        return respond(json_out, etag=True)
+
+    async def System(self, pmox, id):
+        properties = selection()
+        if properties is None:
+            response = not_modified(await pmox.vm_etag(id))
+            if response:
+                return response
+        vm = await pmox.get_vm(id, config=needs_config(properties))
+        if vm is None:
+            return make_response(json.dumps({"error": True, "message": "No VM found"}, indent=4), 404)
+        values = self.rdx_api.system_values(id, vm, pmox.name)
+        if properties:
+            return respond(project(self.resources.build("system.json", **values), properties), etag=True)
+        json_out = self.resources.encode("system.json", **values)
+        return respond(json_out, etag=await pmox.vm_etag(id, { "digest": vm.digest, "status": vm.status }))
+
+    async def chassis(self, pmox):
+        vmid = self.rdx_api.bmc_vmid()
+        if vmid is None:
+            return self.rdx_api.unknown_bmc()
+        vm = await pmox.vm_state(vmid)
+        if not vm:
+            return make_response(json.dumps({"error": True, "message": "No VM found"}, indent=4), 404)
+        power_state = "On" if vm.get("status") == "running" else "Off"
+        etag = f"{vmid}-{power_state}"
+        response = not_modified(etag)
+        if response:
+            return response
+        json_out = self.resources.encode(
+            'chassis.json',
+            uuid=str(uuid.UUID(int=1)),
+            vmid=vmid,
+            power_state=power_state
+        )
+        return respond(json_out, etag=etag)
+
+    async def virtualmedias(self, isos, errors, prefix):
+        for source, error in errors.items():
+            self.app.logger.warning(f"Unable to list ISOs from {source}: {error}")
+        top, skip = paging()
+        members = []
+        for iso in isos:
+            members.append({
+                "@odata.id": f"/redfish/v1/{prefix}/VirtualMedia/{iso.split('/')[-1]}"
+            })
+        page, next_link = paginate(members, top, skip)
+        json_out = self.rdx_api.collection('virtualmedias.json', page, len(members), next_link, prefix=prefix)
+        return respond(json_out, etag=True)
+
+    async def virtualmedia(self, iso_path, isoid, prefix):
+        if not iso_path:
+            self.app.logger.error(f"ISO {isoid} not found")
+            return make_response(json.dumps({"message": f"ISO {isoid} not found"}, indent=4), 404)
+        json_out = self.resources.encode(
+            'virtual_cd.json',
+            id=isoid,
+            image_url=iso_path,
+            name=iso_path.split("/")[-1],
+            inserted=True,
+            prefix=prefix
+        )
+        return respond(json_out, etag=True)
+
+    async def man_virtualmedias(self, pmox):
+        errors = {}
+        isos = await pmox.list_isos(errors=errors)
+        return await self.virtualmedias(isos, errors, "Managers/1")
+
+    async def man_virtualmedia(self, pmox, isoid):
+        return await self.virtualmedia(await pmox.find_iso(isoid), isoid, "Managers/1")
+
+    async def vm_virtualmedias(self, pmox, id):
+        errors = {}
+        isos = await pmox.list_isos_vm(id, errors=errors)
+        if isinstance(isos, dict):
+            return make_response(json.dumps(isos, indent=4), 404)
+        return await self.virtualmedias(isos, errors, f"Systems/{id}")
+
+    async def vm_virtualmedia(self, pmox, id, isoid):
+        return await self.virtualmedia(await pmox.find_iso(isoid, vmid=id), isoid, f"Systems/{id}")
+
+class AsyncServer:
+    """
+        Class to serve the Redmox API from an asyncio event loop. Requests to the async views are
+        handled on the loop, the other ones run the Flask app on a small thread pool.
+    """
+    # Seconds a kept-alive client connection may stay idle
+    idle_timeout = 30
+    # Largest accepted request head
+    max_head = 65536
+
+    def __init__(self, rdx_api, listen, threads=4, connections=10, reuse_port=False, drain_timeout=30):
+        self.rdx_api = rdx_api
+        self.app = rdx_api.app
+        self.listen = listen
+        self.reuse_port = reuse_port
+        self.drain_timeout = drain_timeout
+        self.handlers = set()
+        self.idle = set()
+        self.stopping = None
+        self.views = AsyncViews(rdx_api, connections=connections)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="redmox-wsgi")
+
+    def environ(self, method, target, version, headers, body, writer, port):
+        path, _, query = target.partition("?")
+        peer = writer.get_extra_info("peername") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote(path, "latin-1"),
+            "QUERY_STRING": query,
+            "SERVER_NAME": self.listen[0][0],
+            "SERVER_PORT": str(port),
+            "SERVER_PROTOCOL": version,
+            "REMOTE_ADDR": peer[0],
+            "REMOTE_PORT": str(peer[1]),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False
+        }
+        for key, value in headers:
+            key = key.upper().replace("-", "_")
+            if key in [ "CONTENT_TYPE", "CONTENT_LENGTH" ]:
+                environ[key] = value
+            elif f"HTTP_{key}" in environ:
+                environ[f"HTTP_{key}"] += "," + value
+            else:
+                environ[f"HTTP_{key}"] = value
+        return environ
+
+    def run_wsgi(self, application, environ):
+        """
+            Function to call a WSGI application, returns the status, the headers and the body iterator
+        """
+        started = {}
+        def start_response(status, headers, exc_info=None):
+            started["status"] = status
+            started["headers"] = headers
+        body = application(environ, start_response)
+        return started["status"], started["headers"], body
+
+    async def run_view(self, endpoint, args, environ):
+        """
+            Function to run an async view within a Flask request context, with the app hooks and error handlers
+        """
+        with self.app.request_context(environ):
+            try:
+                response = self.app.preprocess_request()
+                if response is None:
+                    response = await self.views.dispatch(endpoint, args)
+                response = self.app.make_response(response)
+            except Exception as e:
+                try:
+                    response = self.app.make_response(self.app.handle_user_exception(e))
+                except Exception as e:
+                    response = self.app.make_response(self.app.handle_exception(e))
+            response = self.app.process_response(response)
+            return self.run_wsgi(response, environ)
+
+    async def write_response(self, writer, status, headers, body, keep_alive, threaded, head=False):
+        """
+            Function to send a response, chunked when its length is unknown.
+            Bodies of the Flask app are read on the thread pool as they may block.
+            1xx, 204 and 304 responses and the answers to HEAD have no body.
+        """
+        loop = asyncio.get_running_loop()
+        code = int(status.split(" ", 1)[0])
+        bodyless = head or code < 200 or code in [ 204, 304 ]
+        names = [ key.lower() for key, value in headers ]
+        chunked = "content-length" not in names and not bodyless
+        lines = [ f"HTTP/1.1 {status}" ]
+        lines.extend([ f"{key}: {value}" for key, value in headers ])
+        if chunked:
+            lines.append("Transfer-Encoding: chunked")
+        lines.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        iterator = iter(body)
+        try:
+            while not bodyless:
+                if threaded:
+                    chunk = await loop.run_in_executor(self.executor, next, iterator, None)
+                else:
+                    chunk = next(iterator, None)
+                if chunk is None:
+                    break
+                if not chunk:
+                    continue
+                writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk) if chunked else chunk)
+                await writer.drain()
+            if chunked:
+                writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        finally:
+            if hasattr(body, "close"):
+                if threaded:
+                    await loop.run_in_executor(self.executor, body.close)
+                else:
+                    body.close()
+
+    async def handle(self, reader, writer, port):
+        task = asyncio.current_task()
+        self.handlers.add(task)
+        try:
+            while True:
+                self.idle.add(task)
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.idle_timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, asyncio.CancelledError):
+                    return
+                finally:
+                    self.idle.discard(task)
+                lines = head.decode("latin-1").split("\r\n")
+                try:
+                    method, target, version = lines[0].split(" ", 2)
+                except ValueError:
+                    writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    return
+                headers = []
+                for line in lines[1:]:
+                    if line:
+                        key, _, value = line.partition(":")
+                        headers.append((key.strip(), value.strip()))
+                fields = { key.lower(): value for key, value in headers }
+                if "chunked" in fields.get("transfer-encoding", "").lower():
+                    writer.write(b"HTTP/1.1 411 Length Required\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    return
+                body = await reader.readexactly(int(fields.get("content-length", 0) or 0))
+                keep_alive = version == "HTTP/1.1" and fields.get("connection", "").lower() != "close"
+                environ = self.environ(method, target, version, headers, body, writer, port)
+                endpoint, args = None, {}
+                try:
+                    endpoint, args = self.app.url_map.bind_to_environ(environ).match()
+                except HTTPException:
+                    pass
+                if endpoint in self.views.views:
+                    status, response_headers, response_body = await self.run_view(endpoint, args, environ)
+                    keep_alive = keep_alive and not self.stopping.is_set()
+                    await self.write_response(writer, status, response_headers, response_body, keep_alive, False, method == "HEAD")
+                else:
+                    loop = asyncio.get_running_loop()
+                    status, response_headers, response_body = await loop.run_in_executor(self.executor, self.run_wsgi, self.app, environ)
+                    keep_alive = keep_alive and not self.stopping.is_set()
+                    await self.write_response(writer, status, response_headers, response_body, keep_alive, True, method == "HEAD")
+                if not keep_alive:
+                    return
+        except ConnectionError:
+            return
+        finally:
+            self.handlers.discard(task)
+            writer.close()
+
+    async def serve(self):
+        """
+            Function to serve until SIGTERM or SIGINT, then stop accepting, close the idle
+            connections and give the requests in flight up to drain_timeout seconds to finish
+        """
+        loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        if threading.current_thread() is threading.main_thread():
+            loop.add_signal_handler(signal.SIGTERM, self.stopping.set)
+            loop.add_signal_handler(signal.SIGINT, self.stopping.set)
+        servers = []
+        for host, port in self.listen:
+            handler = lambda reader, writer, port=port: self.handle(reader, writer, port)
+            servers.append(await asyncio.start_server(handler, host, port, limit=self.max_head, reuse_port=self.reuse_port or None))
+        self.app.logger.info(f"Serving asynchronously on {', '.join([ f'{host}:{port}' for host, port in self.listen ])}")
+        await self.stopping.wait()
+        for server in servers:
+            server.close()
+        for task in list(self.idle):
+            task.cancel()
+        if self.handlers:
+            done, pending = await asyncio.wait(list(self.handlers), timeout=self.drain_timeout)
+            if pending:
+                self.app.logger.warning(f"Dropping {len(pending)} connections still busy after {self.drain_timeout}s")
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,511 @@
+"""
+    Module providing a non-blocking Proxmox client for the async serving mode
+"""
+
+#!/usr/bin/env python3
+import ssl
+import json
+import time
+import asyncio
+from collections import OrderedDict
+from urllib.parse import urlencode, quote
+from proxmoxer.core import ResourceException, AuthenticationError
+from libs.cache import Inventory, IsoCatalog
+from libs.breaker import UpstreamUnavailable, GATEWAY_STATUSES
+from libs.vmmodel import VM
+from libs.metrics import observed, observe_upstream
+
+class AsyncHTTP:
+    """
+        Class to send HTTP/1.1 requests to the Proxmox API over a small pool of kept-alive connections
+    """
+    def __init__(self, host, port=8006, connections=10, timeout=5, metrics=None, breaker=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.metrics = metrics
+        self.breaker = breaker
+        self.context = ssl.create_default_context()
+        self.context.check_hostname = False
+        self.context.verify_mode = ssl.CERT_NONE
+        self.slots = asyncio.Semaphore(connections)
+        self.idle = []
+
+    async def _connect(self):
+        return await asyncio.open_connection(self.host, self.port, ssl=self.context)
+
+    async def _read_body(self, reader, headers):
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    return b"".join(chunks)
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+        return await reader.readexactly(int(headers.get("content-length", 0)))
+
+    async def _exchange(self, reader, writer, request):
+        writer.write(request)
+        await writer.drain()
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Connection closed by the Proxmox API")
+        _, status, reason = status_line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").rstrip("\r\n")
+            if not line:
+                break
+            key, _, value = line.partition(":")
+            headers[key.strip().lower()] = value.strip()
+        body = await self._read_body(reader, headers)
+        return int(status), reason, headers, body
+
+    async def request(self, method, path, headers=None, body=b""):
+        """
+            Function to send a request, reusing an idle connection when there is one.
+            A request on a reused connection the server already closed is retried once.
+            With a circuit breaker, its timeouts and connection errors trip the circuit.
+        """
+        if self.breaker is not None:
+            self.breaker.check()
+        start = time.perf_counter()
+        status = "error"
+        try:
+            result = await self._request(method, path, headers, body)
+            status = str(result[0])
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            if self.breaker is None:
+                raise
+            raise self.breaker.trip(str(e) or type(e).__name__) from e
+        finally:
+            observe_upstream(self.metrics, method, path, status, start)
+        if self.breaker is not None:
+            if result[0] in GATEWAY_STATUSES:
+                raise self.breaker.trip(f"{result[0]} {result[1]}")
+            self.breaker.success()
+        return result
+
+    async def _request(self, method, path, headers=None, body=b""):
+        lines = [ f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}", "Connection: keep-alive" ]
+        for key, value in (headers or {}).items():
+            lines.append(f"{key}: {value}")
+        lines.append(f"Content-Length: {len(body)}")
+        request = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+        async with self.slots:
+            for attempt in range(2):
+                reused = bool(self.idle)
+                reader, writer = self.idle.pop() if reused else await asyncio.wait_for(self._connect(), self.timeout)
+                try:
+                    status, reason, response_headers, data = await asyncio.wait_for(
+                        self._exchange(reader, writer, request), self.timeout
+                    )
+                except (ConnectionError, asyncio.IncompleteReadError) as e:
+                    writer.close()
+                    if reused and attempt == 0:
+                        continue
+                    raise e
+                except BaseException:
+                    writer.close()
+                    raise
+                if response_headers.get("connection", "").lower() == "close":
+                    writer.close()
+                else:
+                    self.idle.append((reader, writer))
+                return status, reason, data
+
+    def close(self):
+        while self.idle:
+            self.idle.pop()[1].close()
+
+class AsyncResource:
+    """
+        Class to build Proxmox API paths like proxmoxer does, with awaitable calls
+    """
+    def __init__(self, client, path=""):
+        self.client = client
+        self.path = path
+
+    def __getattr__(self, item):
+        if item.startswith("_"):
+            raise AttributeError(item)
+        return AsyncResource(self.client, f"{self.path}/{item}")
+
+    def __call__(self, resource_id=None):
+        if resource_id is None:
+            return self
+        return AsyncResource(self.client, f"{self.path}/{quote(str(resource_id), safe='')}")
+
+    async def get(self, **params):
+        return await self.client.call("GET", self.path, params=params)
+
+    async def post(self, **data):
+        return await self.client.call("POST", self.path, data=data)
+
+    async def put(self, **data):
+        return await self.client.call("PUT", self.path, data=data)
+
+    async def set(self, **data):
+        return await self.client.call("PUT", self.path, data=data)
+
+    async def delete(self, **params):
+        return await self.client.call("DELETE", self.path, params=params)
+
+class AsyncProxmoxAPI(AsyncResource):
+    """
+        Class to call the Proxmox API with a ticket, renewing it before it expires
+    """
+    # Seconds before the ticket is renewed, Proxmox tickets are valid for two hours
+    renew_age = 3600
+
+    def __init__(self, host, user, password, port=8006, connections=10, timeout=5, metrics=None, breaker=None):
+        super().__init__(self)
+        self.user = user
+        self.password = password
+        self.http = AsyncHTTP(host, port, connections=connections, timeout=timeout, metrics=metrics, breaker=breaker)
+        self.ticket = None
+        self.csrf = None
+        self.birth = 0
+        self.renewing = asyncio.Lock()
+
+    async def login(self):
+        body = urlencode({ "username": self.user, "password": self.ticket or self.password }).encode()
+        status, reason, data = await self.http.request(
+            "POST",
+            "/api2/json/access/ticket",
+            { "Content-Type": "application/x-www-form-urlencoded" },
+            body
+        )
+        if status != 200:
+            raise AuthenticationError(f"Couldn't authenticate user: {self.user} to /access/ticket")
+        ticket = json.loads(data)["data"]
+        self.ticket = ticket["ticket"]
+        self.csrf = ticket["CSRFPreventionToken"]
+        self.birth = time.monotonic()
+
+    async def call(self, method, path, params=None, data=None):
+        if not self.ticket or time.monotonic() - self.birth >= self.renew_age:
+            # The calls started together before the first login wait for a single one
+            async with self.renewing:
+                if not self.ticket or time.monotonic() - self.birth >= self.renew_age:
+                    await self.login()
+        url = f"/api2/json{path}"
+        if params:
+            url += "?" + urlencode(params)
+        headers = { "Cookie": f"PVEAuthCookie={self.ticket}" }
+        body = b""
+        if method != "GET":
+            headers["CSRFPreventionToken"] = self.csrf
+        if data:
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+            body = urlencode(data).encode()
+        status, reason, content = await self.http.request(method, url, headers, body)
+        if status >= 400:
+            errors = None
+            try:
+                errors = json.loads(content).get("errors")
+            except ValueError:
+                pass
+            raise ResourceException(status, reason, content.decode(errors="replace"), errors=errors)
+        return json.loads(content).get("data") if content else None
+
+    def close(self):
+        self.http.close()
+
+class AsyncProxmox:
+    """
+        Class to manage Proxmox API without blocking, with the read methods of Proxmox as coroutines.
+        The inventory and the ISO catalog of its scope are shared with the threaded clients.
+    """
+    def __init__(self, host, user, password, port=8006, inventory=None, isos=None, name=None, locks=None, connections=10, deadline=10, metrics=None, breaker=None, timeout=None, caches=None):
+        self.api = AsyncProxmoxAPI(host, user, password, port=port, connections=connections, timeout=timeout or deadline, metrics=metrics, breaker=breaker)
+        self.metrics = metrics
+        self.scope = f"{user}@{host}:{port}"
+        if caches is not None:
+            inventory, isos = caches.get(self.scope)
+        self.inventory = inventory if inventory is not None else Inventory(scope=self.scope)
+        self.isos = isos if isos is not None else IsoCatalog()
+        self.locks = locks if locks is not None else {}
+        self.deadline = deadline
+        self.name = name
+
+    async def open(self):
+        """
+            Function to get the cluster name when it is not known yet, the calls log in on their own so the
+            reads answered from the inventory and the ISO catalog can be served while Proxmox is unavailable
+        """
+        if self.name is None:
+            version = await self.api.version.get()
+            self.name = "Proxmox VE "+version.get('version', 'Unknown')
+        return self
+
+    def tokens(self):
+        """
+            Function to get the current Proxmox ticket and CSRF token of the client, None before it logs in
+        """
+        return (self.api.ticket, self.api.csrf) if self.api.ticket else None
+
+    def lock(self, key):
+        if key not in self.locks:
+            self.locks[key] = asyncio.Lock()
+        return self.locks[key]
+
+    @observed
+    async def snapshot(self):
+        """
+            Function to get the cluster VM resources, one refresh at a time for every client
+        """
+        if self.inventory.is_fresh():
+            return self.inventory.vms
+        async with self.lock("inventory"):
+            if self.inventory.is_fresh():
+                return self.inventory.vms
+            generation = self.inventory.generation
+            try:
+                vms = await self.api.cluster.resources.get(type='vm')
+            except UpstreamUnavailable as e:
+                return self.inventory.serve_stale(e)
+            # The inventory lock is shared with the threads, wait for it off the event loop
+            return await asyncio.get_running_loop().run_in_executor(None, self.inventory.replace, vms, generation)
+
+    @observed
+    async def find_vm(self, vmid):
+        await self.snapshot()
+        return self.inventory.index.get(str(vmid))
+
+    @observed
+    async def vm_state(self, vmid):
+        await self.snapshot()
+        return self.inventory.state(vmid)
+
+    async def gather(self, calls, errors=None):
+        """
+            Function to await a dict of source -> coroutine concurrently, each within the deadline.
+            Failed sources are left out of the results and merged into the errors.
+        """
+        sources = list(calls.keys())
+        outcomes = await asyncio.gather(
+            *[ asyncio.wait_for(call, self.deadline) for call in calls.values() ],
+            return_exceptions=True
+        )
+        results = {}
+        for source, outcome in zip(sources, outcomes):
+            if isinstance(outcome, BaseException):
+                if errors is not None:
+                    errors[source] = str(outcome) or f"Deadline of {self.deadline}s exceeded"
+            else:
+                results[source] = outcome
+        return results
+
+    @observed
+    async def get_vms_id(self):
+        return [ vm['vmid'] for vm in await self.snapshot() if 'vmid' in vm ]
+
+    @observed
+    async def vm_etag(self, vmid, vm=None):
+        if vm is None:
+            vmstatus = await self.find_vm(vmid)
+            digest = self.inventory.digest(vmid)
+            if not vmstatus or not digest:
+                return None
+            vm = { "digest": digest, "status": vmstatus.get('status', 'Unknown') }
+        if not vm.get("digest"):
+            return None
+        return f'{vm["digest"]}-{vm.get("status", "Unknown")}'
+
+    @observed
+    async def get_vm(self, vmid, config=True):
+        vmstatus = await self.find_vm(vmid)
+        if not vmstatus:
+            return None
+        if not config:
+            return VM(vmid, vmstatus, {})
+        return VM(vmid, vmstatus, await self.vm_config(vmstatus['node'], vmid))
+
+    async def vm_config(self, node, vmid):
+        try:
+            vmconfig = await self.api.nodes(node).qemu(vmid).config.get()
+        except UpstreamUnavailable as e:
+            return self.inventory.stale_config(vmid, e)
+        self.inventory.remember_config(vmid, vmconfig)
+        return vmconfig
+
+    @observed
+    async def get_vms(self, vmids=None, errors=None, config=True):
+        wanted = None if vmids is None else set([ str(vmid) for vmid in vmids ])
+        records = {}
+        for vmstatus in await self.snapshot():
+            if 'vmid' in vmstatus and (wanted is None or str(vmstatus['vmid']) in wanted):
+                records[str(vmstatus['vmid'])] = vmstatus
+        if not config:
+            return { vmid: VM(vmid, vmstatus, {}) for vmid, vmstatus in records.items() }
+        configs = await self.gather(
+            { vmid: self.vm_config(vmstatus['node'], vmid) for vmid, vmstatus in records.items() },
+            errors
+        )
+        vms = {}
+        for vmid, vmstatus in records.items():
+            vmconfig = configs.get(vmid)
+            vms[vmid] = VM(vmid, vmstatus, vmconfig) if vmconfig is not None else None
+        return vms
+
+    @observed
+    async def node_list(self):
+        if self.isos.nodes_expired():
+            async with self.lock("nodes"):
+                if self.isos.nodes_expired():
+                    try:
+                        self.isos.store_nodes(await self.api.nodes.get())
+                    except UpstreamUnavailable as e:
+                        return self.isos.serve_stale(*self.isos.nodes, e)
+        return self.isos.nodes[1]
+
+    @observed
+    async def refresh_node(self, node, errors=None):
+        """
+            Function to reload the expired ISO catalog entries of a node
+        """
+        if self.isos.storages_expired(node):
+            try:
+                self.isos.store_storages(node, await self.api.nodes(node).storage.get())
+            except UpstreamUnavailable as e:
+                self.isos.serve_stale(*self.isos.storages.get(node, (0, [])), e)
+        calls = {}
+        for storage in self.isos.storages[node][1]:
+            if self.isos.is_expired(node, storage):
+                calls[f"{node}/{storage}"] = self.load_storage(node, storage)
+        await self.gather(calls, errors)
+
+    async def load_storage(self, node, storage):
+        try:
+            contents = await self.api.nodes(node).storage(storage).content.get(content="iso")
+        except UpstreamUnavailable as e:
+            return self.isos.serve_stale(*self.isos.entries.get((node, storage), (0, {})), e)
+        return self.isos.store_storage(node, storage, contents)
+
+    @observed
+    async def refresh_isos(self, nodes, errors=None):
+        async with self.lock("isos"):
+            await self.gather({ node: self.refresh_node(node, errors) for node in nodes }, errors)
+
+    def node_paths(self, node):
+        isos = []
+        for volid in self.isos.node_isos(None, node, fetch=False).values():
+            iso_arr = volid.split(":")
+            isos.append(f'{node}/{iso_arr[0]}/{iso_arr[1]}')
+        return isos
+
+    @observed
+    async def list_isos(self, errors=None):
+        nodes = await self.node_list()
+        await self.refresh_isos(nodes, errors)
+        isos = []
+        for node in nodes:
+            isos.extend(self.node_paths(node))
+        return isos
+
+    @observed
+    async def list_isos_vm(self, vmid, errors=None):
+        vmstatus = await self.find_vm(vmid)
+        if not vmstatus:
+            return {
+                "error": True,
+                "message": "No VM found"
+            }
+        await self.refresh_isos([ vmstatus["node"] ], errors)
+        return self.node_paths(vmstatus["node"])
+
+    @observed
+    async def find_iso(self, name, vmid=None):
+        if vmid is None:
+            nodes = await self.node_list()
+        else:
+            vmstatus = await self.find_vm(vmid)
+            nodes = [ vmstatus["node"] ] if vmstatus else []
+        await self.refresh_isos(nodes)
+        for node in nodes:
+            volid = self.isos.node_isos(None, node, fetch=False).get(name)
+            if volid:
+                iso_arr = volid.split(":")
+                return f'{node}/{iso_arr[0]}/{iso_arr[1]}'
+        return None
+
+    def close(self):
+        self.api.close()
+
+class AsyncClientPool:
+    """
+        Class to keep the non-blocking clients of the sessions, one per session token.
+        The clients belong to the event loop, the other threads hand their changes over to it.
+    """
+    def __init__(self, host, port=8006, size=32, idle_timeout=1800, name=None, **shared):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.name = name
+        self.shared = shared
+        self.locks = {}
+        self.loop = None
+        self.clients = OrderedDict()
+
+    async def get(self, key, user, password):
+        self.loop = asyncio.get_running_loop()
+        now = time.monotonic()
+        self.evict_idle(now)
+        if key in self.clients:
+            client = self.clients[key][0]
+        else:
+            client = await AsyncProxmox(
+                self.host,
+                user,
+                password,
+                port=self.port,
+                name=self.name() if callable(self.name) else self.name,
+                # The refresh locks go with the caches, one set per scope
+                locks=self.locks.setdefault(f"{user}@{self.host}:{self.port}", {}),
+                **self.shared
+            ).open()
+            if key in self.clients:
+                client.close()
+                client = self.clients[key][0]
+            else:
+                while len(self.clients) >= self.size:
+                    self.clients.popitem(last=False)[1][0].close()
+        self.clients[key] = (client, now)
+        self.clients.move_to_end(key)
+        return client
+
+    def evict_idle(self, now=None):
+        """
+            Function to close the least recently used clients idle for longer than the timeout, on the event loop
+        """
+        now = now or time.monotonic()
+        while self.clients:
+            key, (client, last_used) = next(iter(self.clients.items()))
+            if now - last_used < self.idle_timeout:
+                break
+            self.clients.popitem(last=False)
+            client.close()
+
+    def _drop(self, key):
+        entry = self.clients.pop(key, None)
+        if entry:
+            entry[0].close()
+
+    def discard(self, key):
+        """
+            Function to drop the client of a session, it may be called from any thread
+        """
+        if self.loop is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            self._drop(key)
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._drop, key)
@@ -1,28 +1,38 @@
-import time
+import os
 import json
+import time
 import random
 import uuid
 import logging, sys
 from functools import wraps
 from datetime import datetime
-from flask import Flask, request, render_template, make_response
-from libs.pmoxlib import Proxmox
+from flask import Flask, Response, request, make_response, g
+from proxmoxer import AuthenticationError
+from libs.pmoxlib import ClientPool, FanOut, SingleFlight
+from libs.breaker import CircuitBreaker, UpstreamUnavailable, track_stale, untrack_stale, stale_warning
+from libs.cache import ScopedCaches, InventoryPoller
+from libs.tasks import TaskService, SQLiteTaskStore
+from libs.metrics import Metrics
+from libs import tracing
+from libs.tracing import Profiler
+from libs.events import EventService, SQLiteSubscriptionStore
+from libs.bmcmap import BmcMap
+from libs.listeners import Listeners
+from libs.sessions import open_store, public
+from libs.resources import Resources, StaticResources, QueryError, respond, not_modified, paging, paginate, expansion, selection, project
 from libs.common import CustomFormatter
 
-global SESSIONS
-SESSIONS = {}
+# ComputerSystem properties that need the VM config, the others come from the inventory
+CONFIG_PROPERTIES = [ "UUID", "ProcessorSummary", "MemorySummary" ]
 
-def bmc_map():
-    json_out = {}
-    with open("bmc_map", "r") as f:
-        arr_map = [ x.split() for x in f.readlines() ]
-    for line in arr_map:
-        json_out[line[0]] = line[1]
-    
-    return json_out
+# ResetType values of ComputerSystem.Reset, the restarts run as tasks
+RESET_TYPES = [ "On", "ForceOn", "ForceOff", "PushPowerButton", "GracefulShutdown", "ForceRestart", "GracefulRestart" ]
+
+def needs_config(properties):
+    return properties is None or any([ key in properties for key in CONFIG_PROPERTIES ])
 
 class RedmoxAPI():
-    def __init__(self, configs, debug=False):
+    def __init__(self, configs, debug=False, webhooks=True):
         self.configs = configs
         self.app = Flask("RedmoxAPI")
         for handler in self.app.logger.handlers[:]:
@@ -35,49 +45,201 @@ class RedmoxAPI():
             self.app.logger.setLevel(logging.INFO)
         self.app.logger.addHandler(handler)
         self.app.logger.propagate = False
-        self.current_user = ''
-        with open("bmc_map", "r") as f:
-            arr_map = [ x.split() for x in f.readlines() ]
-        self.bmc_map = {}
-        for line in arr_map:
-            self.bmc_map[line[0]] = line[1]
+        self.resources = Resources(os.path.join(self.app.root_path, "templates"))
+        self.static = StaticResources()
+        cache_configs = self.configs.get("cache") or {}
+        self.caches = ScopedCaches(
+            inventory={
+                "ttl": cache_configs.get("inventory_ttl", 5),
+                "max_stale": cache_configs.get("max_stale", 3600),
+                "stale_wait": cache_configs.get("stale_wait", 1)
+            },
+            isos={ "ttl": cache_configs.get("iso_ttl", 60), "max_stale": cache_configs.get("max_stale", 3600) }
+        )
+        trace_configs = self.configs.get("tracing") or {}
+        self.server_timing = trace_configs.get("server_timing", True)
+        self.trace_log = trace_configs.get("log", False)
+        self.admins = trace_configs.get("admins", [ "root@pam" ])
+        self.profiler = Profiler()
+        metric_configs = self.configs.get("metrics") or {}
+        self.metrics = Metrics() if metric_configs.get("enabled", True) else None
+        upstream_configs = self.configs.get("upstream") or {}
+        self.fanout = FanOut(
+            workers=upstream_configs.get("workers", 8),
+            deadline=upstream_configs.get("deadline", 10)
+        )
+        self.flights = SingleFlight() if upstream_configs.get("coalesce", True) else None
+        self.breaker = CircuitBreaker(
+            threshold=upstream_configs.get("breaker_threshold", 5),
+            reset_timeout=upstream_configs.get("breaker_reset", 30)
+        )
+        self.clients = ClientPool(
+            host=self.configs["proxmox"]["host"],
+            port=self.configs["proxmox"]["port"],
+            size=upstream_configs.get("pool_size", 32),
+            idle_timeout=upstream_configs.get("pool_idle", 1800),
+            caches=self.caches,
+            fanout=self.fanout,
+            connections=upstream_configs.get("connections", 10),
+            metrics=self.metrics,
+            flights=self.flights,
+            breaker=self.breaker,
+            timeout=upstream_configs.get("timeout", 5)
+        )
+        self.poller = InventoryPoller(
+            self.clients.active,
+            interval=cache_configs.get("poll_interval", 0)
+        )
+        event_configs = self.configs.get("events") or {}
+        # Every SSE client holds a server thread, by default half of them are left to the other requests
+        server_threads = (self.configs.get("redfish") or {}).get("threads", 4)
+        event_backend = event_configs.get("backend", "memory")
+        if event_backend not in [ "memory", "sqlite" ]:
+            raise ValueError(f"Unknown event backend: {event_backend}")
+        self.events = EventService(
+            queue_size=event_configs.get("queue_size", 256),
+            webhook_timeout=event_configs.get("webhook_timeout", 5),
+            max_subscribers=event_configs.get("max_subscribers", max(1, server_threads // 2)),
+            store=SQLiteSubscriptionStore(path=event_configs.get("path", "redmox-events.db")) if event_backend == "sqlite" else None,
+            webhooks=webhooks
+        )
+        if self.events.max_subscribers >= server_threads:
+            self.app.logger.warning(f"Up to {self.events.max_subscribers} SSE clients can hold every one of the {server_threads} server threads")
+        self.event_keepalive = event_configs.get("keepalive", 15)
+        self.caches.listen(self.events.on_refresh)
+        session_configs = self.configs.get("sessions") or {}
+        self.sessions = open_store(session_configs, on_evict=self.clients.discard)
+        task_configs = self.configs.get("tasks") or {}
+        task_backend = task_configs.get("backend", "memory")
+        if task_backend not in [ "memory", "sqlite" ]:
+            raise ValueError(f"Unknown task backend: {task_backend}")
+        self.tasks = TaskService(
+            workers=task_configs.get("workers", 4),
+            timeout=task_configs.get("timeout", 60),
+            store=SQLiteTaskStore(path=task_configs.get("path", "redmox-tasks.db")) if task_backend == "sqlite" else None
+        )
+        bmc_configs = self.configs.get("bmc") or {}
+        self.bmc_map = BmcMap(
+            path=bmc_configs.get("map", "bmc_map"),
+            reload_interval=bmc_configs.get("reload_interval", 2),
+            logger=self.app.logger
+        )
+        redfish_configs = self.configs.get("redfish") or {}
+        self.listeners = Listeners(redfish_configs.get("listeners") if redfish_configs.get("mode") == "multi" else None)
+        if self.metrics is not None:
+            self.metrics.gauge("redmox_sessions", "Open Redfish sessions", lambda: len(self.sessions))
+            self.metrics.gauge("redmox_proxmox_clients", "Pooled Proxmox clients", lambda: len(self.clients))
+            if self.flights is not None:
+                self.metrics.counter("redmox_upstream_coalesced_total", "Proxmox GETs answered by an identical GET already in flight", lambda: self.flights.status()["coalesced"])
+            self.metrics.gauge("redmox_upstream_circuit_open", "1 while the circuit breaker rejects the Proxmox calls", lambda: int(self.breaker.state() == "open"))
+            self.metrics.counter("redmox_upstream_circuit_opens_total", "Times the circuit breaker opened", lambda: self.breaker.opens)
+            self.metrics.counter("redmox_upstream_circuit_rejected_total", "Proxmox calls rejected by the open circuit breaker", lambda: self.breaker.rejected)
 
         # Authentication decorator
         def token_required(f):
             @wraps(f)
             def wrapper(*args, **kwargs):
+                start = time.perf_counter()
                 token = request.headers.get('x-auth-token')
                 if not token:
+                    self.count_auth("missing")
                     self.app.logger.error("No valid token provided")
                     return make_response(json.dumps({"message": "A valid token is missing!"}, indent=4), 401)
                 try:
-                    if len(SESSIONS) == 0:
+                    if len(self.sessions) == 0:
+                        self.count_auth("invalid")
                         self.app.logger.error("No sessions are created")
                         return make_response(json.dumps({"message": "Invalid token!"}, indent=4), 401)
-                    match_flag = False
-                    for key in SESSIONS.keys():
-                        if token == key:
-                            match_flag = True
-                    if match_flag:
-                        if SESSIONS[token]["UserName"] != self.current_user:
-                            self.pmox = Proxmox(
-                                host=self.configs["proxmox"]["host"],
-                                port=self.configs["proxmox"]["port"],
-                                user=SESSIONS[token]["UserName"],
-                                password=SESSIONS[token]["Password"]
-                            )
+                    session = self.sessions.get(token)
+                    if session:
+                        # Proxmox renews a ticket given as the password, the sessions never keep the user password
+                        g.pmox = self.clients.get(
+                            token,
+                            user=session["UserName"],
+                            password=session["Ticket"]
+                        )
+                        renewed = self.renewed(session, g.pmox)
+                        if renewed:
+                            self.sessions.update(token, renewed)
+                        g.user = session["UserName"]
+                        self.count_auth("ok")
                         self.app.logger.info("Proxmox session initiated")
                     else:
+                        self.count_auth("invalid")
                         self.app.logger.error("No valid token provided")
                         return make_response(json.dumps({"message": "Invalid token!"}, indent=4), 401)
+                except UpstreamUnavailable:
+                    self.count_auth("unavailable")
+                    raise
                 except Exception as e:
+                    self.count_auth("error")
                     self.app.logger.error(f"Error opening sessions: {e}")
                     return make_response(json.dumps({"message": "Invalid token!", "error": e}, indent=4), 401)
+                tracing.record("auth", "token_required", start, time.perf_counter() - start)
                 return f(*args, **kwargs)
             return wrapper
 
+        @self.app.before_request
+        def begin_trace():
+            if self.server_timing or self.trace_log:
+                g.trace = tracing.begin()
+            g.profile = self.profiler.begin()
+            g.stale = track_stale()
+
+        @self.app.after_request
+        def end_trace(response):
+            trace = tracing.current()
+            if trace is not None:
+                if self.server_timing:
+                    response.headers["Server-Timing"] = trace.server_timing()
+                if self.trace_log:
+                    fields = { "method": request.method, "path": request.full_path.rstrip("?"), "status": response.status_code }
+                    fields.update(trace.fields())
+                    self.app.logger.info(f"Trace: {json.dumps(fields)}")
+            return response
+
+        @self.app.after_request
+        def warn_stale(response):
+            warning = stale_warning()
+            if warning is not None and response.status_code < 400:
+                response.headers["Warning"] = warning
+            return response
+
+        @self.app.teardown_request
+        def close_trace(exc):
+            if g.get("profile") is not None:
+                self.profiler.end(g.profile)
+            if g.get("trace") is not None:
+                tracing.end(g.trace)
+            if g.get("stale") is not None:
+                untrack_stale(g.stale)
+
+        if self.metrics is not None:
+            @self.app.before_request
+            def start_timer():
+                g.started = time.perf_counter()
+                self.metrics.in_flight.inc()
+
+            @self.app.after_request
+            def record_status(response):
+                g.status = response.status_code
+                return response
+
+            @self.app.teardown_request
+            def observe_request(exc):
+                if "started" not in g:
+                    return
+                self.metrics.in_flight.dec()
+                endpoint = request.url_rule.endpoint if request.url_rule else "unmatched"
+                self.metrics.requests.observe(time.perf_counter() - g.started, endpoint, request.method, str(g.get("status", 500)))
+
+            @self.app.route('/metrics', methods=['GET'])
+            def metrics():
+                return Response(self.metrics.render(), content_type=self.metrics.content_type)
+
         @self.app.before_request
         def log_request():
+            self.listeners.count(request.environ.get("SERVER_PORT"))
             message = f"{request.remote_addr} {request.method} {request.path}"
             if request.method in ['POST', 'PUT'] and self.app.logger.isEnabledFor(logging.DEBUG):
                 message += f" DATA: {request.get_data(as_text=True)}"
@@ -95,68 +257,58 @@ class RedmoxAPI():
 
         @self.app.route("/redfish", methods=["GET"])
         def redfish():
-            json_out = {
-                "v1": "/redfish/v1"
-            }
-            return json_out
+            return self.static.respond("redfish")
 
         @self.app.route("/redfish/v1", methods=["GET"])
         @token_required
         def v1():
-            try:
-                rules = {}
-                for rule in self.app.url_map.iter_rules():
-                    if rule.endpoint not in ['static', 'redfish', 'v1']:
-                        rules[rule.endpoint] = {
-                            "@odata.id": rule.rule
-                        }
-                pre_json = render_template("root.json")
-                json_out = json.loads(pre_json)
-                json_out.update(rules)
-                error_code = 200
-            except Exception as e:
-                message = f"Error getting rules: {e}"
-                error_code = 500
-                self.app.logger.error(message)
-                json_out = {
-                    "message": message
-                }
-            return make_response(json.dumps(json_out, indent=4), error_code)
+            return self.static.respond("root")
 
         @self.app.route('/redfish/v1/Managers')
         @token_required
         def managers():
-            return render_template('managers.json')
+            return self.static.respond("managers")
 
         @self.app.route(f'/redfish/v1/Managers/1', methods=['GET'])
         @token_required
         def manager():
-            req_addr = request.url.split("/")[2].split(":")[0]
-            vmid = self.bmc_map[req_addr]
-            json_out = render_template(
+            vmid = self.bmc_vmid()
+            if vmid is None:
+                return self.unknown_bmc()
+            json_out = self.resources.encode(
                 'manager.json',
                 date_time=datetime.now().strftime('%Y-%M-%dT%H:%M:%S+00:00'),
                 vmid=vmid
             )
-            return json_out
+            return respond(json_out)
 
         @self.app.route(f'/redfish/v1/Managers/1/VirtualMedia', methods=['GET'])
         @token_required
         def man_virtualmedias():
+            top, skip = paging()
             try:
                 self.app.logger.info("Getting the Proxmox ISO list")
-                isos = self.pmox.list_isos()
-                id_list = []
+                errors = {}
+                isos = g.pmox.list_isos(errors=errors)
+                for source, error in errors.items():
+                    self.app.logger.warning(f"Unable to list ISOs from {source}: {error}")
+                members = []
                 for iso in isos:
                     arr_iso = iso.split("/")
-                    id_list.append(arr_iso[-1])
-                json_out = render_template(
+                    members.append({
+                        "@odata.id": f"/redfish/v1/Managers/1/VirtualMedia/{arr_iso[-1]}"
+                    })
+                page, next_link = paginate(members, top, skip)
+                json_out = self.collection(
                     'virtualmedias.json',
-                    count=len(id_list),
-                    id_list=id_list,
+                    page,
+                    len(members),
+                    next_link,
                     prefix="Managers/1"
                 )
                 error_code = 200
+            except UpstreamUnavailable:
+                raise
             except Exception as e:
                 message = f"Error getting ISOs: {e}"
                 error_code = 500
@@ -164,32 +316,29 @@ class RedmoxAPI():
                 json_out = {
                     "message": message
                 }
-            return make_response(json_out, error_code)
+            return respond(json_out, error_code, etag=error_code == 200)
 
         @self.app.route(f'/redfish/v1/Managers/1/VirtualMedia/<isoid>', methods=['GET'])
         @token_required
         def man_virtualmedia(isoid):
             try:
                 self.app.logger.info("Getting the Proxmox ISO list")
-                isos = self.pmox.list_isos()
-                iso_path = ""
-                for iso in isos:
-                    arr_iso = iso.split("/")
-                    if isoid == arr_iso[-1]:
-                        iso_path = iso
-                        iso_name = arr_iso[-1]
-                if iso_path == "":
+                iso_path = g.pmox.find_iso(isoid)
+                if not iso_path:
                     raise Exception("ISO not found in Proxox Storage")
+                iso_name = iso_path.split("/")[-1]
 
-                json_out = render_template(
+                json_out = self.resources.encode(
                     'virtual_cd.json',
                     id=isoid,
                     image_url=iso_path,
                     name=iso_name,
-                    inserted="true",
+                    inserted=True,
                     prefix="Managers/1"
                 )
                 error_code = 200
+            except UpstreamUnavailable:
+                raise
             except Exception as e:
                 message = f"Error getting ISO: {e}"
                 error_code = 500
@@ -197,11 +346,11 @@ class RedmoxAPI():
                 json_out = {
                     "message": message
                 }
-            return make_response(json_out, error_code)
+            return respond(json_out, error_code, etag=error_code == 200)
 
         @self.app.route('/redfish/v1/SessionService')
         def sessionservice():
-            return render_template('sessionservice.json')
+            return self.static.respond("sessionservice")
 
         @self.app.route('/redfish/v1/SessionService/Sessions', methods=['GET', 'POST'])
         def sessions():
@@ -209,36 +358,36 @@ class RedmoxAPI():
                 username = request.json.get('UserName')
                 password = request.json.get('Password')
                 try:
-                    id = len(SESSIONS) + 1
+                    id = self.sessions.new_id()
                     token = f'{random.getrandbits(128):016x}'
                     location = f"{request.path}/{id}"
                     self.app.logger.info("New Session: Authenticating with ProxMox Server")
-                    self.pmox = Proxmox(
-                        host=self.configs["proxmox"]["host"],
-                        port=self.configs["proxmox"]["port"],
-                        user=username,
-                        password=password
-                    )
-                    self.current_user = username
-                    json_out = render_template(
+                    pmox = self.clients.login(username, password)
+                    session_out = self.resources.build(
                         'session.json',
-                        pmox_name=self.pmox.name,
+                        pmox_name=pmox.name,
                         id=id,
                         username=username,
                         location=location,
                     )
-                    session_out = { token: json.loads(json_out) }
-                    session_out[token]["Password"] = password
-                    SESSIONS.update(session_out)
+                    json_out = json.dumps(session_out, indent=4)
+                    session_out["Ticket"], session_out["CSRFToken"] = pmox.tokens()
+                    self.clients.put(token, pmox)
+                    self.sessions.add(token, session_out)
+                    self.count_login("created")
                     header = f"HTTP/1.1 201 Created\nLocation: {location}\nX-Auth-Token: {token}\nContent-Type: application/json"
                     json_out = header +"\n\n"+ json_out
+                except UpstreamUnavailable:
+                    self.count_login("unavailable")
+                    raise
                 except Exception as e:
+                    self.count_login("failed")
                     self.app.logger.error(f"Unable to authenticate with ProxMox Server: {str(e)}")
                     return make_response(json.dumps({ "error": str(e) }, indent=4), 401)
             if request.method == 'GET':
                 dict_out = []
-                for token in SESSIONS.keys():
-                    session = SESSIONS[token]
+                for session in self.sessions.list():
+                    session = public(session)
                     session["Password"] = "********"
                     dict_out.append(session)
                 json_out = json.dumps(dict_out, indent=4)
@@ -250,188 +399,299 @@ class RedmoxAPI():
         def session(sessionid):
             if request.method == 'DELETE':
                 self.app.logger.warning(f"Deleting Session: {sessionid}")
-                for token in SESSIONS.keys():
-                    if sessionid in SESSIONS[token]['Id']:
-                        SESSIONS.pop(token)
-                        return ''
+                token, session_out = self.sessions.find(sessionid)
+                if token and self.sessions.delete(token):
+                    return ''
                 self.app.logger.error(f"Session: {sessionid} Not found")
                 return '', 404
-            for token in SESSIONS.keys():
-                if sessionid in SESSIONS[token]['Id']:
-                    session_out = SESSIONS[token]
-                    session_out.pop("Password")
-                    return session_out
+            token, session_out = self.sessions.find(sessionid)
+            if session_out:
+                return public(session_out)
             self.app.logger.error(f"Session: {sessionid} Not found")
             return '', 404
 
         @self.app.route('/redfish/v1/Chassis')
         @token_required
         def chassis_collection():
-            return render_template('chassis_collection.json')
+            return self.static.respond("chassis_collection")
 
         @self.app.route('/redfish/v1/Chassis/1U', methods=['GET'])
         @token_required
         def chassis():
-            uuid_out = uuid.UUID(int=1)
-            req_addr = request.url.split("/")[2].split(":")[0]
-            vmid = self.bmc_map[req_addr]
+            uuid_out = str(uuid.UUID(int=1))
+            vmid = self.bmc_vmid()
+            if vmid is None:
+                return self.unknown_bmc()
             self.app.logger.info(f"Getting information from VM: {vmid}")
-            vm = self.pmox.get_vm_info(vmid)
-            if "error" in vm.keys():
-                return make_response(json.dumps(vm, indent=4), 404)
-            if vm.get("status", "Unknown") == "running":
+            vm = g.pmox.vm_state(vmid)
+            if not vm:
+                return make_response(json.dumps({"error": True, "message": "No VM found"}, indent=4), 404)
+            if vm.get("status") == "running":
                 power_state = "On"
             else:
                 power_state = "Off"
-            json_out = render_template(
+            etag = f"{vmid}-{power_state}"
+            response = not_modified(etag)
+            if response:
+                return response
+            json_out = self.resources.encode(
                 'chassis.json',
                 uuid=uuid_out,
                 vmid=vmid,
                 power_state=power_state
             )
-            return json_out
+            return respond(json_out, etag=etag)
 
         @self.app.route('/redfish/v1/Chassis/1U/Power', methods=['GET'])
         @token_required
         def power():
-            return render_template('power.json')
+            return self.static.respond("power")
 
         @self.app.route('/redfish/v1/Chassis/1U/Thermal', methods=['GET'])
         @token_required
         def thermal():
-            return render_template('thermal.json')
+            return self.static.respond("thermal")
 
         @self.app.route("/redfish/v1/Systems", methods=["GET"])
         @token_required
         def Systems():
+            # $expand=* or . inlines every ComputerSystem, the Members are not Links so ~ leaves them as references
+            expand = expansion()
+            top, skip = paging()
+            properties = selection()
+            vmids = [ str(vmid) for vmid in g.pmox.get_vms_id() ]
+            page, next_link = paginate(vmids, top, skip)
             members = []
-            self.app.logger.info("Getting VMs list")
-            for vmid in self.pmox.get_vms_id():
-                members.append({
-                    "@odata.id": f"/redfish/v1/Systems/{vmid}"
-                })
-            json_out = json.loads(render_template(
-                "systems.json",
-                members=json.dumps(members),
-                count=len(members)
-                )
-            )
-            return json.dumps(json_out, indent=4)
+            if expand in [ None, "~" ]:
+                self.app.logger.info("Getting VMs list")
+                for vmid in page:
+                    members.append({
+                        "@odata.id": f"/redfish/v1/Systems/{vmid}"
+                    })
+            else:
+                self.app.logger.info("Getting information from every VM")
+                errors = {}
+                for vmid, vm in g.pmox.get_vms(page, errors=errors, config=needs_config(properties)).items():
+                    if vm is None:
+                        self.app.logger.warning(f"Unable to expand VM {vmid}: {errors.get(vmid)}")
+                        members.append({
+                            "@odata.id": f"/redfish/v1/Systems/{vmid}"
+                        })
+                        continue
+                    member = self.resources.build("system.json", **self.system_values(vmid, vm, g.pmox.name))
+                    members.append(project(member, properties) if properties else member)
+            json_out = self.collection("systems.json", members, len(vmids), next_link)
+            return respond(json_out, etag=True)
 
         @self.app.route("/redfish/v1/Systems/<id>", methods=["GET"])
         @token_required
         def System(id):
             self.app.logger.info(f"Getting information from VM: {id}")
-            vm = self.pmox.get_vm_info(id)
-            if vm.get("status", "Unknown") == "running":
-                state = "Enabled"
-                power_state = "On"
-            else:
-                state = "Disabled"
-                power_state = "Off"
-            cpus = vm.get("cpu", {})
-            mem = vm.get("memory", {})
-            json_out = render_template(
-                "system.json",
-                id=id,
-                tags=",".join(vm.get("tags", [])),
-                manufacturer=self.pmox.name,
-                vm_name=vm.get("name", "Unknown"),
-                sys_type=f'[{vm.get("type", "")}] Virtual Machine',
-                vmgenid=vm.get("vmgenid", "0"),
-                state=state,
-                power_state=power_state,
-                bootsourceoverride_enabled="None",
-                bootsourceoverride_target="None",
-                bootsourceoverride_mode="None",
-                cpu_count=cpus["cores"] * cpus["sockets"],
-                total_gb=int(mem["assigned_mb"]) / 1024
-            )
+            properties = selection()
+            if properties is None:
+                response = not_modified(g.pmox.vm_etag(id))
+                if response:
+                    return response
+            vm = g.pmox.get_vm(id, config=needs_config(properties))
+            if vm is None:
+                return make_response(json.dumps({"error": True, "message": "No VM found"}, indent=4), 404)
+            if properties:
+                return respond(project(self.resources.build("system.json", **self.system_values(id, vm, g.pmox.name)), properties), etag=True)
+            json_out = self.resources.encode("system.json", **self.system_values(id, vm, g.pmox.name))
 
-            return json_out
+            return respond(json_out, etag=g.pmox.vm_etag(id, { "digest": vm.digest, "status": vm.status }))
         
         @self.app.route('/redfish/v1/Systems/<id>/Actions/ComputerSystem.Reset', methods=['POST'])
         @token_required
         def system_reset(id):
-            reset_type = request.json.get('ResetType')
+            reset_type = (request.get_json(silent=True) or {}).get('ResetType')
+            if reset_type not in RESET_TYPES:
+                self.app.logger.error(f"Unsupported ResetType: {reset_type}")
+                return make_response(json.dumps({
+                    "error": {
+                        "code": "Base.1.8.ActionParameterNotSupported",
+                        "message": f"The value {reset_type} of the parameter ResetType is not supported, use one of {', '.join(RESET_TYPES)}"
+                    }
+                }, indent=4), 400)
+            if g.pmox.find_vm(id) is None:
+                self.app.logger.error(f"VM: {id} Not found")
+                return make_response(json.dumps({"error": True, "message": "No VM found"}, indent=4), 404)
+            if reset_type == 'ForceRestart' or reset_type == 'GracefulRestart':
+                # The restart runs in the background, refuse it now rather than let the task fail
+                self.breaker.fail_fast()
+                task = self.tasks.submit(
+                    f"{reset_type} of System {id}",
+                    self.tasks.power_cycle,
+                    g.pmox,
+                    id,
+                    reset_type == 'GracefulRestart'
+                )
+                location = f"/redfish/v1/TaskService/Tasks/{task.id}"
+                return respond(self.resources.encode('task.json', **task.fields()), 202, {"Location": location})
             if reset_type == 'On' or reset_type == 'ForceOn':
-                result = self.pmox.run_poweron(id)
+                result = g.pmox.run_poweron(id)
             if reset_type == 'ForceOff' or reset_type == 'PushPowerButton':
-                result = self.pmox.run_poweroff(id)
+                result = g.pmox.run_poweroff(id)
             if reset_type == 'GracefulShutdown':
-                result = self.pmox.run_shutdown(id)
-            if reset_type == 'ForceRestart' or reset_type == 'GracefulRestart':
-                if reset_type == 'GracefulRestart':
-                    result = self.pmox.run_shutdown(id)
-                else:
-                    result = self.pmox.run_poweroff(id)
-                qmstatus = "running"
-                attempts = 0
-                while qmstatus == "running" and attempts < 10:
-                    attempts += 1
-                    result = self.pmox.vm_status(id)
-                    qmstatus = result["qmpstatus"]
-                    time.sleep(3)
-                if attempts == 10:
-                    message = {
-                        "message": "Timeout powering off the system"
-                    }
-                    return make_response(json.dumps(message, indent=4), 500)
-                result = self.pmox.run_poweron(id)
-            
+                result = g.pmox.run_shutdown(id)
+            if result.get("error"):
+                if result.get("message") == "No VM found":
+                    self.app.logger.error(f"VM: {id} Not found")
+                    return make_response(json.dumps({"error": True, "message": "No VM found"}, indent=4), 404)
+                self.app.logger.error(f"{reset_type} of VM: {id} failed: {result.get('message')}")
+                return make_response(json.dumps({"error": True, "message": result.get("message")}, indent=4), 500)
+
             return '', 204
 
+        @self.app.route('/redfish/v1/TaskService', methods=['GET'])
+        @token_required
+        def taskservice():
+            return self.static.respond("taskservice")
+
+        @self.app.route('/redfish/v1/TaskService/Tasks', methods=['GET'])
+        @token_required
+        def tasks():
+            members = []
+            for task in self.tasks.list():
+                members.append({
+                    "@odata.id": f"/redfish/v1/TaskService/Tasks/{task.id}"
+                })
+            return respond(self.resources.encode('tasks.json', members=members, count=len(members)))
+
+        @self.app.route('/redfish/v1/TaskService/Tasks/<taskid>', methods=['GET'])
+        @token_required
+        def task(taskid):
+            task = self.tasks.get(taskid)
+            if not task:
+                self.app.logger.error(f"Task: {taskid} Not found")
+                return make_response(json.dumps({"message": f"Task {taskid} not found"}, indent=4), 404)
+            return respond(self.resources.encode('task.json', **task.fields()))
+
+        @self.app.route('/redfish/v1/EventService', methods=['GET'])
+        @token_required
+        def eventservice():
+            return self.static.respond("eventservice")
+
+        @self.app.route('/redfish/v1/EventService/SSE', methods=['GET'])
+        @token_required
+        def eventservice_sse():
+            last_id = request.headers.get("Last-Event-ID")
+            if last_id is not None and not last_id.isdigit():
+                last_id = None
+            subscriber = self.events.subscribe(g.pmox.scope)
+            if subscriber is None:
+                self.app.logger.error(f"Refusing the SSE client, {self.events.max_subscribers} are already streaming")
+                return make_response(
+                    json.dumps({"message": "Too many event streams, retry later"}, indent=4),
+                    503,
+                    { "Retry-After": str(self.event_keepalive) }
+                )
+            self.app.logger.info("Streaming events")
+            response = Response(
+                self.events.stream(subscriber, last_id, self.event_keepalive),
+                mimetype="text/event-stream",
+                headers={ "Cache-Control": "no-cache", "X-Accel-Buffering": "no" }
+            )
+            # The stream releases its slot when it ends, this covers a stream closed before it started
+            response.call_on_close(lambda: self.events.unsubscribe(subscriber))
+            return response
+
+        @self.app.route('/redfish/v1/EventService/Subscriptions', methods=['GET', 'POST'])
+        @token_required
+        def subscriptions():
+            if request.method == "GET":
+                members = []
+                for subscription in self.events.list_subscriptions(g.pmox.scope):
+                    members.append({
+                        "@odata.id": f"/redfish/v1/EventService/Subscriptions/{subscription['id']}"
+                    })
+                return respond(self.resources.encode('subscriptions.json', members=members, count=len(members)))
+            data = request.get_json(silent=True) or {}
+            destination = data.get("Destination", "")
+            if not destination.startswith(("http://", "https://")):
+                self.app.logger.error(f"Invalid event destination: {destination}")
+                return make_response(json.dumps({"message": "Destination must be an http(s) URL"}, indent=4), 400)
+            subscription = self.events.add_subscription(destination, data.get("Context", ""), g.pmox.scope)
+            self.app.logger.info(f"Events subscription {subscription['id']} to {destination}")
+            location = f"/redfish/v1/EventService/Subscriptions/{subscription['id']}"
+            json_out = self.resources.encode('subscription.json', **subscription)
+            return respond(json_out, 201, headers={ "Location": location })
+
+        @self.app.route('/redfish/v1/EventService/Subscriptions/<subscriptionid>', methods=['GET', 'DELETE'])
+        @token_required
+        def subscription(subscriptionid):
+            subscription = self.events.get_subscription(subscriptionid, g.pmox.scope)
+            if not subscription:
+                self.app.logger.error(f"Subscription: {subscriptionid} Not found")
+                return make_response(json.dumps({"message": f"Subscription {subscriptionid} not found"}, indent=4), 404)
+            if request.method == "DELETE":
+                self.events.delete_subscription(subscriptionid)
+                return '', 204
+            return respond(self.resources.encode('subscription.json', **subscription))
+
         @self.app.route('/redfish/v1/Systems/<id>/VirtualMedia', methods=['GET'])
         @token_required
         def vm_virtualmedias(id):
+            top, skip = paging()
             try:
                 self.app.logger.info(f"Getting list of ISOs in ProxMox: {id}")
-                isos = self.pmox.list_isos_vm(id)
-                id_list = []
+                errors = {}
+                isos = g.pmox.list_isos_vm(id, errors=errors)
+                if isinstance(isos, dict):
+                    self.app.logger.error(f"VM: {id} Not found")
+                    return make_response(json.dumps(isos, indent=4), 404)
+                for source, error in errors.items():
+                    self.app.logger.warning(f"Unable to list ISOs from {source}: {error}")
+                members = []
                 for iso in isos:
                     arr_iso = iso.split("/")
-                    id_list.append(arr_iso[-1])
-                json_out = render_template(
+                    members.append({
+                        "@odata.id": f"/redfish/v1/Systems/{id}/VirtualMedia/{arr_iso[-1]}"
+                    })
+                page, next_link = paginate(members, top, skip)
+                json_out = self.collection(
                     'virtualmedias.json',
-                    count=len(id_list),
-                    id_list=id_list,
+                    page,
+                    len(members),
+                    next_link,
                     prefix=f"Systems/{id}"
                 )
+            except UpstreamUnavailable:
+                raise
             except Exception as e:
                 self.app.logger.error(f"Unable to obtain ISOs list: {str(e)}")
-                json_out = { "error": str(e) }
-            return json_out
+                return respond({ "error": str(e) })
+            return respond(json_out, etag=True)
 
         @self.app.route('/redfish/v1/Systems/<id>/VirtualMedia/<isoid>', methods=['GET'])
         @token_required
         def vm_virtualmedia(id, isoid):
             self.app.logger.info(f"Getting ISO information for: {id}")
-            isos = self.pmox.list_isos_vm(id)
-            for iso in isos:
-                arr_iso = iso.split("/")
-                if isoid == arr_iso[-1]:
-                    iso_path = iso
-                    iso_name = arr_iso[-1]
-
-            json_out = render_template(
+            iso_path = g.pmox.find_iso(isoid, vmid=id)
+            if not iso_path:
+                self.app.logger.error(f"ISO {isoid} not found on the node")
+                return make_response(json.dumps({"message": f"ISO {isoid} not found on the node"}, indent=4), 404)
+            iso_name = iso_path.split("/")[-1]
+
+            json_out = self.resources.encode(
                 'virtual_cd.json',
                 id=isoid,
                 image_url=iso_path,
                 name=iso_name,
-                inserted="true",
+                inserted=True,
                 prefix=f"Systems/{id}"
             )
-            return json_out
+            return respond(json_out, etag=True)
 
         @self.app.route('/redfish/v1/Systems/<id>/VirtualMedia/<isoid>/Actions/VirtualMedia.EjectMedia', methods=['POST'])
         @token_required
         def vm_ejectmedia(id, isoid):
             self.app.logger.info(f"Ejecting ISO {isoid} from VM: {id}")
-            vm_info = self.pmox.get_vm_info(id)
-            if not isoid in vm_info["media"]:
+            vm = g.pmox.get_vm(id)
+            if vm is None or not isoid in vm.media:
                 self.app.logger.error(f"Media not mounted")
                 return make_response(json.dumps({"message": "Media not mounted"}, indent=4), 500)
-            result = self.pmox.eject_iso(id)
+            result = g.pmox.eject_iso(id)
 
             return ""
         
@@ -439,19 +699,79 @@ class RedmoxAPI():
         @token_required
         def vm_insertmedia(id, isoid):
             self.app.logger.info(f"Mounting ISO {isoid} on VM: {id}")
-            isos = self.pmox.list_isos_vm(id)
-            selected_iso = ""
-            for iso in isos:
-                if isoid in iso:
-                    selected_iso = iso
-                    break
-            if selected_iso == "":
-                self.app.logger.error(f"ISO {isoid} not found on the node")
-                return make_response(json.dumps({"message": f"ISO {isoid} not found on the node"}, indent=4), 404)
-            result = self.pmox.mount_iso(id, isoid)
+            result = g.pmox.mount_iso(id, isoid)
+            if result.get("error"):
+                if result.get("message") == "No VM found":
+                    self.app.logger.error(f"VM: {id} Not found")
+                    return make_response(json.dumps({"error": True, "message": "No VM found"}, indent=4), 404)
+                if result.get("message") == "No ISO found":
+                    self.app.logger.error(f"ISO {isoid} not found on the node")
+                    return make_response(json.dumps({"message": f"ISO {isoid} not found on the node"}, indent=4), 404)
+                self.app.logger.error(f"Mounting ISO {isoid} on VM: {id} failed: {result.get('message')}")
+                return make_response(json.dumps({"error": True, "message": result.get("message")}, indent=4), 500)
 
             return ""
 
+        @self.app.route('/redmox/listeners', methods=['GET'])
+        @token_required
+        def listeners():
+            return respond({ "mode": redfish_configs.get("mode", "simple"), "listeners": self.listeners.status() })
+
+        @self.app.route('/redmox/inventory', methods=['GET'])
+        @token_required
+        def inventory():
+            json_out = self.poller.status(g.pmox.scope)
+            if self.flights is not None:
+                json_out["single_flight"] = self.flights.status()
+            json_out["circuit_breaker"] = self.breaker.status()
+            json_out["states"] = g.pmox.inventory.states
+            return respond(json_out)
+
+        @self.app.route('/redmox/profile', methods=['GET', 'POST', 'DELETE'])
+        @token_required
+        def profile():
+            if g.user not in self.admins:
+                self.app.logger.error(f"Profiling denied to {g.user}")
+                return make_response(json.dumps({"message": "Profiling is restricted to the administrators"}, indent=4), 403)
+            if request.method == 'POST':
+                requests = (request.get_json(silent=True) or {}).get("requests", 10)
+                if not isinstance(requests, int) or requests < 1:
+                    return make_response(json.dumps({"message": "requests must be a positive integer"}, indent=4), 400)
+                self.profiler.arm(requests)
+                self.app.logger.warning(f"Profiling the next {requests} requests")
+            elif request.method == 'DELETE':
+                self.profiler.arm(0)
+            try:
+                limit = int(request.args.get("limit", 30))
+                return respond(self.profiler.report(limit=limit, sort=request.args.get("sort", "cumulative")))
+            except ValueError as e:
+                return make_response(json.dumps({"message": str(e)}, indent=4), 400)
+
+        @self.app.errorhandler(QueryError)
+        def query_error(e):
+            message = f'[{request.method} {request.full_path}] {e}'
+            self.app.logger.error(message)
+            json_out = {
+                "error": message
+            }
+            return json_out, 400
+
+        @self.app.errorhandler(UpstreamUnavailable)
+        def upstream_unavailable(e):
+            message = f'[{request.method} {request.full_path.rstrip("?")}] {e}'
+            self.app.logger.error(message)
+            json_out = {
+                "error": message
+            }
+            return json_out, 503, { "Retry-After": str(e.retry_after) }
+
+        @self.app.errorhandler(AuthenticationError)
+        def authentication_error(e):
+            # The client of a session logs in on its first Proxmox call, the password may have changed since
+            self.count_auth("invalid")
+            self.app.logger.error(f"Error opening sessions: {e}")
+            return make_response(json.dumps({"message": "Invalid token!"}, indent=4), 401)
+
         @self.app.errorhandler(404)
         def page_not_found(e):
             message = f'[{request.method} {request.path}] Redfish endpoint not found'
@@ -460,4 +780,118 @@ class RedmoxAPI():
                 "error": message
             }
             return json_out, 404
+
+        self.build_static()
+
+    def bmc_vmid(self):
+        """
+            Function to get the vmid of the BMC a request is addressed to, from its listener or its Host header
+        """
+        vmid = self.listeners.vmid(request.environ.get("SERVER_PORT"))
+        if vmid is None:
+            vmid = self.bmc_map.lookup(request.host)
+        return vmid
+
+    def unknown_bmc(self):
+        message = f"No VM mapped to the BMC address {request.host}"
+        self.app.logger.error(message)
+        return make_response(json.dumps({"error": True, "message": message}, indent=4), 404)
+
+    def collection(self, template, members, count, next_link, **values):
+        """
+            Function to encode a page of a collection, with the link to the next page when there is one
+        """
+        if next_link is None:
+            return self.resources.encode(template, members=members, count=count, **values)
+        json_out = self.resources.build(template, members=members, count=count, **values)
+        json_out["Members@odata.nextLink"] = next_link
+        return json_out
+
+    def system_values(self, id, vm, manufacturer):
+        """
+            Function to get the values of the ComputerSystem template of a VM
+        """
+        if vm.status == "running":
+            state = "Enabled"
+            power_state = "On"
+        else:
+            state = "Disabled"
+            power_state = "Off"
+        return {
+            "id": id,
+            "tags": ",".join(vm.tags),
+            "manufacturer": manufacturer,
+            "vm_name": vm.name,
+            "sys_type": f'[{vm.type}] Virtual Machine',
+            "vmgenid": vm.vmgenid or "0",
+            "state": state,
+            "power_state": power_state,
+            "bootsourceoverride_enabled": "None",
+            "bootsourceoverride_target": "None",
+            "bootsourceoverride_mode": "None",
+            "cpu_count": vm.cores * vm.sockets,
+            "total_gb": vm.memory_mb / 1024
+        }
+
+    def renewed(self, session, pmox):
+        """
+            Function to get the session with the renewed Proxmox ticket of its client, None when it did not change.
+            Storing it lets the other workers log in again with a ticket that has not expired.
+        """
+        tokens = pmox.tokens()
+        if tokens is None or tokens[0] == session["Ticket"]:
+            return None
+        return dict(session, Ticket=tokens[0], CSRFToken=tokens[1])
+
+    def count_auth(self, result):
+        if self.metrics is not None:
+            self.metrics.auth.inc(result)
+
+    def count_login(self, result):
+        if self.metrics is not None:
+            self.metrics.logins.inc(result)
+
+    def start(self):
+        """
+            Function to start the background threads: session sweeper and inventory poller
+        """
+        self.sessions.start()
+        if self.poller.interval:
+            ttl = self.caches.inventory_options["ttl"]
+            if self.poller.interval >= ttl:
+                self.app.logger.warning(f"Inventory poll interval ({self.poller.interval}s) is not under the inventory TTL ({ttl}s)")
+            self.app.logger.info(f"Polling the Proxmox inventory every {self.poller.interval}s")
+            self.poller.start()
+
+    def stop(self):
+        """
+            Function to stop the background threads
+        """
+        self.poller.stop()
+        self.sessions.stop()
+        self.events.shutdown()
+
+    def build_static(self):
+        """
+            Function to build the resources that do not change between requests.
+            Must be called again after changing the configuration.
+        """
+        rules = {}
+        # The service root links the Redfish resources only, not /metrics, /redmox/* nor the SSE stream of the EventService
+        for rule in self.app.url_map.iter_rules():
+            if rule.rule.startswith("/redfish/v1/") and rule.endpoint not in ['eventservice_sse']:
+                rules[rule.endpoint] = {
+                    "@odata.id": rule.rule
+                }
+        root = self.resources.build("root.json")
+        root.update(rules)
+        self.static.set("root", root)
+        self.static.set("redfish", { "v1": "/redfish/v1" })
+        self.static.set("managers", self.resources.encode("managers.json"))
+        self.static.set("sessionservice", self.resources.encode("sessionservice.json", timeout=self.sessions.idle_timeout))
+        self.static.set("chassis_collection", self.resources.encode("chassis_collection.json"))
+        self.static.set("power", self.resources.encode("power.json"))
+        self.static.set("thermal", self.resources.encode("thermal.json"))
+        self.static.set("taskservice", self.resources.encode("taskservice.json"))
+        self.static.set("eventservice", self.resources.encode("eventservice.json"))
     
\ No newline at end of file
@@ -0,0 +1,146 @@
+"""
+    Module providing the map of BMC addresses to VMs
+"""
+
+#!/usr/bin/env python3
+import os
+import time
+import logging
+import ipaddress
+import threading
+
+# Largest address range a single rule may expand to
+MAX_RANGE = 65536
+
+def host_address(host):
+    """
+        Function to get the address part of a Host header, without the port
+    """
+    if host.startswith("["):
+        return host[1:].split("]")[0]
+    if host.count(":") == 1:
+        return host.split(":")[0]
+    return host
+
+def normalize(address):
+    try:
+        return str(ipaddress.ip_address(address))
+    except ValueError:
+        return address.lower()
+
+def is_ip(address):
+    try:
+        ipaddress.ip_address(address)
+        return True
+    except ValueError:
+        return False
+
+def parse_rule(address, vmid):
+    """
+        Function to expand a rule into (address, vmid) pairs, None when it is a single address.
+        The address is an IP or a host name, a CIDR network or a first-last IP range; with a
+        network or a range, every address gets the vmid plus its offset from the first one.
+    """
+    vmid = int(vmid)
+    if "/" in address:
+        network = ipaddress.ip_network(address, strict=False)
+        first, last = network.network_address, network.broadcast_address
+    elif "-" in address and is_ip(address.split("-", 1)[0]):
+        start, end = address.split("-", 1)
+        first, last = ipaddress.ip_address(start), ipaddress.ip_address(end)
+        if first.version != last.version or last < first:
+            raise ValueError(f"Invalid address range {address}")
+    else:
+        return None
+    size = int(last) - int(first) + 1
+    if size > MAX_RANGE:
+        raise ValueError(f"Address range {address} is larger than {MAX_RANGE} addresses")
+    return [ (str(first + offset), str(vmid + offset)) for offset in range(size) ]
+
+class BmcMap:
+    """
+        Class to resolve the VM emulated by each BMC address, reloading the map file when it changes
+    """
+    def __init__(self, path="bmc_map", reload_interval=2, logger=None):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.logger = logger or logging.getLogger("RedmoxAPI")
+        self.lock = threading.Lock()
+        self.index = {}
+        self.mtime = None
+        self.checked = 0
+        self.load()
+
+    def parse(self, lines):
+        """
+            Function to build the address index from the lines of a map file.
+            Exact addresses take precedence over the addresses of networks and ranges.
+        """
+        exact = {}
+        ranges = {}
+        for number, line in enumerate(lines, 1):
+            fields = line.split("#")[0].split()
+            if not fields:
+                continue
+            if len(fields) != 2:
+                raise ValueError(f"{self.path}:{number}: expected an address and a vmid")
+            try:
+                pairs = parse_rule(fields[0], fields[1])
+                if pairs is None:
+                    exact[normalize(fields[0])] = str(int(fields[1]))
+                    continue
+            except ValueError as e:
+                raise ValueError(f"{self.path}:{number}: {e}")
+            for address, vmid in pairs:
+                ranges.setdefault(address, vmid)
+        ranges.update(exact)
+        return ranges
+
+    def load(self):
+        """
+            Function to read the map file, keeping the previous index when it is invalid
+        """
+        mtime = os.stat(self.path).st_mtime
+        with open(self.path, "r") as f:
+            lines = f.readlines()
+        try:
+            index = self.parse(lines)
+        except ValueError as e:
+            self.logger.error(f"Keeping the previous BMC map: {e}")
+            self.mtime = mtime
+            return False
+        self.index = index
+        self.mtime = mtime
+        return True
+
+    def check(self):
+        """
+            Function to reload the map file when its modification time changed, at most every reload_interval
+        """
+        now = time.monotonic()
+        if now - self.checked < self.reload_interval:
+            return
+        with self.lock:
+            if now - self.checked < self.reload_interval:
+                return
+            self.checked = now
+            try:
+                if os.stat(self.path).st_mtime != self.mtime:
+                    if self.load():
+                        self.logger.info(f"BMC map reloaded: {len(self.index)} addresses")
+            except OSError as e:
+                self.logger.error(f"Unable to read the BMC map: {e}")
+
+    def lookup(self, host):
+        """
+            Function to get the vmid of the BMC addressed by a Host header, None if it is unknown
+        """
+        self.check()
+        address = host_address(host)
+        vmid = self.index.get(address)
+        if vmid is None:
+            vmid = self.index.get(normalize(address))
+        return vmid
+
+    def __len__(self):
+        return len(self.index)
@@ -0,0 +1,188 @@
+"""
+    Module providing the circuit breaker around the Proxmox API and the staleness of the responses
+"""
+
+#!/usr/bin/env python3
+import time
+import threading
+import contextvars
+import requests
+
+# Sources of the response being built that were served from their last good data, propagated like the trace
+STALE = contextvars.ContextVar("redmox_stale", default=None)
+
+# Proxmox API answers meaning pveproxy or a proxy in front of it is not serving
+GATEWAY_STATUSES = (502, 503, 504)
+
+class UpstreamUnavailable(Exception):
+    """
+        Exception raised when the Proxmox API times out, can not be reached or the circuit is open
+    """
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """
+        Class to stop calling the Proxmox API after consecutive failures.
+        The circuit opens after threshold failures in a row, rejects every call for
+        reset_timeout seconds, then lets a single trial call through: the circuit
+        closes when it succeeds and opens again when it fails. A threshold of 0
+        never opens the circuit, failures are still reported as UpstreamUnavailable.
+    """
+    def __init__(self, threshold=5, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened = None
+        self.trial = None
+        self.opens = 0
+        self.rejected = 0
+        self.last_error = None
+
+    def state(self):
+        if self.opened is None:
+            return "closed"
+        if time.monotonic() - self.opened < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def retry_after(self):
+        """
+            Function to get the whole seconds before the next trial call, at least 1
+        """
+        opened = self.opened
+        if opened is None:
+            return 1
+        return max(1, int(self.reset_timeout - (time.monotonic() - opened) + 0.999))
+
+    def allow(self):
+        """
+            Function to tell if a call may go upstream, marking it as the trial when the circuit is half-open.
+            A trial that did not report back within reset_timeout seconds is replaced.
+        """
+        if self.opened is None:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            if self.opened is None:
+                return True
+            if now - self.opened < self.reset_timeout:
+                return False
+            if self.trial is not None and now - self.trial < self.reset_timeout:
+                return False
+            self.trial = now
+            return True
+
+    def reject(self):
+        with self.lock:
+            self.rejected += 1
+        return UpstreamUnavailable(f"Proxmox API unavailable ({self.last_error}), circuit open", self.retry_after())
+
+    def check(self):
+        """
+            Function to raise UpstreamUnavailable when the circuit rejects calls
+        """
+        if not self.allow():
+            raise self.reject()
+
+    def fail_fast(self):
+        """
+            Function to raise UpstreamUnavailable while the circuit is open, without taking the trial call
+        """
+        if self.state() == "open":
+            raise self.reject()
+
+    def success(self):
+        if self.failures or self.opened is not None:
+            with self.lock:
+                self.failures = 0
+                self.opened = None
+                self.trial = None
+
+    def trip(self, error):
+        """
+            Function to count a failed call, returns the UpstreamUnavailable to raise for it
+        """
+        with self.lock:
+            self.failures += 1
+            self.last_error = str(error)
+            self.trial = None
+            if self.threshold and (self.opened is not None or self.failures >= self.threshold):
+                if self.opened is None or time.monotonic() - self.opened >= self.reset_timeout:
+                    self.opens += 1
+                self.opened = time.monotonic()
+        return UpstreamUnavailable(f"Proxmox API unavailable: {error}", self.retry_after())
+
+    def call(self, func, *args, **kwargs):
+        """
+            Function to call func through the circuit, its connection errors and timeouts trip it
+        """
+        self.check()
+        try:
+            result = func(*args, **kwargs)
+        except requests.RequestException as e:
+            raise self.trip(e) from e
+        except Exception:
+            self.success()
+            raise
+        self.success()
+        return result
+
+    def guard(self, session):
+        """
+            Function to route every request of a requests session through the circuit, the one under a ProxmoxAPI client
+        """
+        send = session.request
+        def request(method, url, *args, **kwargs):
+            self.check()
+            try:
+                response = send(method, url, *args, **kwargs)
+            except requests.RequestException as e:
+                raise self.trip(e) from e
+            if response.status_code in GATEWAY_STATUSES:
+                raise self.trip(f"{response.status_code} {response.reason}")
+            self.success()
+            return response
+        session.request = request
+
+    def status(self):
+        return {
+            "state": self.state(),
+            "failures": self.failures,
+            "threshold": self.threshold,
+            "reset_timeout": self.reset_timeout,
+            "retry_after": self.retry_after() if self.opened is not None else None,
+            "opens": self.opens,
+            "rejected": self.rejected,
+            "last_error": self.last_error
+        }
+
+def track_stale():
+    """
+        Function to start collecting the stale sources of the current request, returns the token to stop
+    """
+    return STALE.set([])
+
+def untrack_stale(token):
+    STALE.reset(token)
+
+def mark_stale(source, age):
+    """
+        Function to report that the current request is served data of source last fetched age seconds ago
+    """
+    sources = STALE.get()
+    if sources is not None:
+        sources.append((source, age))
+
+def stale_warning():
+    """
+        Function to get the Warning header value of the current request, None when nothing was stale
+    """
+    sources = STALE.get()
+    if not sources:
+        return None
+    age = max([ age for source, age in sources ])
+    names = ", ".join(sorted(set([ source for source, age in sources ])))
+    return f'110 - "Response is Stale: Proxmox API unavailable, {names} from {int(age)}s ago"'
@@ -0,0 +1,459 @@
+"""
+    Module providing shared caches for Proxmox API data
+"""
+
+#!/usr/bin/env python3
+import time
+import threading
+from functools import partial
+from libs.breaker import UpstreamUnavailable, mark_stale
+
+# Fields of the cluster resources kept in the VM state table
+STATE_FIELDS = [ "node", "status", "uptime", "cpu", "maxcpu", "mem", "maxmem" ]
+
+class Inventory:
+    """
+        Class to keep a snapshot of the cluster VM resources shared by the clients of one Proxmox scope.
+        While the Proxmox API is unavailable, the last snapshot and VM configs are
+        served for up to max_stale seconds, and a request does not wait more than
+        stale_wait seconds for a refresh running in another thread.
+    """
+    def __init__(self, ttl=5, max_stale=3600, stale_wait=1, scope=None, on_invalidate=None):
+        self.ttl = ttl
+        self.scope = scope
+        self.on_invalidate = on_invalidate
+        self.max_stale = max_stale
+        self.stale_wait = stale_wait
+        self.lock = threading.Lock()
+        self.refreshing = threading.Lock()
+        self.generation = 0
+        self.vms = []
+        self.index = {}
+        self.states = {}
+        self.digests = {}
+        self.configs = {}
+        self.listeners = []
+        self.loaded = False
+        self.timestamp = 0
+        self.fetched = 0
+
+    def age(self):
+        """
+            Seconds elapsed since the last refresh of the snapshot
+        """
+        if not self.timestamp:
+            return None
+        return time.monotonic() - self.timestamp
+
+    def is_fresh(self):
+        age = self.age()
+        return age is not None and age < self.ttl
+
+    def _load(self, api):
+        generation = self.generation
+        return self.replace(api.cluster.resources.get(type='vm'), generation)
+
+    def replace(self, vms, generation):
+        """
+            Function to store cluster resources fetched while the inventory was at generation.
+            The lock is only held to swap the snapshot, never across a Proxmox request.
+        """
+        with self.lock:
+            notification = self.store(vms)
+            if generation != self.generation:
+                # Invalidated while fetching, the resources may predate the change
+                self.timestamp = 0
+        self.notify(notification)
+        return vms
+
+    def store(self, vms):
+        """
+            Function to replace the snapshot with freshly fetched cluster resources.
+            Must be called with the lock held, returns what notify must send once it is released.
+        """
+        index = {}
+        states = {}
+        for vm in vms:
+            if 'vmid' in vm:
+                index[str(vm['vmid'])] = vm
+                states[str(vm['vmid'])] = { key: vm.get(key) for key in STATE_FIELDS }
+        previous = self.states
+        self.vms = vms
+        self.index = index
+        self.states = states
+        self.timestamp = self.fetched = time.monotonic()
+        notification = (list(self.listeners), previous, states) if self.loaded else None
+        self.loaded = True
+        return notification
+
+    def notify(self, notification):
+        """
+            Function to call the listeners of a refresh, without the lock held: they publish events and may read the inventory
+        """
+        if notification is None:
+            return
+        listeners, previous, states = notification
+        for listener in listeners:
+            listener(previous, states)
+
+    def listen(self, listener):
+        """
+            Function to call listener(previous, states) with the VM state tables after every refresh
+        """
+        with self.lock:
+            self.listeners.append(listener)
+
+    def refresh(self, api):
+        """
+            Function to fetch the cluster resources and rebuild the vmid index
+        """
+        with self.refreshing:
+            return self._load(api)
+
+    def snapshot(self, api):
+        """
+            Function to get the cluster VM resources, refreshing them when expired.
+            The last ones are served stale when the refresh fails or is still running after stale_wait.
+        """
+        if self.is_fresh():
+            return self.vms
+        if not self.refreshing.acquire(timeout=self.stale_wait if self.loaded else -1):
+            return self.serve_stale(UpstreamUnavailable(f"Inventory refresh still running after {self.stale_wait}s"))
+        try:
+            if self.is_fresh():
+                return self.vms
+            return self._load(api)
+        except UpstreamUnavailable as e:
+            return self.serve_stale(e)
+        finally:
+            self.refreshing.release()
+
+    def serve_stale(self, error):
+        """
+            Function to get the last snapshot when it can not be refreshed, marking the request stale.
+            Raises the error when there is no snapshot younger than max_stale.
+        """
+        if not self.loaded or time.monotonic() - self.fetched > self.max_stale:
+            raise error
+        mark_stale("inventory", time.monotonic() - self.fetched)
+        return self.vms
+
+    def lookup(self, api, vmid):
+        """
+            Function to get the resource record of a VM, None if it does not exist
+        """
+        self.snapshot(api)
+        return self.index.get(str(vmid))
+
+    def node(self, api, vmid):
+        """
+            Function to get the node hosting a VM, None if it does not exist
+        """
+        vm = self.lookup(api, vmid)
+        return vm["node"] if vm else None
+
+    def state(self, vmid):
+        """
+            Function to get the state of a VM from the last snapshot, None if it does not exist
+        """
+        return self.states.get(str(vmid))
+
+    def remember_digest(self, vmid, digest):
+        """
+            Function to keep the config digest of a VM seen during the current snapshot
+        """
+        self.digests[str(vmid)] = (self.timestamp, digest)
+
+    def remember_config(self, vmid, config):
+        """
+            Function to keep the last fetched config of a VM, and its digest for the current snapshot.
+            Like the snapshot, they are only served to the clients of the scope of the inventory.
+        """
+        self.configs[str(vmid)] = (time.monotonic(), config)
+        self.remember_digest(vmid, config.get('digest', ''))
+
+    def stale_config(self, vmid, error):
+        """
+            Function to get the last fetched config of a VM when it can not be fetched, marking the request stale.
+            Raises the error when there is no config younger than max_stale.
+        """
+        fetched, config = self.configs.get(str(vmid), (0, None))
+        if config is None or time.monotonic() - fetched > self.max_stale:
+            raise error
+        mark_stale("config", time.monotonic() - fetched)
+        return config
+
+    def digest(self, vmid):
+        """
+            Function to get the config digest of a VM while the snapshot it was seen in is fresh
+        """
+        timestamp, digest = self.digests.get(str(vmid), (0, None))
+        if timestamp != self.timestamp or not self.is_fresh():
+            return None
+        return digest
+
+    def invalidate(self):
+        """
+            Function to expire the snapshot after a change made through Proxmox, and the snapshots of the other scopes
+        """
+        self.expire()
+        if self.on_invalidate:
+            self.on_invalidate(self)
+
+    def expire(self):
+        with self.lock:
+            self.generation += 1
+            self.timestamp = 0
+            self.digests = {}
+
+class ScopedCaches:
+    """
+        Class to keep an inventory and an ISO catalog per Proxmox scope, the user@host:port of the clients.
+        Proxmox answers every user with what its permissions let it see, so a scope never reads the caches of another.
+    """
+    def __init__(self, inventory=None, isos=None):
+        self.inventory_options = inventory or {}
+        self.iso_options = isos or {}
+        self.lock = threading.Lock()
+        self.inventories = {}
+        self.catalogs = {}
+        self.listeners = []
+
+    def get(self, scope):
+        """
+            Function to get the inventory and the ISO catalog of a scope, created on its first use
+        """
+        with self.lock:
+            if scope not in self.inventories:
+                inventory = Inventory(scope=scope, on_invalidate=self.invalidate, **self.inventory_options)
+                for listener in self.listeners:
+                    inventory.listen(partial(listener, scope=scope))
+                self.inventories[scope] = inventory
+                self.catalogs[scope] = IsoCatalog(**self.iso_options)
+            return self.inventories[scope], self.catalogs[scope]
+
+    def listen(self, listener):
+        """
+            Function to call listener(previous, states, scope=scope) after every refresh of the inventory of any scope
+        """
+        with self.lock:
+            self.listeners.append(listener)
+            for scope, inventory in self.inventories.items():
+                inventory.listen(partial(listener, scope=scope))
+
+    def invalidate(self, source=None):
+        """
+            Function to expire the inventories of every scope but source, a change seen by one user is seen by all
+        """
+        with self.lock:
+            inventories = list(self.inventories.values())
+        for inventory in inventories:
+            if inventory is not source:
+                inventory.expire()
+
+    def scopes(self):
+        with self.lock:
+            return list(self.inventories.keys())
+
+class InventoryPoller:
+    """
+        Class to refresh the inventories in the background so requests read VM states from memory.
+        The clients function returns a Proxmox client of every scope to refresh the inventory of:
+        each scope is polled with the permissions of its own user, so what a user sees never
+        depends on which user logged in last.
+    """
+    def __init__(self, clients, interval=2):
+        self.clients = clients
+        self.interval = interval
+        self.inventories = {}
+        self.polls = 0
+        self.failures = 0
+        self.last_error = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def poll(self):
+        """
+            Function to refresh the inventory of every scope once, returns the number of inventories refreshed
+        """
+        clients = self.clients()
+        self.inventories = { client.scope: client.inventory for client in clients }
+        refreshed = 0
+        for client in clients:
+            try:
+                client.inventory.refresh(client.api)
+            except Exception as e:
+                self.failures += 1
+                self.last_error = f"{client.scope}: {e}"
+                continue
+            refreshed += 1
+        self.polls += refreshed
+        if refreshed == len(clients):
+            self.last_error = None
+        return refreshed
+
+    def start(self):
+        if self.thread or not self.interval:
+            return
+        self.stopped.clear()
+        def loop():
+            while not self.stopped.is_set():
+                self.poll()
+                self.stopped.wait(self.interval)
+        self.thread = threading.Thread(target=loop, name="redmox-inventory", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join(timeout=self.interval + 1)
+            self.thread = None
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def status(self, scope=None):
+        """
+            Function to describe the poller and the staleness of the state table of a scope
+        """
+        inventory = self.inventories.get(scope)
+        age = inventory.age() if inventory else None
+        return {
+            "running": self.running(),
+            "interval": self.interval,
+            "scopes": len(self.inventories),
+            "polled": inventory is not None,
+            "age": round(age, 3) if age is not None else None,
+            "polls": self.polls,
+            "failures": self.failures,
+            "vms": len(inventory.states) if inventory else 0
+        }
+
+class IsoCatalog:
+    """
+        Class to keep the ISO images available on every node storage.
+        While the Proxmox API is unavailable, the last listings are served for up to max_stale seconds.
+    """
+    def __init__(self, ttl=60, max_stale=3600):
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.lock = threading.Lock()
+        self.nodes = (0, [])
+        self.storages = {}
+        self.entries = {}
+        self.index = {}
+
+    def _expired(self, timestamp):
+        return not timestamp or time.monotonic() - timestamp >= self.ttl
+
+    def serve_stale(self, timestamp, value, error):
+        """
+            Function to get a listing fetched at timestamp when it can not be refreshed, marking the request stale.
+            Raises the error when the listing was never fetched or is older than max_stale.
+        """
+        if not timestamp or time.monotonic() - timestamp > self.max_stale:
+            raise error
+        mark_stale("isos", time.monotonic() - timestamp)
+        return value
+
+    def node_list(self, api):
+        """
+            Function to get the names of the cluster nodes
+        """
+        timestamp, nodes = self.nodes
+        if self._expired(timestamp):
+            try:
+                nodes = self.store_nodes(api.nodes.get())
+            except UpstreamUnavailable as e:
+                nodes = self.serve_stale(timestamp, nodes, e)
+        return nodes
+
+    def nodes_expired(self):
+        return self._expired(self.nodes[0])
+
+    def store_nodes(self, nodes):
+        nodes = [ node["node"] for node in nodes ]
+        self.nodes = (time.monotonic(), nodes)
+        return nodes
+
+    def storage_list(self, api, node):
+        """
+            Function to get the names of the storages attached to a node
+        """
+        if self.storages_expired(node):
+            try:
+                return self.store_storages(node, api.nodes(node).storage.get())
+            except UpstreamUnavailable as e:
+                return self.serve_stale(*self.storages.get(node, (0, [])), e)
+        return self.storages[node][1]
+
+    def storages_expired(self, node):
+        return self._expired(self.storages.get(node, (0, []))[0])
+
+    def store_storages(self, node, storages):
+        storages = [ stg["storage"] for stg in storages ]
+        self.storages[node] = (time.monotonic(), storages)
+        return storages
+
+    def load_storage(self, api, node, storage):
+        """
+            Function to fetch the ISO images of a storage into the catalog
+        """
+        try:
+            return self.store_storage(node, storage, api.nodes(node).storage(storage).content.get(content="iso"))
+        except UpstreamUnavailable as e:
+            return self.serve_stale(*self.entries.get((node, storage), (0, {})), e)
+
+    def store_storage(self, node, storage, contents):
+        """
+            Function to keep the fetched ISO contents of a storage
+        """
+        isos = {}
+        for content in contents:
+            isos[content["volid"].split("/")[-1]] = content["volid"]
+        with self.lock:
+            self.entries[(node, storage)] = (time.monotonic(), isos)
+            self.index.pop(node, None)
+        return isos
+
+    def is_expired(self, node, storage):
+        return self._expired(self.entries.get((node, storage), (0, {}))[0])
+
+    def node_isos(self, api, node, fetch=True):
+        """
+            Function to get the name->volid index of the ISO images reachable from a node.
+            With fetch disabled, expired storages are served from what is already cached.
+        """
+        if fetch:
+            storages = self.storage_list(api, node)
+        else:
+            storages = self.storages.get(node, (0, []))[1]
+        for storage in storages:
+            if fetch and self.is_expired(node, storage):
+                self.load_storage(api, node, storage)
+        with self.lock:
+            index = self.index.get(node)
+            if index is None:
+                index = {}
+                for storage in storages:
+                    index.update(self.entries.get((node, storage), (0, {}))[1])
+                self.index[node] = index
+        return index
+
+    def find(self, api, node, name):
+        """
+            Function to get the volid of an ISO image on a node, None if it does not exist
+        """
+        return self.node_isos(api, node).get(name)
+
+    def drop(self, node, storage=None):
+        """
+            Function to forget the ISO images of a node storage, or of every storage of the node
+        """
+        with self.lock:
+            for key in list(self.entries.keys()):
+                if key[0] == node and storage in [None, key[1]]:
+                    self.entries.pop(key)
+            if storage is None:
+                self.storages.pop(node, None)
+            self.index.pop(node, None)
@@ -77,3 +77,13 @@ def set_logger(name, logfile=None, debug=False):
         main_logger.addHandler(stream_handler)
 
     return main_logger
+
+def private_sqlite(path):
+    """
+    Function to create a SQLite database file and its WAL and shared memory files readable by the owner only.
+    SQLite creates the -wal and -shm files with the mode of the database, so they must exist at 0600 before it is opened.
+    """
+    for name in [ path, f"{path}-wal", f"{path}-shm" ]:
+        os.close(os.open(name, os.O_CREAT | os.O_WRONLY, 0o600))
+        os.chmod(name, 0o600)
+    return path
@@ -0,0 +1,311 @@
+"""
+    Module providing the Redfish Event Service fed by the inventory snapshots
+"""
+
+#!/usr/bin/env python3
+import json
+import queue
+import sqlite3
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from libs.tasks import timestamp
+from libs.common import private_sqlite
+
+POWER_STATES = { "running": "On", "stopped": "Off", "paused": "Paused" }
+
+def power_state(status):
+    return POWER_STATES.get(status, "Unknown")
+
+def visible(event, scope):
+    """
+        Function to tell if an event is shown to the clients of a Proxmox scope, the one whose inventory it comes from
+    """
+    return event["scope"] is None or event["scope"] == scope
+
+class Subscriber:
+    """
+        Class to buffer the events of a Server-Sent Events client
+    """
+    def __init__(self, size=256, scope=None):
+        self.events = queue.Queue(maxsize=size)
+        self.scope = scope
+        self.dropped = 0
+
+    def push(self, event):
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def next(self, timeout):
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+class SQLiteSubscriptionStore:
+    """
+        Class to keep the webhook subscriptions in a SQLite file shared by every Redmox process on the host
+    """
+    def __init__(self, path="redmox-events.db"):
+        self.path = path
+        self.local = threading.local()
+        private_sqlite(self.path)
+        with self.db() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS subscriptions ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, destination TEXT, context TEXT, failures INTEGER, scope TEXT)"
+            )
+
+    def db(self):
+        """
+            Function to get the SQLite connection of the current thread
+        """
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return db
+
+    def row(self, row):
+        return { "id": str(row[0]), "destination": row[1], "context": row[2], "failures": row[3], "scope": row[4] }
+
+    def add(self, destination, context="", scope=None):
+        with self.db() as db:
+            id = db.execute(
+                "INSERT INTO subscriptions (destination, context, failures, scope) VALUES (?, ?, 0, ?)", (destination, context, scope)
+            ).lastrowid
+        return { "id": str(id), "destination": destination, "context": context, "failures": 0, "scope": scope }
+
+    def get(self, id):
+        if not id.isdigit():
+            return None
+        row = self.db().execute("SELECT id, destination, context, failures, scope FROM subscriptions WHERE id = ?", (int(id),)).fetchone()
+        return self.row(row) if row else None
+
+    def delete(self, id):
+        if not id.isdigit():
+            return False
+        with self.db() as db:
+            return db.execute("DELETE FROM subscriptions WHERE id = ?", (int(id),)).rowcount > 0
+
+    def list(self):
+        rows = self.db().execute("SELECT id, destination, context, failures, scope FROM subscriptions ORDER BY id").fetchall()
+        return [ self.row(row) for row in rows ]
+
+    def set_failures(self, id, failures):
+        with self.db() as db:
+            db.execute("UPDATE subscriptions SET failures = ? WHERE id = ?", (failures, int(id)))
+
+class EventService:
+    """
+        Class to turn the differences between inventory snapshots into Redfish events,
+        streamed to Server-Sent Events clients and posted to webhook subscriptions.
+        The events of the inventory of a Proxmox scope only reach the clients and subscriptions of that scope.
+        With a store, the subscriptions are shared with the other processes using it, and
+        only the process created with webhooks enabled posts the events to them.
+    """
+    def __init__(self, queue_size=256, history=256, webhook_timeout=5, workers=2, max_subscribers=2, store=None, webhooks=True):
+        self.queue_size = queue_size
+        self.max_subscribers = max_subscribers
+        self.store = store
+        self.webhooks = webhooks
+        self.webhook_timeout = webhook_timeout
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.subscription_ids = itertools.count(1)
+        self.history = deque(maxlen=history)
+        self.subscribers = set()
+        self.subscriptions = {}
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="redmox-webhook")
+        self.stopped = threading.Event()
+
+    def diff(self, old, new):
+        """
+            Function to get the events between two VM state tables
+        """
+        records = []
+        for vmid, state in new.items():
+            origin = f"/redfish/v1/Systems/{vmid}"
+            before = old.get(vmid)
+            if before is None:
+                records.append(("ResourceEvent.1.3.ResourceCreated", f"System {vmid} was created", origin))
+                continue
+            if before.get("status") != state.get("status"):
+                records.append((
+                    "ResourceEvent.1.3.ResourceChanged",
+                    f"The power state of System {vmid} changed from "
+                    f"{power_state(before.get('status'))} to {power_state(state.get('status'))}",
+                    origin
+                ))
+        for vmid in old:
+            if vmid not in new:
+                records.append(("ResourceEvent.1.3.ResourceRemoved", f"System {vmid} was removed", f"/redfish/v1/Systems/{vmid}"))
+        return records
+
+    def on_refresh(self, old, new, scope=None):
+        """
+            Function called by the inventory of a scope with the previous and the new state tables
+        """
+        records = self.diff(old, new)
+        if records:
+            self.publish(records, scope)
+
+    def publish(self, records, scope=None):
+        """
+            Function to send a list of (message id, message, origin) records as one event to the clients of a scope,
+            to every client without a scope
+        """
+        with self.lock:
+            id = str(next(self.ids))
+            now = timestamp()
+            event = {
+                "id": id,
+                "scope": scope,
+                "records": [
+                    {
+                        "EventId": f"{id}.{i}",
+                        "EventTimestamp": now,
+                        "MessageId": message_id,
+                        "Message": message,
+                        "OriginOfCondition": { "@odata.id": origin }
+                    }
+                    for i, (message_id, message, origin) in enumerate(records)
+                ]
+            }
+            self.history.append(event)
+            subscribers = [ subscriber for subscriber in self.subscribers if visible(event, subscriber.scope) ]
+        for subscriber in subscribers:
+            subscriber.push(event)
+        if self.webhooks:
+            for subscription in self.list_subscriptions():
+                if visible(event, subscription["scope"]):
+                    self.executor.submit(self.deliver, subscription, event)
+        return event
+
+    def since(self, last_id, scope=None):
+        """
+            Function to get the buffered events of a scope newer than an event id, for reconnecting clients
+        """
+        with self.lock:
+            return [ event for event in self.history if int(event["id"]) > int(last_id) and visible(event, scope) ]
+
+    def subscribe(self, scope=None):
+        """
+            Function to add a Server-Sent Events client of a scope, None when max_subscribers are already streaming
+        """
+        subscriber = Subscriber(self.queue_size, scope)
+        with self.lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                return None
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def add_subscription(self, destination, context="", scope=None):
+        if self.store:
+            return self.store.add(destination, context, scope)
+        with self.lock:
+            subscription = {
+                "id": str(next(self.subscription_ids)),
+                "destination": destination,
+                "context": context,
+                "failures": 0,
+                "scope": scope
+            }
+            self.subscriptions[subscription["id"]] = subscription
+        return subscription
+
+    def get_subscription(self, id, scope=None):
+        """
+            Function to get a subscription made from a scope, None when it does not exist or belongs to another scope
+        """
+        if self.store:
+            subscription = self.store.get(id)
+        else:
+            subscription = self.subscriptions.get(id)
+        if subscription is None or subscription["scope"] != scope:
+            return None
+        return subscription
+
+    def delete_subscription(self, id):
+        if self.store:
+            return self.store.delete(id)
+        with self.lock:
+            return self.subscriptions.pop(id, None) is not None
+
+    def list_subscriptions(self, scope=None):
+        """
+            Function to get the subscriptions made from a scope, every subscription without a scope
+        """
+        if self.store:
+            subscriptions = self.store.list()
+        else:
+            with self.lock:
+                subscriptions = list(self.subscriptions.values())
+        if scope is None:
+            return subscriptions
+        return [ subscription for subscription in subscriptions if subscription["scope"] == scope ]
+
+    def deliver(self, subscription, event):
+        """
+            Function to post an event to a webhook subscription
+        """
+        try:
+            response = requests.post(
+                subscription["destination"],
+                json=self.payload(event, subscription["context"]),
+                timeout=self.webhook_timeout
+            )
+            response.raise_for_status()
+            failures = 0
+        except Exception:
+            failures = subscription["failures"] + 1
+        subscription["failures"] = failures
+        if self.store:
+            self.store.set_failures(subscription["id"], failures)
+
+    def payload(self, event, context=""):
+        return {
+            "@odata.type": "#Event.v1_7_0.Event",
+            "Id": event["id"],
+            "Name": "Redmox Event",
+            "Context": context,
+            "Events": event["records"]
+        }
+
+    def stream(self, subscriber, last_id=None, keepalive=15):
+        """
+            Function to generate the Server-Sent Events of a subscriber, starting with the
+            buffered events newer than last_id, and a comment line when idle to keep the
+            connection open. The subscriber is removed when the client goes away.
+        """
+        try:
+            yield ": connected\n\n"
+            sent = 0
+            if last_id is not None:
+                for event in self.since(last_id, subscriber.scope):
+                    sent = int(event["id"])
+                    yield f"id: {event['id']}\ndata: {json.dumps(self.payload(event))}\n\n"
+            while not self.stopped.is_set():
+                event = subscriber.next(keepalive)
+                if event is None:
+                    yield ": keepalive\n\n"
+                    continue
+                if int(event["id"]) <= sent:
+                    continue
+                yield f"id: {event['id']}\ndata: {json.dumps(self.payload(event))}\n\n"
+        finally:
+            self.unsubscribe(subscriber)
+
+    def shutdown(self):
+        self.stopped.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
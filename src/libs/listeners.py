@@ -0,0 +1,70 @@
+"""
+    Module providing the virtual BMC listeners of the multi mode
+"""
+
+#!/usr/bin/env python3
+import threading
+from collections import Counter
+
+def parse_listener(line):
+    """
+        Function to expand a "host:port vmid" or "host:first-last vmid" entry into
+        (host, port, vmid) listeners, each port of a range getting the next vmid
+    """
+    fields = str(line).split()
+    if len(fields) != 2:
+        raise ValueError(f"Invalid listener '{line}': expected host:port and a vmid")
+    address, vmid = fields
+    host, sep, ports = address.rpartition(":")
+    if not sep or not host:
+        raise ValueError(f"Invalid listener '{line}': expected host:port")
+    first, _, last = ports.partition("-")
+    first = int(first)
+    last = int(last) if last else first
+    if last < first or not 0 < first <= 65535 or last > 65535:
+        raise ValueError(f"Invalid listener '{line}': bad port range")
+    vmid = int(vmid)
+    return [ (host, port, str(vmid + port - first)) for port in range(first, last + 1) ]
+
+class Listeners:
+    """
+        Class to keep the listeners of the multi mode, one port per virtual BMC,
+        and count the requests each of them received
+    """
+    def __init__(self, entries=None):
+        self.listeners = []
+        self.ports = {}
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        for entry in entries or []:
+            for host, port, vmid in parse_listener(entry):
+                if str(port) in self.ports and self.ports[str(port)] != vmid:
+                    raise ValueError(f"Port {port} is bound to VMs {self.ports[str(port)]} and {vmid}, use the BMC map for address based routing")
+                self.ports[str(port)] = vmid
+                self.listeners.append((host, port, vmid))
+
+    def listen(self):
+        """
+            Function to get the waitress listen argument for every listener
+        """
+        return " ".join([ f"[{host}]:{port}" if ":" in host else f"{host}:{port}" for host, port, vmid in self.listeners ])
+
+    def vmid(self, port):
+        """
+            Function to get the vmid of the listener a request came in through, None if it is not one
+        """
+        return self.ports.get(port)
+
+    def count(self, port):
+        if port in self.ports:
+            with self.lock:
+                self.requests[port] += 1
+
+    def status(self):
+        return [
+            { "host": host, "port": port, "vmid": vmid, "requests": self.requests[str(port)] }
+            for host, port, vmid in self.listeners
+        ]
+
+    def __len__(self):
+        return len(self.listeners)
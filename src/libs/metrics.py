@@ -0,0 +1,274 @@
+"""
+    Module providing the Prometheus metrics of Redmox
+"""
+
+#!/usr/bin/env python3
+import time
+import bisect
+import asyncio
+import functools
+import threading
+from urllib.parse import urlsplit
+from libs import tracing
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Path segments followed by an identifier, replaced by a placeholder to bound the label values
+PATH_IDS = {
+    "nodes": "{node}",
+    "qemu": "{vmid}",
+    "lxc": "{vmid}",
+    "storage": "{storage}",
+    "content": "{volume}",
+    "tasks": "{upid}"
+}
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def label_text(names, values, extra=""):
+    pairs = [ f'{name}="{escape(value)}"' for name, value in zip(names, values) ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+@functools.lru_cache(maxsize=1024)
+def upstream_path(url):
+    """
+        Function to get the path of a Proxmox API URL with its node, VM, storage,
+        volume and task identifiers replaced by placeholders
+    """
+    parts = urlsplit(url).path.split("/")
+    for i in range(len(parts) - 1, 0, -1):
+        if parts[i - 1] in PATH_IDS:
+            parts[i] = PATH_IDS[parts[i - 1]]
+    return "/".join(parts)
+
+class Metric:
+    """
+        Base class for the metrics, one value per combination of label values
+    """
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def samples(self):
+        with self.lock:
+            return [ (self.name, labels, value) for labels, value in self.values.items() ]
+
+    def render(self):
+        lines = [ f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}" ]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{label_text(self.labels, labels)} {number(value)}")
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, value=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, *labels, value=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + value
+
+    def dec(self, *labels, value=1):
+        self.inc(*labels, value=-value)
+
+    def set(self, *labels, value=0):
+        with self.lock:
+            self.values[labels] = value
+
+class GaugeFunc(Metric):
+    """
+        Class to report a gauge computed when the metrics are scraped
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help, func):
+        super().__init__(name, help)
+        self.func = func
+
+    def samples(self):
+        return [ (self.name, (), self.func()) ]
+
+class CounterFunc(GaugeFunc):
+    """
+        Class to report a counter kept elsewhere, read when the metrics are scraped
+    """
+    kind = "counter"
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [ [0] * (len(self.buckets) + 1), 0.0, 0 ]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = [ f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}" ]
+        with self.lock:
+            values = [ (labels, list(counts), total, count) for labels, (counts, total, count) in self.values.items() ]
+        for labels, counts, total, count in values:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket
+                le = 'le="' + number(bound) + '"'
+                lines.append(f"{self.name}_bucket{label_text(self.labels, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{label_text(self.labels, labels)} {number(total)}")
+            lines.append(f"{self.name}_count{label_text(self.labels, labels)} {count}")
+        return lines
+
+class Metrics:
+    """
+        Class to keep the metrics of a Redmox process and render them in the Prometheus text format
+    """
+    content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self.metrics = []
+        self.requests = self.add(Histogram(
+            "redmox_http_request_duration_seconds",
+            "Latency of the Redfish requests by endpoint, method and status",
+            ("endpoint", "method", "status")
+        ))
+        self.in_flight = self.add(Gauge(
+            "redmox_http_requests_in_flight",
+            "Redfish requests being served"
+        ))
+        self.auth = self.add(Counter(
+            "redmox_auth_total",
+            "Token checks of the Redfish requests by result",
+            ("result",)
+        ))
+        self.logins = self.add(Counter(
+            "redmox_logins_total",
+            "Redfish session creations by result",
+            ("result",)
+        ))
+        self.upstream = self.add(Histogram(
+            "redmox_upstream_request_duration_seconds",
+            "Latency of the Proxmox API requests by method, path and status",
+            ("method", "path", "status")
+        ))
+        self.calls = self.add(Histogram(
+            "redmox_proxmox_call_duration_seconds",
+            "Latency of the Proxmox client methods",
+            ("method",)
+        ))
+        self.call_errors = self.add(Counter(
+            "redmox_proxmox_call_errors_total",
+            "Proxmox client methods that raised an exception",
+            ("method",)
+        ))
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help, func):
+        """
+            Function to add a gauge computed by func when the metrics are scraped
+        """
+        return self.add(GaugeFunc(name, help, func))
+
+    def counter(self, name, help, func):
+        """
+            Function to add a counter read from func when the metrics are scraped
+        """
+        return self.add(CounterFunc(name, help, func))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+def observe_upstream(metrics, method, url, status, start):
+    """
+        Function to report a Proxmox API request in the metrics, when there are some, and in the request trace
+    """
+    elapsed = time.perf_counter() - start
+    path = upstream_path(url)
+    if metrics is not None:
+        metrics.upstream.observe(elapsed, method, path, status)
+    tracing.record("upstream", f"{method} {path}", start, elapsed)
+
+def instrument_session(session, metrics=None):
+    """
+        Function to time every request of a requests session, the one under a ProxmoxAPI client
+    """
+    send = session.request
+    def request(method, url, *args, **kwargs):
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = send(method, url, *args, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            observe_upstream(metrics, method, url, status, start)
+    session.request = request
+
+def observe_call(metrics, name, start, error):
+    elapsed = time.perf_counter() - start
+    if metrics is not None:
+        metrics.calls.observe(elapsed, name)
+        if error:
+            metrics.call_errors.inc(name)
+    tracing.record("pmox", name, start, elapsed)
+
+def observed(func):
+    """
+        Decorator to time a method of a client in the metrics of its metrics attribute and in the request trace
+    """
+    name = func.__name__
+    if asyncio.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(self, *args, **kwargs):
+            start = time.perf_counter()
+            error = True
+            try:
+                result = await func(self, *args, **kwargs)
+                error = False
+                return result
+            finally:
+                observe_call(self.metrics, name, start, error)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        start = time.perf_counter()
+        error = True
+        try:
+            result = func(self, *args, **kwargs)
+            error = False
+            return result
+        finally:
+            observe_call(self.metrics, name, start, error)
+    return wrapper
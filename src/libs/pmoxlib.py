@@ -3,195 +3,490 @@
 """
 
 #!/usr/bin/env python3
+import time
+import logging
+import threading
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from requests.adapters import HTTPAdapter
 from proxmoxer import ProxmoxAPI, ResourceException
+from libs.cache import Inventory, IsoCatalog
+from libs.breaker import UpstreamUnavailable
+from libs.vmmodel import VM
+from libs.metrics import observed, instrument_session
+from libs import tracing
+
+logger = logging.getLogger("RedmoxAPI")
+
+class FanOut:
+    """
+        Class to run independent Proxmox API calls in a bounded thread pool
+    """
+    def __init__(self, workers=8, deadline=10):
+        self.workers = workers
+        self.deadline = deadline
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="redmox-fanout")
+
+    def run(self, calls, deadline=None):
+        """
+            Function to run a dict of source -> (function, *args) calls in parallel.
+            Returns the results and the errors, both keyed by source; a call that
+            runs longer than the deadline is reported as an error and not awaited.
+        """
+        deadline = deadline or self.deadline
+        results = {}
+        errors = {}
+        started = {}
+
+        def timed(source, func, *args):
+            started[source] = time.monotonic()
+            return func(*args)
+
+        pending = {}
+        for source, call in calls.items():
+            # A context copy per call carries the request trace into the worker thread
+            pending[self.executor.submit(contextvars.copy_context().run, timed, source, *call)] = source
+        while pending:
+            done, _ = wait(pending, timeout=min(deadline, 0.5), return_when=FIRST_COMPLETED)
+            for future in done:
+                source = pending.pop(future)
+                try:
+                    results[source] = future.result()
+                except Exception as e:
+                    errors[source] = str(e)
+            now = time.monotonic()
+            for future, source in list(pending.items()):
+                if source in started and now - started[source] > deadline:
+                    pending.pop(future)
+                    errors[source] = f"Deadline of {deadline}s exceeded"
+        return results, errors
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+class Flight:
+    """
+        Class to keep the outcome of an upstream call the identical calls are waiting for
+    """
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """
+        Class to share one upstream GET between the identical GETs running at the same time.
+        The calls are identical when they come from the same Proxmox user for the same URL and parameters.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, func, *args, **kwargs):
+        """
+            Function to run func, or to wait for the run of an identical call already in flight and get its outcome
+        """
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = self.flights[key] = Flight()
+                self.calls += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = func(*args, **kwargs)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                self.flights.pop(key, None)
+            flight.done.set()
+
+    def share(self, session, scope):
+        """
+            Function to route the GETs of a requests session through the single flight, the one under a ProxmoxAPI client
+        """
+        send = session.request
+        def request(method, url, *args, **kwargs):
+            if method != "GET":
+                return send(method, url, *args, **kwargs)
+            params = kwargs.get("params")
+            key = (scope, url, tuple(sorted(params.items())) if params else ())
+            return self.do(key, send, method, url, *args, **kwargs)
+        session.request = request
+
+    def status(self):
+        with self.lock:
+            return { "calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self.flights) }
+
+class DeferredAPI:
+    """
+        Class to stand for a ProxmoxAPI client that logs in on its first use.
+        The reads answered from the inventory and the ISO catalog never use it, so they can be served while Proxmox is unavailable.
+    """
+    def __init__(self, connect):
+        self._connect = connect
+        self._lock = threading.Lock()
+        self._api = None
+
+    def _get(self):
+        if self._api is None:
+            with self._lock:
+                if self._api is None:
+                    self._api = self._connect()
+        return self._api
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._get()(*args, **kwargs)
+
+class ClientPool:
+    """
+        Class to keep logged in Proxmox clients, one per session token
+    """
+    def __init__(self, host, port=8006, size=32, idle_timeout=1800, **shared):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.shared = shared
+        self.name = None
+        self.lock = threading.Lock()
+        self.clients = OrderedDict()
+
+    def _store(self, key, client):
+        with self.lock:
+            if key in self.clients:
+                return self.clients[key][0]
+            self.clients[key] = (client, time.monotonic())
+            while len(self.clients) > self.size:
+                self.clients.popitem(last=False)
+        return client
+
+    def login(self, user, password, defer=False):
+        """
+            Function to open a new Proxmox client, reusing the cached cluster version.
+            With defer, the client of an authenticated session logs in on its first Proxmox call.
+        """
+        with tracing.span("login", user):
+            client = Proxmox(
+                host=self.host,
+                port=self.port,
+                user=user,
+                password=password,
+                name=self.name,
+                defer=defer,
+                **self.shared
+            )
+        self.name = client.name
+        return client
+
+    def put(self, key, client):
+        return self._store(key, client)
+
+    def get(self, key, user, password):
+        """
+            Function to get the client of a session, logging in again only when it is not pooled and on its first Proxmox call
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.evict_idle(now)
+            if key in self.clients:
+                client = self.clients[key][0]
+                self.clients[key] = (client, now)
+                self.clients.move_to_end(key)
+                return client
+        return self._store(key, self.login(user, password, defer=True))
+
+    def evict_idle(self, now=None):
+        """
+            Function to drop the least recently used clients idle for longer than the timeout.
+            Must be called with the lock held.
+        """
+        now = now or time.monotonic()
+        while self.clients:
+            key, (client, last_used) = next(iter(self.clients.items()))
+            if now - last_used < self.idle_timeout:
+                break
+            self.clients.popitem(last=False)
+
+    def recent(self):
+        """
+            Function to get the most recently used client, None when the pool is empty
+        """
+        with self.lock:
+            if not self.clients:
+                return None
+            return next(reversed(self.clients.values()))[0]
+
+    def active(self):
+        """
+            Function to get the most recently used client of every scope in the pool
+        """
+        with self.lock:
+            return list({ client.scope: client for client, last_used in self.clients.values() }.values())
+
+    def discard(self, key):
+        with self.lock:
+            self.clients.pop(key, None)
+
+    def __len__(self):
+        return len(self.clients)
 
 class Proxmox:
     """
         Class to manage Proxmox API
     """
-    def __init__(self, host, user, password, port=8006):
+    def __init__(self, host, user, password, port=8006, inventory=None, isos=None, fanout=None, name=None, connections=10, metrics=None, flights=None, breaker=None, timeout=5, defer=False, caches=None):
         self.host = host
         self.user = user
         self.password = password
         self.port = port
-        self.api = ProxmoxAPI(host, user=user, password=password, port=port, verify_ssl=False)
-        self.name = "Proxmox VE "+self.api.version.get().get('version', 'Unknown')
+        # What a Proxmox user sees depends on its permissions, the caches and the shared GETs are kept per scope
+        self.scope = f"{user}@{host}:{port}"
+        if caches is not None:
+            inventory, isos = caches.get(self.scope)
+        self.inventory = inventory if inventory is not None else Inventory(scope=self.scope)
+        self.isos = isos if isos is not None else IsoCatalog()
+        self.fanout = fanout if fanout is not None else FanOut()
+        self.metrics = metrics
+        self.connections = connections
+        self.flights = flights
+        self.breaker = breaker
+        self.timeout = timeout
+        # The cluster name is fetched with the login, only a known one lets it wait for the first call
+        if defer and name is not None:
+            self.api = DeferredAPI(self.connect)
+        else:
+            self.api = self.connect()
+        if name is None:
+            name = "Proxmox VE "+self.api.version.get().get('version', 'Unknown')
+        self.name = name
+
+    def connect(self):
+        """
+            Function to log in to the Proxmox API, returns the client with its requests session set up
+        """
+        if self.breaker is not None:
+            api = self.breaker.call(ProxmoxAPI, self.host, user=self.user, password=self.password, port=self.port, verify_ssl=False, timeout=self.timeout)
+        else:
+            api = ProxmoxAPI(self.host, user=self.user, password=self.password, port=self.port, verify_ssl=False, timeout=self.timeout)
+        # Keep enough idle connections alive for the fan-out workers sharing this client
+        api._store["session"].mount("https://", HTTPAdapter(pool_maxsize=max(self.connections, self.fanout.workers)))
+        instrument_session(api._store["session"], self.metrics)
+        if self.breaker is not None:
+            self.breaker.guard(api._store["session"])
+        if self.flights is not None:
+            self.flights.share(api._store["session"], self.scope)
+        return api
+
+    def tokens(self):
+        """
+            Function to get the current Proxmox ticket and CSRF token of the client, None before it logs in
+        """
+        api = self.api._api if isinstance(self.api, DeferredAPI) else self.api
+        return api.get_tokens() if api is not None else None
 
-    def list_isos(self):
-        nodes = self.api.nodes.get()
+    @observed
+    def find_vm(self, vmid):
+        """
+            Function to get the cluster resource record of a VM from the inventory snapshot
+        """
+        return self.inventory.lookup(self.api, vmid)
+
+    @observed
+    def vm_state(self, vmid):
+        """
+            Function to get the status, uptime, cpu and memory usage of a VM from the inventory state table
+        """
+        self.inventory.snapshot(self.api)
+        return self.inventory.state(vmid)
+
+    def fan_out(self, calls, errors=None):
+        """
+            Function to run independent calls in parallel, merging the
+            per-source errors into the given dict
+        """
+        results, failed = self.fanout.run(calls)
+        if errors is not None:
+            errors.update(failed)
+        return results
+
+    @observed
+    def refresh_isos(self, nodes, errors=None):
+        """
+            Function to reload in parallel the expired ISO catalog entries of the nodes
+        """
+        storages = self.fan_out(
+            { node: (self.isos.storage_list, self.api, node) for node in nodes },
+            errors
+        )
+        calls = {}
+        for node, names in storages.items():
+            for storage in names:
+                if self.isos.is_expired(node, storage):
+                    calls[f"{node}/{storage}"] = (self.isos.load_storage, self.api, node, storage)
+        self.fan_out(calls, errors)
+
+    @observed
+    def list_isos(self, errors=None):
+        nodes = self.isos.node_list(self.api)
+        self.refresh_isos(nodes, errors)
+        isos = []
         for node in nodes:
-            stgs = self.api.nodes(node["node"]).storage.get()
-            isos = []
-            for stg in stgs:
-                content = self.api.nodes(node["node"]).storage(stg["storage"]).content.get(content="iso")
-                for iso in content:
-                    iso_arr = iso["volid"].split(":")
-                    path = f'{node["node"]}/{iso_arr[0]}/{iso_arr[1]}'
-                    isos.append(path)
+            for volid in self.isos.node_isos(self.api, node, fetch=False).values():
+                iso_arr = volid.split(":")
+                isos.append(f'{node}/{iso_arr[0]}/{iso_arr[1]}')
         return isos
 
-    def list_isos_vm(self, vmid):
-        vms = self.api.cluster.resources.get(type='vm')
-        vmstatus = ""
-        for vm in vms:
-            if 'vmid' in vm and str(vm['vmid']) == vmid:
-                vmstatus = vm
-                break
-        if vmstatus == "":
+    @observed
+    def list_isos_vm(self, vmid, errors=None):
+        vmstatus = self.find_vm(vmid)
+        if not vmstatus:
             return {
                 "error": True,
                 "message": "No VM found"
             }
+        self.refresh_isos([ vmstatus["node"] ], errors)
         isos = []
-        for stg in self.api.nodes(vmstatus["node"]).storage.get():
-            for iso in self.api.nodes(vmstatus["node"]).storage(stg["storage"]).content.get(content="iso"):
-                iso_arr = iso["volid"].split(":")
-                path = f'{vmstatus["node"]}/{iso_arr[0]}/{iso_arr[1]}'
-                isos.append(path)
-        
+        for volid in self.isos.node_isos(self.api, vmstatus["node"], fetch=False).values():
+            iso_arr = volid.split(":")
+            isos.append(f'{vmstatus["node"]}/{iso_arr[0]}/{iso_arr[1]}')
+
         return isos
 
+    @observed
+    def find_iso(self, name, vmid=None):
+        """
+            Function to get the path of an ISO by name, on the node of the VM when given
+        """
+        if vmid is None:
+            nodes = self.isos.node_list(self.api)
+        else:
+            vmstatus = self.find_vm(vmid)
+            nodes = [ vmstatus["node"] ] if vmstatus else []
+        self.refresh_isos(nodes)
+        for node in nodes:
+            volid = self.isos.node_isos(self.api, node, fetch=False).get(name)
+            if volid:
+                iso_arr = volid.split(":")
+                return f'{node}/{iso_arr[0]}/{iso_arr[1]}'
+        return None
+
+    @observed
     def get_vms_id(self):
         """
             Function to get the list of VMs
         """
-        vms = self.api.cluster.resources.get(type='vm')
+        vms = self.inventory.snapshot(self.api)
         vms_id = []
         for vm in vms:
             if 'vmid' in vm:
                 vms_id.append(vm['vmid'])
         return vms_id
     
+    @observed
+    def vm_etag(self, vmid, vm=None):
+        """
+            Function to get the entity tag of a VM from its config digest and power state.
+            Without the VM information, it is only known while the inventory snapshot is fresh.
+        """
+        if vm is None:
+            vmstatus = self.find_vm(vmid)
+            digest = self.inventory.digest(vmid)
+            if not vmstatus or not digest:
+                return None
+            vm = { "digest": digest, "status": vmstatus.get('status', 'Unknown') }
+        if not vm.get("digest"):
+            return None
+        return f'{vm["digest"]}-{vm.get("status", "Unknown")}'
+
+    @observed
+    def get_vm(self, vmid, config=True):
+        """
+            Function to get the VM model of a VM, None if it does not exist.
+            Without config, only the inventory record is used and no request is made.
+        """
+        vmstatus = self.find_vm(vmid)
+        if not vmstatus:
+            return None
+        if not config:
+            return VM(vmid, vmstatus, {})
+        return VM(vmid, vmstatus, self.vm_config(vmstatus['node'], vmid))
+
+    def vm_config(self, node, vmid):
+        """
+            Function to fetch the config of a VM, falling back to the last one fetched while the Proxmox API is unavailable
+        """
+        try:
+            vmconfig = self.api.nodes(node).qemu(vmid).config.get()
+        except UpstreamUnavailable as e:
+            return self.inventory.stale_config(vmid, e)
+        self.inventory.remember_config(vmid, vmconfig)
+        return vmconfig
+
+    @observed
+    def get_vms(self, vmids=None, errors=None, config=True):
+        """
+            Function to get the VM model of every VM, or of the given ones, from a single
+            inventory snapshot, fetching the configs in parallel. VMs whose config could
+            not be fetched are None.
+        """
+        wanted = None if vmids is None else set([ str(vmid) for vmid in vmids ])
+        records = {}
+        for vmstatus in self.inventory.snapshot(self.api):
+            if 'vmid' in vmstatus and (wanted is None or str(vmstatus['vmid']) in wanted):
+                records[str(vmstatus['vmid'])] = vmstatus
+        if not config:
+            return { vmid: VM(vmid, vmstatus, {}) for vmid, vmstatus in records.items() }
+        configs = self.fan_out(
+            { vmid: (self.vm_config, vmstatus['node'], vmid) for vmid, vmstatus in records.items() },
+            errors
+        )
+        vms = {}
+        for vmid, vmstatus in records.items():
+            vmconfig = configs.get(vmid)
+            vms[vmid] = VM(vmid, vmstatus, vmconfig) if vmconfig is not None else None
+        return vms
+
+    @observed
     def get_vm_info(self, vmid):
         """
             Function to get the information of a VM
         """
-        vms = self.api.cluster.resources.get(type='vm')
-        vmstatus = ""
-        for vm in vms:
-            if 'vmid' in vm and str(vm['vmid']) == vmid:
-                vmstatus = vm
-                break
-        if vmstatus == "":
+        vm = self.get_vm(vmid)
+        if vm is None:
             return {
                 "error": True,
                 "message": "No VM found"
             }
-        vmconfig = self.api.nodes(vmstatus['node']).qemu(vmid).config.get()
-        json_out = {
-            "id": vmstatus['vmid'],
-            "vmgenid": vmconfig.get('vmgenid', ''),
-            "name": vmstatus.get('name', 'Unknown'),
-            "status": vmstatus.get('status', 'Unknown'),
-            "node": vmstatus.get('node', 'Unknown'),
-            "type": vmstatus.get('type', 'Unknown'),
-            "tags": vmstatus.get('tags', []),
-            "uptime": vmstatus.get('uptime', 0),
-            "template": vmstatus.get('template', 0),
-            "digest": vmconfig.get('digest', ''),
-            "media": vmconfig.get('ide2', ''),
-            "boot": {
-                "order": vmconfig['boot'].replace('order=', '').split(';') if 'boot' in vmconfig else [],
-            },
-            "ostype": vmconfig.get('ostype', 'Unknown'),
-            "cpu": {
-                "usage": {
-                    "current": vmstatus.get('cpu', 0),
-                    "total": vmstatus.get('maxcpu', 0)
-                },
-                "cores": vmconfig.get('cores', 1),
-                "type": vmconfig.get('cpu', 'Unknown'),
-                "sockets": vmconfig.get('sockets', 1)
-            },
-            "memory": {
-                "usage": {
-                    "current": vmstatus.get('mem', 0),
-                    "total": vmstatus.get('maxmem', 0)
-                },
-                "assigned_mb": vmconfig.get('memory', 0),
-                "numa": vmconfig.get('numa', 0)
-            },
-            "disk": {
-                "usage": {
-                    "current": vmstatus.get('disk', 0),
-                    "read": vmstatus.get('diskread', 0),
-                    "write": vmstatus.get('diskwrite', 0),
-                    "total": vmstatus.get('maxdisk', 0)
-                },
-                "list": []
-            },
-            "network": {
-                "usage": {
-                    "in": vmstatus.get('netin', 0),
-                    "out": vmstatus.get('netout', 0)
-                }
-            }
-        }
-        for key, value in vmconfig.items():
-            if isinstance(value, str) and "iso/" in value:
-                json_out["cdrom"] = { "mount": key }
-                arr_value = value.split(',')
-                iso_data = arr_value[0].split(':')
-                json_out["cdrom"]["datastore"] = iso_data[0]
-                json_out["cdrom"]["iso"] = iso_data[1].replace('iso/', '')
-                for item in arr_value:
-                    if "=" in item:
-                        arr_item = item.split('=')
-                        json_out["cdrom"][arr_item[0]] = arr_item[1]
-            if key == "meta":
-                json_out["meta"] = {}
-                for item in value.split(','):
-                    if "=" in item:
-                        arr_item = item.split('=')
-                        json_out["meta"][arr_item[0]] = arr_item[1]
-            if key.startswith("net"):
-                json_out["network"]["interfaces"] = []
-                arr_value = value.split(',')
-                interface = { "name": key }
-                for item in arr_value:
-                    if "=" in item:
-                        arr_item = item.split('=')
-                        interface[arr_item[0]] = arr_item[1]
-                json_out["network"]["interfaces"].append(interface)
-            if isinstance(value, str) and "iothread" in value:
-                disk = { 
-                    "device": key,
-                    "status": "mounted"
-                }
-                arr_value = value.split(',')
-                disk["datastore"] = arr_value[0].split(':')[0]
-                disk["name"] = arr_value[0].split(':')[1]
-                for item in arr_value:
-                    if "=" in item:
-                        arr_item = item.split('=')
-                        disk[arr_item[0]] = arr_item[1]
-                json_out["disk"]["list"].append(disk)
-            if "bios" in key:
-                json_out["bios"] = { "name": key }
-                arr_value = value.split(',')
-                for item in arr_value:
-                    if "=" in item:
-                        arr_item = item.split('=')
-                        json_out["bios"][arr_item[0]] = arr_item[1]
-            if "unused" in key:
-                disk = { 
-                    "device": key,
-                    "status": "unused"
-                }
-                arr_value = value.split(',')
-                disk["datastore"] = arr_value[0].split(':')[0]
-                disk["name"] = arr_value[0].split(':')[1]
-                json_out["disk"]["list"].append(disk)
-
-        return json_out
+        return vm.to_dict()
 
+    @observed
     def get_guest_info(self, vmid):
         try:
-            vms = self.api.cluster.resources.get(type='vm')
-            for vm in vms:
-                if 'vmid' in vm and str(vm['vmid']) == vmid:
-                    vmstatus = vm
-                    break
+            vmstatus = self.find_vm(vmid)
+            if not vmstatus:
+                return {
+                    "error": True,
+                    "message": "No VM found"
+                }
             result = self.api.nodes(vmstatus["node"]).qemu(vmid).agent.get("get-osinfo")
             vmosinfo = {
                 "pretty-name": result["result"].get('pretty-name', 'Unknown'),
@@ -211,14 +506,17 @@ class Proxmox:
 
         return json_out
     
+    @observed
     def run_poweron(self, vmid):
         try:
-            vms = self.api.cluster.resources.get(type='vm')
-            for vm in vms:
-                if 'vmid' in vm and str(vm['vmid']) == vmid:
-                    vmstatus = vm
-                    break
+            vmstatus = self.find_vm(vmid)
+            if not vmstatus:
+                return {
+                    "error": True,
+                    "message": "No VM found"
+                }
             result = self.api.nodes(vmstatus["node"]).qemu(vmid).status.start.post()
+            self.inventory.invalidate()
             arr_res = result.split(":")
             json_out = { 
                 arr_res[0]: {
@@ -229,6 +527,7 @@ class Proxmox:
                     "type": arr_res[5],
                     "id": arr_res[6],
                     "user": arr_res[7],
+                    "upid": result
                 }
             }
         except ResourceException as e:
@@ -239,14 +538,17 @@ class Proxmox:
         
         return json_out
 
+    @observed
     def run_poweroff(self, vmid):
         try:
-            vms = self.api.cluster.resources.get(type='vm')
-            for vm in vms:
-                if 'vmid' in vm and str(vm['vmid']) == vmid:
-                    vmstatus = vm
-                    break
+            vmstatus = self.find_vm(vmid)
+            if not vmstatus:
+                return {
+                    "error": True,
+                    "message": "No VM found"
+                }
             result = self.api.nodes(vmstatus["node"]).qemu(vmid).status.stop.post(skiplock=1)
+            self.inventory.invalidate()
             arr_res = result.split(":")
             json_out = { 
                 arr_res[0]: {
@@ -257,6 +559,7 @@ class Proxmox:
                     "type": arr_res[5],
                     "id": arr_res[6],
                     "user": arr_res[7],
+                    "upid": result
                 }
             }
         except ResourceException as e:
@@ -267,18 +570,21 @@ class Proxmox:
         
         return json_out
     
+    @observed
     def run_shutdown(self, vmid):
         try:
-            vms = self.api.cluster.resources.get(type='vm')
-            for vm in vms:
-                if 'vmid' in vm and str(vm['vmid']) == vmid:
-                    vmstatus = vm
-                    break
+            vmstatus = self.find_vm(vmid)
+            if not vmstatus:
+                return {
+                    "error": True,
+                    "message": "No VM found"
+                }
             result = self.api.nodes(vmstatus["node"]).qemu(vmid).status.shutdown.post(
                 forceStop=1,
                 skiplock=1
             )
-            print(result)
+            self.inventory.invalidate()
+            logger.info(f"Shutdown of VM {vmid} started: {result}")
             arr_res = result.split(":")
             json_out = { 
                 arr_res[0]: {
@@ -289,6 +595,7 @@ class Proxmox:
                     "type": arr_res[5],
                     "id": arr_res[6],
                     "user": arr_res[7],
+                    "upid": result
                 }
             }
         except ResourceException as e:
@@ -299,13 +606,15 @@ class Proxmox:
         
         return json_out
 
+    @observed
     def vm_status(self, vmid):
         try:
-            vms = self.api.cluster.resources.get(type='vm')
-            for vm in vms:
-                if 'vmid' in vm and str(vm['vmid']) == vmid:
-                    vmstatus = vm
-                    break
+            vmstatus = self.find_vm(vmid)
+            if not vmstatus:
+                return {
+                    "error": True,
+                    "message": "No VM found"
+                }
             result = self.api.nodes(vmstatus["node"]).qemu(vmid).status.current.get()
             json_out = result
         except ResourceException as e:
@@ -316,15 +625,33 @@ class Proxmox:
         
         return json_out
         
+    @observed
+    def task_status(self, upid):
+        """
+            Function to get the status of a Proxmox task from its UPID
+        """
+        try:
+            json_out = self.api.nodes(upid.split(":")[1]).tasks(upid).status.get()
+        except ResourceException as e:
+            json_out = {
+                "message": e.content,
+                "error": True
+            }
+
+        return json_out
+
+    @observed
     def boot_order(self, vmid, order):
         try:
-            vms = self.api.cluster.resources.get(type='vm')
-            for vm in vms:
-                if 'vmid' in vm and str(vm['vmid']) == vmid:
-                    vmstatus = vm
-                    break
+            vmstatus = self.find_vm(vmid)
+            if not vmstatus:
+                return {
+                    "error": True,
+                    "message": "No VM found"
+                }
             str_order = ";".join(order)
             result = self.api.nodes(vmstatus["node"]).qemu(vmid).config.set(boot=f'order={str_order}')
+            self.inventory.invalidate()
             json_out = {
                 "message": f"Boot order changed: {str_order}\n [i] You need to reboot from PVE or API to apply changes"
             }
@@ -336,20 +663,17 @@ class Proxmox:
 
         return json_out
     
+    @observed
     def eject_iso(self, vmid):
         try:
-            vms = self.api.cluster.resources.get(type='vm')
-            vmstatus = ""
-            for vm in vms:
-                if 'vmid' in vm and str(vm['vmid']) == vmid:
-                    vmstatus = vm
-                    break
-            if vmstatus == "":
+            vmstatus = self.find_vm(vmid)
+            if not vmstatus:
                 return {
                     "error": True,
                     "message": "No VM found"
                 }
             result = self.api.nodes(vmstatus["node"]).qemu(vmid).config.set(cdrom='none')
+            self.inventory.invalidate()
             json_out = {
                 "message": result
             }
@@ -361,32 +685,32 @@ class Proxmox:
 
         return json_out
 
+    @observed
     def mount_iso(self, vmid, iso):
-        vms = self.api.cluster.resources.get(type='vm')
-        vmstatus = ""
-        for vm in vms:
-            if 'vmid' in vm and str(vm['vmid']) == vmid:
-                vmstatus = vm
-                break
-        if vmstatus == "":
+        vmstatus = self.find_vm(vmid)
+        if not vmstatus:
             return {
                 "error": True,
                 "message": "No VM found"
             }
-        iso_path = ""
-        for stg in self.api.nodes(vmstatus["node"]).storage.get():
-            for content in self.api.nodes(vmstatus["node"]).storage(stg["storage"]).content.get(content="iso"):
-                if iso in content["volid"]:
-                    iso_path = content["volid"]
-                    break
-        if iso_path == "":
+        iso_path = self.isos.find(self.api, vmstatus["node"], iso)
+        if not iso_path:
             return {
                 "error": True,
                 "message": "No ISO found"
             }
-        result = self.api.nodes(vmstatus["node"]).qemu(vmid).config.set(cdrom=iso_path)
-        json_out = {
+        try:
+            result = self.api.nodes(vmstatus["node"]).qemu(vmid).config.set(cdrom=iso_path)
+            self.inventory.invalidate()
+            json_out = {
                 "message": result
             }
-        
+        except ResourceException as e:
+            if "does not exist" in str(e) or "no such volume" in str(e):
+                self.isos.drop(vmstatus["node"], iso_path.split(":")[0])
+            json_out = {
+                "message": e.content,
+                "error": True
+            }
+
         return json_out
@@ -0,0 +1,133 @@
+"""
+    Module providing the prefork serving mode: worker processes sharing the listen ports through SO_REUSEPORT
+"""
+
+#!/usr/bin/env python3
+import os
+import time
+import signal
+import socket
+import logging
+import traceback
+from waitress.server import create_server, BaseWSGIServer
+from waitress.channel import HTTPChannel
+
+def reuseport_socket(host, port, backlog=1024):
+    """
+        Function to open a listening socket that other processes can bind to the same address
+    """
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+def serve_waitress(app, listen, threads=4, drain_timeout=30):
+    """
+        Function to serve an app with waitress on SO_REUSEPORT sockets until SIGTERM.
+        On SIGTERM the sockets stop accepting, idle connections are closed and the
+        requests in flight get up to drain_timeout seconds to finish.
+    """
+    logger = logging.getLogger("RedmoxAPI")
+    sockets = [ reuseport_socket(host, port) for host, port in listen ]
+    channels = {}
+    server = create_server(app, map=channels, sockets=sockets, threads=threads)
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(time.monotonic()))
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(time.monotonic()))
+    try:
+        while True:
+            server.asyncore.loop(timeout=0.5, map=channels, use_poll=True, count=1)
+            if not stopping:
+                continue
+            busy = 0
+            for channel in list(channels.values()):
+                if isinstance(channel, BaseWSGIServer):
+                    # Not channel.close(), it also closes the trigger waking the loop when a response is ready
+                    channel.del_channel()
+                    channel.socket.close()
+                elif isinstance(channel, HTTPChannel):
+                    if channel.requests or channel.request is not None or channel.total_outbufs_len:
+                        busy += 1
+                    else:
+                        channel.handle_close()
+            if not busy:
+                break
+            if time.monotonic() - stopping[0] > drain_timeout:
+                logger.warning(f"Dropping {busy} connections still busy after {drain_timeout}s")
+                break
+    finally:
+        server.task_dispatcher.shutdown()
+
+class Supervisor:
+    """
+        Class to run the worker processes, restart the ones that die and stop them all on SIGTERM
+    """
+    def __init__(self, workers, target, logger=None, drain_timeout=30, max_backoff=30):
+        self.workers = workers
+        self.target = target
+        self.logger = logger or logging.getLogger("RedMox")
+        self.drain_timeout = drain_timeout
+        self.max_backoff = max_backoff
+        self.children = {}
+        self.stopping = None
+
+    def spawn(self, index, delay=0):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            code = 0
+            try:
+                if delay:
+                    time.sleep(delay)
+                self.target(index)
+            except Exception:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        self.children[pid] = (index, time.monotonic(), delay)
+        return pid
+
+    def stop(self, signum=None, frame=None):
+        if self.stopping is None:
+            self.stopping = time.monotonic()
+            self.logger.info(f"Stopping {len(self.children)} workers")
+            for pid in self.children:
+                self.signal(pid, signal.SIGTERM)
+
+    def signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def run(self):
+        """
+            Function to start the workers and supervise them until they all stopped.
+            A worker dying soon after it started is restarted with a growing delay.
+        """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for index in range(self.workers):
+            self.spawn(index)
+        while self.children:
+            if self.stopping is not None and time.monotonic() - self.stopping > self.drain_timeout + 5:
+                for pid in self.children:
+                    self.signal(pid, signal.SIGKILL)
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                time.sleep(0.2)
+                continue
+            index, started, delay = self.children.pop(pid)
+            if self.stopping is not None:
+                continue
+            self.logger.error(f"Worker {index} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)}, restarting it")
+            lifetime = time.monotonic() - started - delay
+            self.spawn(index, min(max(delay * 2, 1), self.max_backoff) if lifetime < 5 else 0)
@@ -0,0 +1,258 @@
+"""
+    Module providing the Redfish resource builders
+"""
+
+#!/usr/bin/env python3
+import os
+import re
+import json
+import hashlib
+from urllib.parse import urlencode
+from json.encoder import encode_basestring_ascii
+from flask import Response, request
+from libs import tracing
+from libs.tracing import traced
+
+PLACEHOLDER = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+ENCODED_PLACEHOLDER = re.compile(r'"\{\{\s*(\w+)\s*\}\}"|\{\{\s*(\w+)\s*\}\}')
+ENCODE = json.JSONEncoder().encode
+# Properties a $select response always carries
+SELECT_REQUIRED = [ "@odata.id", "@odata.type", "@odata.context", "@odata.etag" ]
+# $expand=*, . or ~ with an optional ($levels=n), n up to the MaxLevels of root.json
+EXPAND = re.compile(r'([*.~])(?:\(\$levels=(\d+)\))?')
+MAX_EXPAND_LEVELS = 1
+
+class QueryError(Exception):
+    """
+        Class for the errors in the Redfish query parameters of a request
+    """
+
+def _compile(node):
+    """
+        Function to turn a skeleton node into a fill function, None when the node is static.
+        A string made of a single placeholder takes the value as is, any other string
+        containing placeholders is formatted.
+    """
+    if isinstance(node, str):
+        whole = PLACEHOLDER.fullmatch(node)
+        if whole:
+            name = whole.group(1)
+            return lambda values: values[name]
+        parts = PLACEHOLDER.split(node)
+        if len(parts) == 1:
+            return None
+        def fill_str(values):
+            return "".join([ str(values[part]) if i % 2 else part for i, part in enumerate(parts) ])
+        return fill_str
+    if isinstance(node, dict):
+        fills = {}
+        for key, child in node.items():
+            fill = _compile(child)
+            if fill:
+                fills[key] = fill
+        if not fills:
+            return None
+        def fill_dict(values):
+            out = dict(node)
+            for key, fill in fills.items():
+                out[key] = fill(values)
+            return out
+        return fill_dict
+    if isinstance(node, list):
+        fills = [ (i, _compile(child)) for i, child in enumerate(node) ]
+        fills = [ (i, fill) for i, fill in fills if fill ]
+        if not fills:
+            return None
+        def fill_list(values):
+            out = list(node)
+            for i, fill in fills:
+                out[i] = fill(values)
+            return out
+        return fill_list
+    return None
+
+def _fragments(skeleton):
+    """
+        Function to split the encoded skeleton into static JSON text and placeholders.
+        Placeholders are (name, whole) tuples, whole when the value replaces the entire string.
+    """
+    text = json.dumps(skeleton)
+    fragments = []
+    position = 0
+    for match in ENCODED_PLACEHOLDER.finditer(text):
+        fragments.append(text[position:match.start()])
+        if match.group(1):
+            fragments.append((match.group(1), True))
+        else:
+            fragments.append((match.group(2), False))
+        position = match.end()
+    fragments.append(text[position:])
+    return fragments
+
+class Resource:
+    """
+        Class to build a Redfish resource from a precompiled template skeleton.
+        Static parts of the skeleton are shared between builds and must not be modified.
+    """
+    def __init__(self, name, skeleton):
+        self.name = name
+        self.skeleton = skeleton
+        self.fill = _compile(skeleton)
+        self.fragments = _fragments(skeleton)
+
+    def build(self, **values):
+        """
+            Function to get the resource as a dict, for handlers that need to modify it
+        """
+        if self.fill is None:
+            return dict(self.skeleton)
+        return self.fill(values)
+
+    def encode(self, **values):
+        """
+            Function to get the resource as JSON text, encoding only the request values
+        """
+        out = []
+        for fragment in self.fragments:
+            if fragment.__class__ is str:
+                out.append(fragment)
+                continue
+            value = values[fragment[0]]
+            if not fragment[1]:
+                out.append(encode_basestring_ascii(str(value))[1:-1])
+            elif value.__class__ is str:
+                out.append(encode_basestring_ascii(value))
+            else:
+                out.append(ENCODE(value))
+        return "".join(out)
+
+class Resources:
+    """
+        Class to load every template of a folder as a resource builder
+    """
+    def __init__(self, folder="templates"):
+        self.folder = folder
+        self.resources = {}
+        for filename in sorted(os.listdir(folder)):
+            if filename.endswith(".json"):
+                with open(os.path.join(folder, filename), "r") as f:
+                    self.resources[filename] = Resource(filename, json.load(f))
+
+    @traced("render", lambda self, template, **values: template)
+    def build(self, template, **values):
+        return self.resources[template].build(**values)
+
+    @traced("render", lambda self, template, **values: template)
+    def encode(self, template, **values):
+        return self.resources[template].encode(**values)
+
+class StaticResources:
+    """
+        Class to keep resources that never change between requests as ready-to-send bytes
+    """
+    def __init__(self):
+        self.bodies = {}
+
+    def set(self, key, body):
+        if not isinstance(body, (str, bytes)):
+            body = json.dumps(body)
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.bodies[key] = (body, hashlib.sha1(body).hexdigest())
+
+    def respond(self, key):
+        body, etag = self.bodies[key]
+        response = Response(body, mimetype="application/json")
+        response.set_etag(etag)
+        return response.make_conditional(request)
+
+def respond(body, code=200, headers=None, etag=None):
+    """
+        Function to send a resource as a JSON response, encoding it unless it already is.
+        With an etag, or etag=True to hash the body, the response answers If-None-Match.
+    """
+    if not isinstance(body, (str, bytes)):
+        with tracing.span("render", "json"):
+            body = json.dumps(body)
+    response = Response(body, status=code, mimetype="application/json")
+    if headers:
+        response.headers.update(headers)
+    if etag:
+        if etag is True:
+            response.add_etag()
+        else:
+            response.set_etag(etag)
+        response.make_conditional(request)
+    return response
+
+def not_modified(etag):
+    """
+        Function to answer a conditional GET whose entity tag matches, None otherwise
+    """
+    if etag and request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+def paging():
+    """
+        Function to get the $top and $skip query parameters of the request, top is None without limit
+    """
+    try:
+        top = int(request.args["$top"]) if "$top" in request.args else None
+        skip = int(request.args.get("$skip", 0))
+    except ValueError:
+        raise QueryError("$top and $skip must be integers")
+    if (top is not None and top < 0) or skip < 0:
+        raise QueryError("$top and $skip must be positive")
+    return top, skip
+
+def paginate(members, top, skip):
+    """
+        Function to cut a collection to the requested window.
+        Returns the members of the page and the link to the next page, None on the last one.
+    """
+    if top is None and not skip:
+        return members, None
+    end = len(members) if top is None else skip + top
+    next_link = None
+    if end < len(members):
+        args = request.args.to_dict()
+        args["$skip"] = str(end)
+        next_link = f"{request.path}?{urlencode(args, safe='$*.~()=,/')}"
+    return members[skip:end], next_link
+
+def expansion():
+    """
+        Function to get the kind of the $expand query parameter of the request, None without it.
+        * expands every subordinate resource, . the ones outside Links and ~ the ones in Links only.
+    """
+    expand = request.args.get("$expand")
+    if expand is None:
+        return None
+    match = EXPAND.fullmatch(expand)
+    if not match:
+        raise QueryError(f"Unsupported $expand: {expand}")
+    levels = int(match.group(2) or 1)
+    if not 1 <= levels <= MAX_EXPAND_LEVELS:
+        raise QueryError(f"$levels must be from 1 up to the MaxLevels of {MAX_EXPAND_LEVELS}")
+    return match.group(1)
+
+def selection():
+    """
+        Function to get the top-level properties of the $select query parameter, None without it
+    """
+    select = request.args.get("$select")
+    if select is None:
+        return None
+    properties = set([ item.strip().split("/")[0] for item in select.split(",") if item.strip() ])
+    if not properties:
+        raise QueryError("$select must list at least one property")
+    return properties
+
+def project(resource, properties):
+    """
+        Function to keep only the selected properties of a resource
+    """
+    return { key: value for key, value in resource.items() if key in properties or key in SELECT_REQUIRED }
@@ -0,0 +1,321 @@
+"""
+    Module providing the Redfish session store
+"""
+
+#!/usr/bin/env python3
+import time
+import json
+import sqlite3
+import itertools
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from libs.common import private_sqlite
+
+class SessionStore(ABC):
+    """
+        Base class for the Redfish session backends
+    """
+    def __init__(self, idle_timeout=1800, max_age=86400, max_sessions=1024, sweep_interval=60, on_evict=None):
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self.max_sessions = max_sessions
+        self.sweep_interval = sweep_interval
+        self.on_evict = on_evict
+        self.sweeper = None
+        self.stopped = threading.Event()
+
+    @abstractmethod
+    def new_id(self):
+        """
+            Function to get the Id of the next session
+        """
+
+    @abstractmethod
+    def add(self, token, session):
+        """
+            Function to store a session under its token, evicting the oldest ones over max_sessions
+        """
+
+    @abstractmethod
+    def update(self, token, session):
+        """
+            Function to replace the session of a token, keeping its age
+        """
+
+    @abstractmethod
+    def get(self, token):
+        """
+            Function to get the session of a token and mark it used, None when it does not exist or expired
+        """
+
+    @abstractmethod
+    def find(self, id):
+        """
+            Function to get the token and the session of a session Id, (None, None) when it does not exist
+        """
+
+    @abstractmethod
+    def delete(self, token):
+        """
+            Function to delete the session of a token, returns whether it existed
+        """
+
+    @abstractmethod
+    def list(self):
+        """
+            Function to get the sessions that are not expired
+        """
+
+    @abstractmethod
+    def sweep(self):
+        """
+            Function to evict the expired sessions
+        """
+
+    @abstractmethod
+    def __len__(self):
+        pass
+
+    def start(self):
+        """
+            Function to start the periodic eviction of expired sessions
+        """
+        if self.sweeper or not self.sweep_interval:
+            return
+        def loop():
+            while not self.stopped.wait(self.sweep_interval):
+                self.sweep()
+        self.sweeper = threading.Thread(target=loop, name="redmox-sessions", daemon=True)
+        self.sweeper.start()
+
+    def stop(self):
+        self.stopped.set()
+
+class MemorySessionStore(SessionStore):
+    """
+        Class to keep the Redfish sessions of this process indexed by token and by session id
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.lock = threading.RLock()
+        self.counter = itertools.count(1)
+        self.sessions = OrderedDict()
+        self.ids = {}
+
+    def new_id(self):
+        return str(next(self.counter))
+
+    def _expired(self, entry, now):
+        return now - entry["used"] >= self.idle_timeout or now - entry["created"] >= self.max_age
+
+    def _evict(self, token):
+        entry = self.sessions.pop(token, None)
+        if entry is None:
+            return
+        self.ids.pop(entry["session"]["Id"], None)
+        if self.on_evict:
+            self.on_evict(token)
+
+    def add(self, token, session):
+        """
+            Function to store a new session, evicting the least recently used ones over the cap
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.sessions[token] = { "session": session, "created": now, "used": now }
+            self.ids[session["Id"]] = token
+            while len(self.sessions) > self.max_sessions:
+                self._evict(next(iter(self.sessions)))
+
+    def update(self, token, session):
+        with self.lock:
+            if token in self.sessions:
+                self.sessions[token]["session"] = session
+
+    def get(self, token):
+        """
+            Function to get the session of a token, None if it does not exist or expired
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.sessions.get(token)
+            if entry is None:
+                return None
+            if self._expired(entry, now):
+                self._evict(token)
+                return None
+            entry["used"] = now
+            self.sessions.move_to_end(token)
+            return entry["session"]
+
+    def find(self, id):
+        """
+            Function to get the token and session of a session id, (None, None) if it does not exist
+        """
+        with self.lock:
+            token = self.ids.get(id)
+            if token is None:
+                return None, None
+            return token, self.get(token)
+
+    def delete(self, token):
+        with self.lock:
+            if token not in self.sessions:
+                return False
+            self._evict(token)
+            return True
+
+    def list(self):
+        with self.lock:
+            self.sweep()
+            return [ entry["session"] for entry in self.sessions.values() ]
+
+    def sweep(self):
+        """
+            Function to evict every expired session
+        """
+        now = time.monotonic()
+        with self.lock:
+            for token in [ t for t, entry in self.sessions.items() if self._expired(entry, now) ]:
+                self._evict(token)
+
+    def __len__(self):
+        return len(self.sessions)
+
+class SQLiteSessionStore(SessionStore):
+    """
+        Class to keep the Redfish sessions in a SQLite file shared by every Redmox process on the host
+    """
+    # Skip the last-used update when the session was touched this recently
+    touch_interval = 1
+
+    def __init__(self, path="redmox-sessions.db", **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.local = threading.local()
+        private_sqlite(self.path)
+        db = self.db()
+        with db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "token TEXT PRIMARY KEY, id TEXT UNIQUE, data TEXT, created REAL, used REAL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS sessions_used ON sessions (used)")
+            db.execute("CREATE TABLE IF NOT EXISTS session_ids (id INTEGER PRIMARY KEY AUTOINCREMENT)")
+
+    def db(self):
+        """
+            Function to get the SQLite connection of the current thread
+        """
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return db
+
+    def _expired(self, created, used, now):
+        return now - used >= self.idle_timeout or now - created >= self.max_age
+
+    def _evict(self, tokens):
+        if not tokens:
+            return
+        with self.db() as db:
+            db.executemany("DELETE FROM sessions WHERE token = ?", [ (token,) for token in tokens ])
+        if self.on_evict:
+            for token in tokens:
+                self.on_evict(token)
+
+    def new_id(self):
+        with self.db() as db:
+            return str(db.execute("INSERT INTO session_ids DEFAULT VALUES").lastrowid)
+
+    def add(self, token, session):
+        now = time.time()
+        with self.db() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO sessions (token, id, data, created, used) VALUES (?, ?, ?, ?, ?)",
+                (token, session["Id"], json.dumps(session), now, now)
+            )
+            overflow = db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] - self.max_sessions
+        if overflow > 0:
+            rows = self.db().execute("SELECT token FROM sessions ORDER BY used LIMIT ?", (overflow,))
+            self._evict([ row[0] for row in rows.fetchall() ])
+
+    def update(self, token, session):
+        with self.db() as db:
+            db.execute("UPDATE sessions SET data = ? WHERE token = ?", (json.dumps(session), token))
+
+    def get(self, token):
+        now = time.time()
+        row = self.db().execute(
+            "SELECT data, created, used FROM sessions WHERE token = ?", (token,)
+        ).fetchone()
+        if row is None:
+            return None
+        data, created, used = row
+        if self._expired(created, used, now):
+            self._evict([ token ])
+            return None
+        if now - used >= self.touch_interval:
+            with self.db() as db:
+                db.execute("UPDATE sessions SET used = ? WHERE token = ?", (now, token))
+        return json.loads(data)
+
+    def find(self, id):
+        row = self.db().execute("SELECT token FROM sessions WHERE id = ?", (id,)).fetchone()
+        if row is None:
+            return None, None
+        return row[0], self.get(row[0])
+
+    def delete(self, token):
+        with self.db() as db:
+            deleted = db.execute("DELETE FROM sessions WHERE token = ?", (token,)).rowcount
+        if deleted and self.on_evict:
+            self.on_evict(token)
+        return bool(deleted)
+
+    def list(self):
+        self.sweep()
+        rows = self.db().execute("SELECT data FROM sessions ORDER BY used").fetchall()
+        return [ json.loads(row[0]) for row in rows ]
+
+    def sweep(self):
+        now = time.time()
+        rows = self.db().execute(
+            "SELECT token FROM sessions WHERE used <= ? OR created <= ?",
+            (now - self.idle_timeout, now - self.max_age)
+        ).fetchall()
+        self._evict([ row[0] for row in rows ])
+
+    def __len__(self):
+        return self.db().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+def open_store(configs, on_evict=None):
+    """
+        Function to create the session backend selected in the configuration
+    """
+    kwargs = {
+        "idle_timeout": configs.get("idle_timeout", 1800),
+        "max_age": configs.get("max_age", 86400),
+        "max_sessions": configs.get("max_sessions", 1024),
+        "sweep_interval": configs.get("sweep_interval", 60),
+        "on_evict": on_evict
+    }
+    backend = configs.get("backend", "memory")
+    if backend == "sqlite":
+        return SQLiteSessionStore(path=configs.get("path", "redmox-sessions.db"), **kwargs)
+    if backend != "memory":
+        raise ValueError(f"Unknown session backend: {backend}")
+    return MemorySessionStore(**kwargs)
+
+def public(session):
+    """
+        Function to get a copy of a session without its credentials
+    """
+    session_out = dict(session)
+    session_out.pop("Ticket", None)
+    session_out.pop("CSRFToken", None)
+    return session_out
@@ -0,0 +1,228 @@
+"""
+    Module providing the Redfish Task Service for long running actions
+"""
+
+#!/usr/bin/env python3
+import time
+import json
+import sqlite3
+import itertools
+import threading
+from collections import OrderedDict
+from libs.common import private_sqlite
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+def timestamp():
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+class Task:
+    """
+        Class to keep the progress of a background action
+    """
+    def __init__(self, id, name, on_change=None):
+        self.id = id
+        self.name = name
+        self.state = "New"
+        self.status = "OK"
+        self.percent = 0
+        self.messages = []
+        self.start_time = timestamp()
+        self.end_time = None
+        self.on_change = on_change
+
+    @classmethod
+    def from_fields(cls, fields):
+        task = cls(fields["id"], fields["name"])
+        task.state = fields["state"]
+        task.status = fields["status"]
+        task.percent = fields["percent"]
+        task.messages = fields["messages"]
+        task.start_time = fields["start_time"]
+        task.end_time = fields["end_time"]
+        return task
+
+    def changed(self):
+        if self.on_change:
+            self.on_change(self)
+
+    def update(self, state=None, percent=None, message=None):
+        if state:
+            self.state = state
+        if percent is not None:
+            self.percent = percent
+        if message:
+            self.messages.append({ "Message": message })
+        self.changed()
+
+    def finish(self, message=None, error=False):
+        self.state = "Exception" if error else "Completed"
+        self.status = "Critical" if error else "OK"
+        self.percent = 100
+        self.end_time = timestamp()
+        if message:
+            self.messages.append({ "Message": message })
+        self.changed()
+
+    def done(self):
+        return self.state in [ "Completed", "Exception" ]
+
+    def fields(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "state": self.state,
+            "status": self.status,
+            "percent": self.percent,
+            "messages": list(self.messages),
+            "start_time": self.start_time,
+            "end_time": self.end_time
+        }
+
+class SQLiteTaskStore:
+    """
+        Class to keep the tasks in a SQLite file so every Redmox process on the host can report them
+    """
+    def __init__(self, path="redmox-tasks.db", keep=256):
+        self.path = path
+        self.keep = keep
+        self.local = threading.local()
+        private_sqlite(self.path)
+        with self.db() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS tasks (id INTEGER PRIMARY KEY AUTOINCREMENT, data TEXT, done INTEGER)")
+
+    def db(self):
+        """
+            Function to get the SQLite connection of the current thread
+        """
+        db = getattr(self.local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self.local.db = db
+        return db
+
+    def new_id(self):
+        """
+            Function to reserve a task id unique across the processes, dropping the oldest finished tasks over keep
+        """
+        with self.db() as db:
+            id = db.execute("INSERT INTO tasks (data, done) VALUES (NULL, 0)").lastrowid
+            db.execute(
+                "DELETE FROM tasks WHERE done = 1 AND id <= (SELECT MAX(id) FROM tasks) - ?", (self.keep,)
+            )
+        return str(id)
+
+    def save(self, task):
+        with self.db() as db:
+            db.execute(
+                "UPDATE tasks SET data = ?, done = ? WHERE id = ?",
+                (json.dumps(task.fields()), int(task.done()), int(task.id))
+            )
+
+    def load(self, id):
+        if not id.isdigit():
+            return None
+        row = self.db().execute("SELECT data FROM tasks WHERE id = ?", (int(id),)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return Task.from_fields(json.loads(row[0]))
+
+    def list(self):
+        rows = self.db().execute("SELECT data FROM tasks WHERE data IS NOT NULL ORDER BY id").fetchall()
+        return [ Task.from_fields(json.loads(row[0])) for row in rows ]
+
+class TaskService:
+    """
+        Class to run actions in the background and keep track of them as Redfish tasks.
+        With a store, the tasks are also visible to the other processes sharing it.
+    """
+    def __init__(self, workers=4, timeout=60, keep=256, store=None):
+        self.timeout = timeout
+        self.keep = keep
+        self.store = store
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.tasks = OrderedDict()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="redmox-task")
+
+    def submit(self, name, func, *args):
+        """
+            Function to run func(task, *args) in the background, returns the new task
+        """
+        if self.store:
+            task = Task(self.store.new_id(), name, on_change=self.store.save)
+        else:
+            task = Task(str(next(self.ids)), name)
+        task.changed()
+        with self.lock:
+            self.tasks[task.id] = task
+            for old_id in list(self.tasks.keys()):
+                if len(self.tasks) <= self.keep:
+                    break
+                if self.tasks[old_id].done():
+                    self.tasks.pop(old_id)
+        self.executor.submit(self._run, task, func, *args)
+        return task
+
+    def _run(self, task, func, *args):
+        task.update(state="Running")
+        try:
+            func(task, *args)
+            if not task.done():
+                task.finish()
+        except Exception as e:
+            task.finish(message=str(e), error=True)
+
+    def get(self, id):
+        task = self.tasks.get(id)
+        if task is None and self.store:
+            task = self.store.load(id)
+        return task
+
+    def list(self):
+        if self.store:
+            return self.store.list()
+        return list(self.tasks.values())
+
+    def wait_upid(self, pmox, upid, timeout=None):
+        """
+            Function to poll a Proxmox task until it stops, backing off between polls.
+            Returns the exit status of the task.
+        """
+        deadline = time.monotonic() + (timeout or self.timeout)
+        delay = 0.5
+        while True:
+            result = pmox.task_status(upid)
+            if result.get("error"):
+                raise Exception(result["message"])
+            if result.get("status") == "stopped":
+                return result.get("exitstatus", "Unknown")
+            if time.monotonic() + delay > deadline:
+                raise Exception(f"Timeout waiting for Proxmox task {upid}")
+            time.sleep(delay)
+            delay = min(delay * 1.5, 5)
+
+    def power_cycle(self, task, pmox, vmid, graceful=False):
+        """
+            Function to stop a VM, wait for the Proxmox task to end and start it again
+        """
+        if graceful:
+            result = pmox.run_shutdown(vmid)
+        else:
+            result = pmox.run_poweroff(vmid)
+        if result.get("error"):
+            raise Exception(result["message"])
+        task.update(percent=10, message=f"Stopping VM {vmid}")
+        exit_status = self.wait_upid(pmox, result["UPID"]["upid"])
+        if exit_status != "OK":
+            raise Exception(f"Unable to stop VM {vmid}: {exit_status}")
+        task.update(percent=50, message=f"VM {vmid} stopped")
+        result = pmox.run_poweron(vmid)
+        if result.get("error"):
+            raise Exception(result["message"])
+        exit_status = self.wait_upid(pmox, result["UPID"]["upid"])
+        if exit_status != "OK":
+            raise Exception(f"Unable to start VM {vmid}: {exit_status}")
+        task.finish(message=f"VM {vmid} restarted")
@@ -0,0 +1,188 @@
+"""
+    Module providing the per-request traces of Redmox and the on-demand profiler
+"""
+
+#!/usr/bin/env python3
+import time
+import pstats
+import cProfile
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Trace of the request being served, propagated to the fan-out threads and the asyncio tasks
+CURRENT = contextvars.ContextVar("redmox_trace", default=None)
+
+# Span kinds reported in the Server-Timing header, the other ones only go to the trace log
+TIMING_KINDS = [ "auth", "login", "upstream", "render" ]
+
+class Trace:
+    """
+        Class to collect the timed steps of a request
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.spans = []
+
+    def add(self, kind, name, start, elapsed):
+        with self.lock:
+            self.spans.append((kind, name, start, elapsed))
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        """
+            Function to get the Server-Timing header value: the time and count of each kind of step and the total
+        """
+        totals = {}
+        with self.lock:
+            for kind, name, start, elapsed in self.spans:
+                count, duration = totals.get(kind, (0, 0))
+                totals[kind] = (count + 1, duration + elapsed)
+        metrics = []
+        for kind in TIMING_KINDS:
+            if kind in totals:
+                count, duration = totals[kind]
+                metrics.append(f'{kind};dur={duration * 1000:.2f};desc="{count} calls"')
+        metrics.append(f"total;dur={self.elapsed() * 1000:.2f}")
+        return ", ".join(metrics)
+
+    def fields(self):
+        with self.lock:
+            spans = list(self.spans)
+        return {
+            "total_ms": round(self.elapsed() * 1000, 3),
+            "spans": [
+                {
+                    "kind": kind,
+                    "name": name,
+                    "start_ms": round((start - self.start) * 1000, 3),
+                    "duration_ms": round(elapsed * 1000, 3)
+                }
+                for kind, name, start, elapsed in sorted(spans, key=lambda span: span[2])
+            ]
+        }
+
+def begin():
+    """
+        Function to start the trace of the current request, returns the token to end it
+    """
+    return CURRENT.set(Trace())
+
+def end(token):
+    CURRENT.reset(token)
+
+def current():
+    return CURRENT.get()
+
+def record(kind, name, start, elapsed):
+    trace = CURRENT.get()
+    if trace is not None:
+        trace.add(kind, name, start, elapsed)
+
+@contextmanager
+def span(kind, name):
+    """
+        Function to time a block in the trace of the current request
+    """
+    trace = CURRENT.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(kind, name, start, time.perf_counter() - start)
+
+def traced(kind, label=None):
+    """
+        Decorator to time every call of a function in the trace of the current request.
+        The span is named by label(*args, **kwargs) when given, by the function otherwise.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = CURRENT.get()
+            if trace is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                trace.add(kind, label(*args, **kwargs) if label else func.__qualname__, start, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+class Profiler:
+    """
+        Class to run cProfile on the next requests and aggregate their statistics.
+        A thread profiles one request at a time; in async mode the profile of a view
+        also catches the other requests the event loop serves while it is waiting.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.remaining = 0
+        self.profiled = 0
+        self.stats = None
+
+    def arm(self, requests):
+        """
+            Function to profile the next requests, dropping the statistics collected so far
+        """
+        with self.lock:
+            self.remaining = requests
+            self.profiled = 0
+            self.stats = None
+
+    def begin(self):
+        """
+            Function to start profiling a request when some are still to profile, returns the profile or None
+        """
+        if not self.remaining or getattr(self.local, "profile", None) is not None:
+            return None
+        with self.lock:
+            if self.remaining <= 0:
+                return None
+            self.remaining -= 1
+        profile = cProfile.Profile()
+        self.local.profile = profile
+        profile.enable()
+        return profile
+
+    def end(self, profile):
+        profile.disable()
+        self.local.profile = None
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+            self.profiled += 1
+
+    def report(self, limit=30, sort="cumulative"):
+        """
+            Function to get the functions taking the most time over the profiled requests
+        """
+        keys = { "cumulative": 3, "tottime": 2, "calls": 1 }
+        if sort not in keys:
+            raise ValueError(f"Unknown sort {sort}, expected one of {', '.join(keys)}")
+        with self.lock:
+            entries = list(self.stats.stats.items()) if self.stats else []
+            status = { "remaining": self.remaining, "profiled": self.profiled }
+        entries.sort(key=lambda entry: entry[1][keys[sort]], reverse=True)
+        status["functions"] = [
+            {
+                "function": f"{filename}:{line}({name})",
+                "calls": calls,
+                "primitive_calls": primitive,
+                "total_time": round(total, 6),
+                "cumulative_time": round(cumulative, 6)
+            }
+            for (filename, line, name), (primitive, calls, total, cumulative, callers) in entries[:limit]
+        ]
+        return status
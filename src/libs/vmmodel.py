@@ -0,0 +1,221 @@
+"""
+    Module providing the VM model built from Proxmox resources and config
+"""
+
+#!/usr/bin/env python3
+import threading
+from collections import OrderedDict
+
+def parse_options(value):
+    """
+        Function to split a Proxmox property string "head,key=value,..." in a single pass
+    """
+    head = None
+    options = {}
+    for item in value.split(','):
+        key, sep, option = item.partition('=')
+        if sep:
+            options[key] = option
+        elif head is None:
+            head = item
+    return head, options
+
+class SectionCache:
+    """
+        Class to keep the parsed config sections of the most recent config digests
+    """
+    def __init__(self, size=1024):
+        self.size = size
+        self.lock = threading.Lock()
+        self.sections = OrderedDict()
+
+    def get(self, digest):
+        with self.lock:
+            sections = self.sections.get(digest)
+            if sections is not None:
+                self.sections.move_to_end(digest)
+            return sections
+
+    def put(self, digest, sections):
+        with self.lock:
+            self.sections[digest] = sections
+            while len(self.sections) > self.size:
+                self.sections.popitem(last=False)
+
+SECTIONS = SectionCache()
+
+def parse_sections(config):
+    """
+        Function to parse the drive, network, meta and bios entries of a VM config in a single pass
+    """
+    sections = {
+        "cdrom": None,
+        "meta": None,
+        "interfaces": [],
+        "disks": [],
+        "bios": None
+    }
+    for key, value in config.items():
+        if not isinstance(value, str):
+            continue
+        if "iso/" in value:
+            head, options = parse_options(value)
+            datastore, _, iso = head.partition(':')
+            sections["cdrom"] = { "mount": key, "datastore": datastore, "iso": iso.replace('iso/', '') }
+            sections["cdrom"].update(options)
+        if key == "meta":
+            sections["meta"] = parse_options(value)[1]
+        if key.startswith("net"):
+            interface = { "name": key }
+            interface.update(parse_options(value)[1])
+            sections["interfaces"].append(interface)
+        if "iothread" in value:
+            head, options = parse_options(value)
+            datastore, _, name = head.partition(':')
+            disk = { "device": key, "status": "mounted", "datastore": datastore, "name": name }
+            disk.update(options)
+            sections["disks"].append(disk)
+        if "bios" in key:
+            sections["bios"] = { "name": key }
+            sections["bios"].update(parse_options(value)[1])
+        if "unused" in key:
+            datastore, _, name = value.split(',')[0].partition(':')
+            sections["disks"].append({ "device": key, "status": "unused", "datastore": datastore, "name": name })
+    return sections
+
+class VM:
+    """
+        Class to expose the resource record and config of a VM, parsing config sections on demand
+    """
+    __slots__ = ("vmid", "record", "config", "_sections")
+
+    def __init__(self, vmid, record, config):
+        self.vmid = vmid
+        self.record = record
+        self.config = config
+        self._sections = None
+
+    @property
+    def name(self):
+        return self.record.get('name', 'Unknown')
+
+    @property
+    def status(self):
+        return self.record.get('status', 'Unknown')
+
+    @property
+    def node(self):
+        return self.record.get('node', 'Unknown')
+
+    @property
+    def type(self):
+        return self.record.get('type', 'Unknown')
+
+    @property
+    def tags(self):
+        tags = self.record.get('tags', '')
+        return [ tag for tag in tags.split(';') if tag ] if isinstance(tags, str) else tags
+
+    @property
+    def vmgenid(self):
+        return self.config.get('vmgenid', '')
+
+    @property
+    def digest(self):
+        return self.config.get('digest', '')
+
+    @property
+    def cores(self):
+        return int(self.config.get('cores', 1))
+
+    @property
+    def sockets(self):
+        return int(self.config.get('sockets', 1))
+
+    @property
+    def memory_mb(self):
+        return int(self.config.get('memory', 0))
+
+    @property
+    def media(self):
+        return self.config.get('ide2', '')
+
+    @property
+    def boot_order(self):
+        return self.config['boot'].replace('order=', '').split(';') if 'boot' in self.config else []
+
+    def sections(self):
+        """
+            Function to get the parsed config sections, shared by every VM with the same config digest
+        """
+        if self._sections is None:
+            sections = SECTIONS.get(self.digest) if self.digest else None
+            if sections is None:
+                sections = parse_sections(self.config)
+                if self.digest:
+                    SECTIONS.put(self.digest, sections)
+            self._sections = sections
+        return self._sections
+
+    def to_dict(self):
+        """
+            Function to get every VM field in the get_vm_info format
+        """
+        record = self.record
+        config = self.config
+        json_out = {
+            "id": record['vmid'],
+            "vmgenid": self.vmgenid,
+            "name": self.name,
+            "status": self.status,
+            "node": self.node,
+            "type": self.type,
+            "tags": self.tags,
+            "uptime": record.get('uptime', 0),
+            "template": record.get('template', 0),
+            "digest": self.digest,
+            "media": self.media,
+            "boot": {
+                "order": self.boot_order,
+            },
+            "ostype": config.get('ostype', 'Unknown'),
+            "cpu": {
+                "usage": {
+                    "current": record.get('cpu', 0),
+                    "total": record.get('maxcpu', 0)
+                },
+                "cores": config.get('cores', 1),
+                "type": config.get('cpu', 'Unknown'),
+                "sockets": config.get('sockets', 1)
+            },
+            "memory": {
+                "usage": {
+                    "current": record.get('mem', 0),
+                    "total": record.get('maxmem', 0)
+                },
+                "assigned_mb": config.get('memory', 0),
+                "numa": config.get('numa', 0)
+            },
+            "disk": {
+                "usage": {
+                    "current": record.get('disk', 0),
+                    "read": record.get('diskread', 0),
+                    "write": record.get('diskwrite', 0),
+                    "total": record.get('maxdisk', 0)
+                },
+                "list": [ dict(disk) for disk in self.sections()["disks"] ]
+            },
+            "network": {
+                "usage": {
+                    "in": record.get('netin', 0),
+                    "out": record.get('netout', 0)
+                }
+            }
+        }
+        sections = self.sections()
+        if sections["interfaces"]:
+            json_out["network"]["interfaces"] = [ dict(interface) for interface in sections["interfaces"] ]
+        for key in [ "cdrom", "meta", "bios" ]:
+            if sections[key] is not None:
+                json_out[key] = dict(sections[key])
+        return json_out
@@ -3,6 +3,9 @@ import os
 import yaml
 from waitress import serve
 from libs.apilib import RedmoxAPI
+from libs.aioapi import AsyncServer
+from libs.listeners import Listeners
+from libs.prefork import Supervisor, serve_waitress
 from libs.common import Clr, set_logger
 
 if __name__ == "__main__":
@@ -18,10 +21,29 @@ if __name__ == "__main__":
         if not configs["redfish"]["vmid"] or configs["redfish"]["vmid"] == "":
             logger.error(f"Please set the VMs associated with the manager. Env. Variable: [{Clr.purple}VMIDS{Clr.reset}]")
             exit()
+    if configs["redfish"].get("server", "waitress") not in [ "waitress", "async" ]:
+        logger.error(f"Define Server properly, values {Clr.green}waitress/async{Clr.reset}")
+        exit()
+    if configs["redfish"]["mode"] == "multi":
+        if not configs["redfish"].get("listeners"):
+            logger.error(f"Please set the listeners of the multi mode. Config: [{Clr.purple}redfish.listeners{Clr.reset}]")
+            exit()
     debug = True if os.getenv("DEBUG") == "yes" else False
-
-    rdx_api = RedmoxAPI(configs, debug=debug)
-    app = rdx_api.app
+    workers = 1 if debug else configs["redfish"].get("workers", 1)
+    if workers > 1:
+        if any([ (configs.get(section) or {}).get("backend", "memory") != "sqlite" for section in [ "sessions", "tasks", "events" ] ]):
+            logger.error(f"Several workers need the sqlite backends. Config: [{Clr.purple}sessions.backend{Clr.reset}], [{Clr.purple}tasks.backend{Clr.reset}] and [{Clr.purple}events.backend{Clr.reset}]")
+            exit()
+        if not (configs.get("cache") or {}).get("poll_interval", 0):
+            logger.warning(f"Only the first worker posts the webhooks, of the changes it sees when refreshing. Config: [{Clr.purple}cache.poll_interval{Clr.reset}]")
+    server = configs["redfish"].get("server", "waitress")
+    threads = configs["redfish"].get("threads", 4)
+    drain_timeout = configs["redfish"].get("drain_timeout", 30)
+    connections = (configs.get("upstream") or {}).get("connections", 10)
+    if configs["redfish"]["mode"] == "multi":
+        listen = [ (host, port) for host, port, vmid in Listeners(configs["redfish"]["listeners"]).listeners ]
+    else:
+        listen = [ (configs["redfish"]["host"], configs["redfish"]["port"]) ]
 
     print(f"{Clr.purple}#### Starting Redmox Server ####{Clr.reset}\n")
     if debug:
@@ -29,8 +51,37 @@ if __name__ == "__main__":
     print(f"-----------------------\n|    {Clr.cyan}PROXMOX SERVER{Clr.reset}   |\n-----------------------")
     print(f'- {Clr.green}HOST{Clr.reset}: {configs["proxmox"]["host"]}\n- {Clr.green}PORT{Clr.reset}: {configs["proxmox"]["port"]}')
     print("-----------------------\n")
+    if configs["redfish"]["mode"] == "multi":
+        print(f"- {Clr.green}LISTENERS{Clr.reset}: {len(listen)}\n")
 
-    if debug:
-        app.run(debug=True)
-    else:
-        serve(app, host=configs["redfish"]["host"], port=configs["redfish"]["port"])
\ No newline at end of file
+    if workers > 1:
+        # Each worker builds its own API after the fork, nothing with threads or open files crosses it
+        # The subscriptions are shared, only the first worker posts to them so an event is delivered once
+        def worker(index):
+            rdx_api = RedmoxAPI(configs, debug=False, webhooks=index == 0)
+            rdx_api.start()
+            try:
+                if server == "async":
+                    AsyncServer(rdx_api, listen, threads=threads, connections=connections, reuse_port=True, drain_timeout=drain_timeout).run()
+                else:
+                    serve_waitress(rdx_api.app, listen, threads=threads, drain_timeout=drain_timeout)
+            finally:
+                rdx_api.stop()
+        print(f"- {Clr.green}WORKERS{Clr.reset}: {workers}\n")
+        Supervisor(workers, worker, logger=logger, drain_timeout=drain_timeout).run()
+        exit()
+
+    rdx_api = RedmoxAPI(configs, debug=debug)
+    app = rdx_api.app
+    rdx_api.start()
+    try:
+        if debug:
+            app.run(debug=True)
+        elif server == "async":
+            AsyncServer(rdx_api, listen, threads=threads, connections=connections, drain_timeout=drain_timeout).run()
+        elif configs["redfish"]["mode"] == "multi":
+            serve(app, listen=rdx_api.listeners.listen(), threads=threads)
+        else:
+            serve(app, host=configs["redfish"]["host"], port=configs["redfish"]["port"], threads=threads)
+    finally:
+        rdx_api.stop()
\ No newline at end of file
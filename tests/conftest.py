@@ -0,0 +1,78 @@
+import os
+import sys
+import logging
+import pytest
+import yaml
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SRC = os.path.join(ROOT, "src")
+sys.path.insert(0, SRC)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from fakepve import FakePVE
+from libs.apilib import RedmoxAPI
+
+class Recorder:
+    """
+        Class to drive a fresh Redmox app with a logged in session and record the Proxmox calls of each request
+    """
+    def __init__(self, api, fake):
+        self.api = api
+        self.fake = fake
+        self.client = api.app.test_client()
+        self.headers = { "Host": "127.0.0.1" }
+        self.token = self.login()
+        self.headers["X-Auth-Token"] = self.token
+        self.calls()
+
+    def login(self):
+        response = self.client.post("/redfish/v1/SessionService/Sessions", json={ "UserName": "root@pam", "Password": "test" })
+        assert response.status_code == 200, response.get_data(as_text=True)
+        return response.get_data(as_text=True).split("X-Auth-Token: ")[1].split()[0]
+
+    def calls(self):
+        """
+            Function to get the Proxmox calls since the last call, as "METHOD /path" -> count
+        """
+        return {
+            f"{method} {path.replace('/api2/json', '', 1)}": count
+            for (method, path), count in self.fake.reset_calls().items()
+        }
+
+    def request(self, method, path, body=None):
+        response = self.client.open(path, method=method, headers=self.headers, json=body)
+        assert response.status_code < 400, f"{method} {path}: {response.status_code} {response.get_data(as_text=True)}"
+        return self.calls()
+
+@pytest.fixture(scope="session")
+def fake():
+    fake = FakePVE(nodes=2, vms=4, storages=2, isos=2).start()
+    yield fake
+    fake.stop()
+
+@pytest.fixture
+def configs(fake, tmp_path, monkeypatch):
+    """
+        Configuration of the app under test, a test module can override it to change some settings
+    """
+    # The app loads its templates relative to the working directory
+    monkeypatch.chdir(SRC)
+    with open("configs.yaml", "r") as f:
+        configs = yaml.safe_load(f)
+    bmc_map = tmp_path / "bmc_map"
+    bmc_map.write_text(f"127.0.0.1 {min(fake.vms)}\n")
+    configs["proxmox"] = { "host": "127.0.0.1", "port": fake.port }
+    configs["redfish"].update(mode="simple", vmid=min(fake.vms))
+    configs["bmc"]["map"] = str(bmc_map)
+    configs["cache"]["poll_interval"] = 0
+    configs["sessions"]["backend"] = "memory"
+    configs["tasks"]["backend"] = "memory"
+    return configs
+
+@pytest.fixture
+def redmox(fake, configs):
+    api = RedmoxAPI(configs)
+    api.app.logger.setLevel(logging.CRITICAL)
+    fake.reset_calls()
+    yield Recorder(api, fake)
+    api.stop()
@@ -0,0 +1,52 @@
+"""
+    Pool of the non-blocking clients of the sessions
+
+    The clients belong to the event loop of the async server, while the
+    session store evicts them from its sweeper and request threads.
+"""
+import asyncio
+import threading
+
+from libs.aiopmox import AsyncClientPool
+
+def pool(fake, **kwargs):
+    return AsyncClientPool("127.0.0.1", port=fake.port, name="fake", **kwargs)
+
+def test_discard_from_other_thread(fake):
+    async def run():
+        clients = pool(fake)
+        await clients.get("a", "root@pam", "test")
+        thread = threading.Thread(target=clients.discard, args=("a",))
+        thread.start()
+        thread.join()
+        # The other thread hands the change over to the loop rather than touching the pool
+        assert list(clients.clients) == [ "a" ]
+        await asyncio.sleep(0)
+        assert list(clients.clients) == []
+    asyncio.run(run())
+
+def test_discard_on_loop(fake):
+    async def run():
+        clients = pool(fake)
+        await clients.get("a", "root@pam", "test")
+        clients.discard("a")
+        assert list(clients.clients) == []
+    asyncio.run(run())
+
+def test_idle_clients_evicted(fake):
+    async def run():
+        clients = pool(fake, idle_timeout=0.1)
+        first = await clients.get("a", "root@pam", "test")
+        assert await clients.get("a", "root@pam", "test") is first
+        await asyncio.sleep(0.15)
+        await clients.get("b", "root@pam", "test")
+        assert list(clients.clients) == [ "b" ]
+    asyncio.run(run())
+
+def test_size_bound(fake):
+    async def run():
+        clients = pool(fake, size=2)
+        for key in [ "a", "b", "a", "c" ]:
+            await clients.get(key, "root@pam", "test")
+        assert list(clients.clients) == [ "a", "c" ]
+    asyncio.run(run())
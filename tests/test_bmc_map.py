@@ -0,0 +1,95 @@
+"""
+    Map of the BMC addresses to the VMs they emulate
+
+    The rules of the map file are single addresses, CIDR networks and
+    first-last IP ranges, a network or a range numbering its VMs from the
+    vmid of its first address.
+"""
+import os
+import logging
+import pytest
+
+from libs.bmcmap import BmcMap, MAX_RANGE, parse_rule, host_address
+
+@pytest.fixture
+def bmc_map(tmp_path):
+    """
+        Function to give the test a map file writer, returning the map reloaded on every lookup
+    """
+    path = tmp_path / "bmc_map"
+    def write(text, mtime=1000000000):
+        path.write_text(text)
+        os.utime(path, (mtime, mtime))
+        return path
+    write("")
+    write.map = BmcMap(str(path), reload_interval=0, logger=logging.getLogger("test"))
+    return write
+
+def test_single_address():
+    assert parse_rule("10.0.0.1", "100") is None
+    assert parse_rule("bmc1.example.com", "100") is None
+
+def test_cidr():
+    assert parse_rule("10.0.0.0/30", "100") == [
+        ("10.0.0.0", "100"), ("10.0.0.1", "101"), ("10.0.0.2", "102"), ("10.0.0.3", "103")
+    ]
+    # The host bits are ignored, the rule starts at the network address
+    assert parse_rule("10.0.0.5/31", "200") == [ ("10.0.0.4", "200"), ("10.0.0.5", "201") ]
+
+def test_dash_range():
+    assert parse_rule("10.0.0.250-10.0.1.1", "100") == [
+        ("10.0.0.250", "100"), ("10.0.0.251", "101"), ("10.0.0.252", "102"), ("10.0.0.253", "103"),
+        ("10.0.0.254", "104"), ("10.0.0.255", "105"), ("10.0.1.0", "106"), ("10.0.1.1", "107")
+    ]
+    assert parse_rule("fd00::1-fd00::2", "100") == [ ("fd00::1", "100"), ("fd00::2", "101") ]
+
+@pytest.mark.parametrize("address", [ "10.0.0.2-10.0.0.1", "10.0.0.1-fd00::1", "10.0.0.1-bmc", "10.0.0.0/33" ])
+def test_invalid_rule(address):
+    with pytest.raises(ValueError):
+        parse_rule(address, "100")
+
+def test_host_name_with_dash():
+    assert parse_rule("bmc-1.example.com", "100") is None
+
+def test_oversize_rejected():
+    assert len(parse_rule("10.0.0.0/16", "1")) == MAX_RANGE
+    with pytest.raises(ValueError, match=str(MAX_RANGE)):
+        parse_rule("10.0.0.0/15", "1")
+    with pytest.raises(ValueError, match=str(MAX_RANGE)):
+        parse_rule("10.0.0.0-10.1.0.0", "1")
+
+def test_overlaps(bmc_map):
+    bmc_map("10.0.0.0/30 100\n10.0.0.2-10.0.0.5 200\n10.0.0.1 300\n", mtime=1000000001)
+    bmc_map.map.check()
+    assert bmc_map.map.index == {
+        "10.0.0.0": "100",
+        "10.0.0.1": "300",  # An exact address wins over the networks and the ranges
+        "10.0.0.2": "102",  # The first rule wins between networks and ranges
+        "10.0.0.3": "103",
+        "10.0.0.4": "202",
+        "10.0.0.5": "203"
+    }
+
+def test_lookup(bmc_map):
+    bmc_map("10.0.0.1 100  # rack 1\nBMC1.example.com 101\nfd00::1 102\n", mtime=1000000001)
+    assert bmc_map.map.lookup("10.0.0.1:8000") == "100"
+    assert bmc_map.map.lookup("bmc1.example.com") == "101"
+    assert bmc_map.map.lookup("[fd00:0::1]:8000") == "102"
+    assert bmc_map.map.lookup("10.0.0.2") is None
+    assert host_address("[fd00::1]:443") == "fd00::1"
+
+def test_reload_on_mtime_change(bmc_map):
+    bmc_map("10.0.0.1 100\n", mtime=1000000001)
+    assert bmc_map.map.lookup("10.0.0.1") == "100"
+    # Same modification time, the file is not read again
+    bmc_map("10.0.0.1 200\n", mtime=1000000001)
+    assert bmc_map.map.lookup("10.0.0.1") == "100"
+    bmc_map("10.0.0.1 200\n", mtime=1000000002)
+    assert bmc_map.map.lookup("10.0.0.1") == "200"
+
+def test_invalid_file_keeps_previous_map(bmc_map):
+    bmc_map("10.0.0.1 100\n", mtime=1000000001)
+    assert bmc_map.map.lookup("10.0.0.1") == "100"
+    bmc_map("10.0.0.0/8 100\n", mtime=1000000002)
+    assert bmc_map.map.lookup("10.0.0.1") == "100"
+    assert bmc_map.map.mtime == 1000000002
@@ -0,0 +1,182 @@
+"""
+    Upstream call budgets of the Redfish routes
+
+    Each route is requested on a fresh app right after the login (cold) and
+    once more right away (warm); the Proxmox calls of both requests must match
+    the budget exactly. A change that adds a round trip to a route fails here:
+    update the budget only when the extra call is intended.
+"""
+import json
+import time
+import pytest
+
+# The fake Proxmox API has a self-signed certificate, like most clusters Redmox talks to
+pytestmark = pytest.mark.filterwarnings("ignore::urllib3.exceptions.InsecureRequestWarning")
+
+RESOURCES = "GET /cluster/resources"
+CONFIG = "GET /nodes/{node}/qemu/{vmid}/config"
+SET_CONFIG = "PUT /nodes/{node}/qemu/{vmid}/config"
+NODES = "GET /nodes"
+STORAGES = "GET /nodes/{node}/storage"
+CONTENT = "GET /nodes/{node}/storage/{storage}/content"
+START = "POST /nodes/{node}/qemu/{vmid}/status/start"
+STOP = "POST /nodes/{node}/qemu/{vmid}/status/stop"
+SHUTDOWN = "POST /nodes/{node}/qemu/{vmid}/status/shutdown"
+TASK_STATUS = "GET /nodes/{node}/tasks/{upid}/status"
+TICKET = "POST /access/ticket"
+VERSION = "GET /version"
+
+# The fake cluster: 2 nodes, 4 VMs from 100, 2 storages of 2 ISOs per node
+ISO = "pve1-local-0.iso"
+
+BUDGETS = [
+    # method, path, cold calls, warm calls
+    ("GET", "/redfish/v1", {}, {}),
+    ("GET", "/redfish/v1/Managers", {}, {}),
+    ("GET", "/redfish/v1/Managers/1", {}, {}),
+    ("GET", "/redfish/v1/Managers/1/VirtualMedia", { NODES: 1, STORAGES: 2, CONTENT: 4 }, {}),
+    ("GET", f"/redfish/v1/Managers/1/VirtualMedia/{ISO}", { NODES: 1, STORAGES: 2, CONTENT: 4 }, {}),
+    ("GET", "/redfish/v1/SessionService", {}, {}),
+    ("GET", "/redfish/v1/SessionService/Sessions", {}, {}),
+    ("GET", "/redfish/v1/SessionService/Sessions/1", {}, {}),
+    ("GET", "/redfish/v1/Chassis", {}, {}),
+    ("GET", "/redfish/v1/Chassis/1U", { RESOURCES: 1 }, {}),
+    ("GET", "/redfish/v1/Chassis/1U/Power", {}, {}),
+    ("GET", "/redfish/v1/Chassis/1U/Thermal", {}, {}),
+    ("GET", "/redfish/v1/Systems", { RESOURCES: 1 }, {}),
+    ("GET", "/redfish/v1/Systems?$expand=*", { RESOURCES: 1, CONFIG: 4 }, { CONFIG: 4 }),
+    ("GET", "/redfish/v1/Systems?$expand=*&$select=PowerState", { RESOURCES: 1 }, {}),
+    ("GET", "/redfish/v1/Systems?$expand=*&$top=2", { RESOURCES: 1, CONFIG: 2 }, { CONFIG: 2 }),
+    ("GET", "/redfish/v1/Systems?$expand=.($levels=1)", { RESOURCES: 1, CONFIG: 4 }, { CONFIG: 4 }),
+    ("GET", "/redfish/v1/Systems?$expand=~", { RESOURCES: 1 }, {}),
+    ("GET", "/redfish/v1/Systems/100", { RESOURCES: 1, CONFIG: 1 }, { CONFIG: 1 }),
+    ("GET", "/redfish/v1/Systems/100?$select=PowerState", { RESOURCES: 1 }, {}),
+    ("GET", "/redfish/v1/Systems/100/VirtualMedia", { RESOURCES: 1, STORAGES: 1, CONTENT: 2 }, {}),
+    ("GET", f"/redfish/v1/Systems/100/VirtualMedia/{ISO}", { RESOURCES: 1, STORAGES: 1, CONTENT: 2 }, {}),
+    ("GET", "/redfish/v1/TaskService", {}, {}),
+    ("GET", "/redfish/v1/TaskService/Tasks", {}, {}),
+    ("GET", "/redfish/v1/EventService", {}, {}),
+    ("GET", "/redfish/v1/EventService/Subscriptions", {}, {}),
+    ("GET", "/redmox/inventory", {}, {}),
+]
+
+@pytest.mark.parametrize("method, path, cold, warm", BUDGETS, ids=[ f"{method} {path}" for method, path, cold, warm in BUDGETS ])
+def test_route_budget(redmox, method, path, cold, warm):
+    assert redmox.request(method, path) == cold
+    assert redmox.request(method, path) == warm
+
+@pytest.mark.parametrize("expand", [ "*($levels=2)", ".($levels=0)", "*($levels=x)", "Links" ])
+def test_unsupported_expand(redmox, expand):
+    response = redmox.client.get(f"/redfish/v1/Systems?$expand={expand}", headers=redmox.headers)
+    assert response.status_code == 400
+    assert redmox.calls() == {}
+
+def test_expand_links_only(redmox):
+    # The Members of a collection are not Links, ~ leaves them as references
+    response = redmox.client.get("/redfish/v1/Systems?$expand=~", headers=redmox.headers)
+    assert response.get_json()["Members"] == [ { "@odata.id": f"/redfish/v1/Systems/{vmid}" } for vmid in sorted(redmox.fake.vms) ]
+
+def test_login_budget(redmox):
+    # The cluster version is fetched by the first login of the app only
+    redmox.login()
+    assert redmox.calls() == { TICKET: 1 }
+
+def test_token_reuses_the_pooled_client(redmox):
+    for attempt in range(3):
+        redmox.request("GET", "/redfish/v1/Chassis/1U")
+    assert TICKET not in redmox.calls()
+
+def test_reset_budget(redmox):
+    # A power action invalidates the inventory, the next one fetches it again
+    body = { "ResetType": "On" }
+    assert redmox.request("POST", "/redfish/v1/Systems/100/Actions/ComputerSystem.Reset", body) == { RESOURCES: 1, START: 1 }
+    assert redmox.request("POST", "/redfish/v1/Systems/100/Actions/ComputerSystem.Reset", body) == { RESOURCES: 1, START: 1 }
+
+@pytest.mark.parametrize("reset_type", [ "On", "ForceOff", "GracefulShutdown", "ForceRestart", "GracefulRestart" ])
+def test_reset_missing_vm(redmox, reset_type):
+    response = redmox.client.post("/redfish/v1/Systems/999/Actions/ComputerSystem.Reset", headers=redmox.headers, json={ "ResetType": reset_type })
+    assert response.status_code == 404
+    assert redmox.calls() == { RESOURCES: 1 }
+    assert redmox.api.tasks.list() == []
+
+def test_reset_unsupported_type(redmox):
+    response = redmox.client.post("/redfish/v1/Systems/100/Actions/ComputerSystem.Reset", headers=redmox.headers, json={ "ResetType": "Bogus" })
+    assert response.status_code == 400
+    assert json.loads(response.get_data())["error"]["code"] == "Base.1.8.ActionParameterNotSupported"
+    assert redmox.calls() == {}
+
+def test_reset_error(redmox, monkeypatch):
+    monkeypatch.setattr("libs.pmoxlib.Proxmox.run_poweroff", lambda self, vmid: { "error": True, "message": "VM is locked (backup)" })
+    response = redmox.client.post("/redfish/v1/Systems/100/Actions/ComputerSystem.Reset", headers=redmox.headers, json={ "ResetType": "ForceOff" })
+    assert response.status_code == 500
+    assert json.loads(response.get_data())["message"] == "VM is locked (backup)"
+
+@pytest.mark.parametrize("reset_type, stop", [ ("ForceRestart", STOP), ("GracefulRestart", SHUTDOWN) ])
+def test_restart_budget(redmox, reset_type, stop):
+    # The restart task stops the VM, polls its Proxmox task, then does the same to start it
+    response = redmox.client.post("/redfish/v1/Systems/100/Actions/ComputerSystem.Reset", headers=redmox.headers, json={ "ResetType": reset_type })
+    assert response.status_code == 202
+    location = response.headers["Location"]
+    wait_task(redmox, location)
+    assert redmox.calls() == { RESOURCES: 2, stop: 1, TASK_STATUS: 2, START: 1 }
+    # The task is answered from the task service, not from Proxmox
+    assert redmox.request("GET", location) == {}
+    assert redmox.request("GET", location) == {}
+
+def wait_task(redmox, location, timeout=10):
+    """
+        Function to wait for the task behind location to end, it must complete
+    """
+    task = location.rsplit("/", 1)[1]
+    deadline = time.monotonic() + timeout
+    while not redmox.api.tasks.get(task).done():
+        assert time.monotonic() < deadline, f"{location} still running"
+        time.sleep(0.05)
+    assert redmox.api.tasks.get(task).state == "Completed"
+
+def test_subscription_budget(redmox):
+    response = redmox.client.post("/redfish/v1/EventService/Subscriptions", headers=redmox.headers, json={ "Destination": "http://127.0.0.1:9/events" })
+    assert response.status_code == 201
+    assert redmox.calls() == {}
+    location = response.headers["Location"]
+    assert redmox.request("GET", location) == {}
+    assert redmox.request("DELETE", location) == {}
+
+def test_delete_session_budget(redmox):
+    assert redmox.request("DELETE", "/redfish/v1/SessionService/Sessions/1") == {}
+
+def test_insert_media_budget(redmox):
+    path = f"/redfish/v1/Systems/100/VirtualMedia/{ISO}/Actions/VirtualMedia.InsertMedia"
+    body = { "Image": ISO }
+    assert redmox.request("POST", path, body) == { RESOURCES: 1, STORAGES: 1, CONTENT: 2, SET_CONFIG: 1 }
+    assert redmox.request("POST", path, body) == { RESOURCES: 1, SET_CONFIG: 1 }
+
+def test_insert_media_errors(redmox, monkeypatch):
+    # A missing VM or ISO is answered from the inventory and the ISO catalog, nothing is set
+    response = redmox.client.post(f"/redfish/v1/Systems/999/VirtualMedia/{ISO}/Actions/VirtualMedia.InsertMedia", headers=redmox.headers, json={ "Image": ISO })
+    assert response.status_code == 404
+    assert json.loads(response.get_data())["message"] == "No VM found"
+    response = redmox.client.post("/redfish/v1/Systems/100/VirtualMedia/missing.iso/Actions/VirtualMedia.InsertMedia", headers=redmox.headers, json={ "Image": "missing.iso" })
+    assert response.status_code == 404
+    assert SET_CONFIG not in redmox.calls()
+    monkeypatch.setattr("libs.pmoxlib.Proxmox.mount_iso", lambda self, vmid, iso: { "error": True, "message": "VM is locked (backup)" })
+    response = redmox.client.post(f"/redfish/v1/Systems/100/VirtualMedia/{ISO}/Actions/VirtualMedia.InsertMedia", headers=redmox.headers, json={ "Image": ISO })
+    assert response.status_code == 500
+    assert json.loads(response.get_data())["message"] == "VM is locked (backup)"
+
+def test_virtual_media_missing_vm(redmox):
+    response = redmox.client.get("/redfish/v1/Systems/999/VirtualMedia", headers=redmox.headers)
+    assert response.status_code == 404
+    assert "ETag" not in response.headers
+    assert json.loads(response.get_data())["message"] == "No VM found"
+
+def test_eject_media_budget(redmox):
+    redmox.request("POST", f"/redfish/v1/Systems/100/VirtualMedia/{ISO}/Actions/VirtualMedia.InsertMedia", { "Image": ISO })
+    path = f"/redfish/v1/Systems/100/VirtualMedia/{ISO}/Actions/VirtualMedia.EjectMedia"
+    assert redmox.request("POST", path, {}) == { RESOURCES: 1, CONFIG: 1, SET_CONFIG: 1 }
+
+def test_system_after_power_action(redmox):
+    # The power action drops the inventory, the next System fetches it again
+    redmox.request("GET", "/redfish/v1/Systems/100")
+    redmox.request("POST", "/redfish/v1/Systems/100/Actions/ComputerSystem.Reset", { "ResetType": "On" })
+    assert redmox.request("GET", "/redfish/v1/Systems/100") == { RESOURCES: 1, CONFIG: 1 }
@@ -0,0 +1,42 @@
+"""
+    Notification of the inventory refreshes
+
+    The listeners publish the power state events, they are called once the
+    inventory lock is released so they can read the inventory and never
+    hold up the requests waiting for it.
+"""
+import threading
+
+from libs.cache import Inventory
+
+VMS = [ { "vmid": 100, "status": "running" }, { "vmid": 101, "status": "stopped" } ]
+
+def test_listeners_called_without_lock():
+    inventory = Inventory()
+    inventory.replace(VMS, inventory.generation)
+    calls = []
+    def listener(previous, states):
+        acquired = inventory.lock.acquire(blocking=False)
+        if acquired:
+            inventory.lock.release()
+        calls.append((acquired, previous["100"]["status"], states["100"]["status"]))
+    inventory.listen(listener)
+    inventory.replace([ dict(VMS[0], status="stopped"), VMS[1] ], inventory.generation)
+    assert calls == [ (True, "running", "stopped") ]
+
+def test_listener_added_during_refresh_waits_for_next():
+    inventory = Inventory()
+    inventory.replace(VMS, inventory.generation)
+    calls = []
+    def late(previous, states):
+        calls.append("late")
+    def listener(previous, states):
+        calls.append("first")
+        thread = threading.Thread(target=inventory.listen, args=(late,))
+        thread.start()
+        thread.join()
+    inventory.listen(listener)
+    inventory.replace(VMS, inventory.generation)
+    assert calls == [ "first" ]
+    inventory.replace(VMS, inventory.generation)
+    assert calls == [ "first", "first", "late" ]
@@ -0,0 +1,97 @@
+"""
+    Isolation of the Proxmox users of the sessions
+
+    Proxmox answers every user with what its permissions let it see, so the
+    inventory, the VM configs, the ISO catalog and the events are kept per
+    user. The fake Proxmox API shows ops@pve two of its four VMs only, the
+    other sessions log in as root@pam and see all of them.
+"""
+import pytest
+
+pytestmark = pytest.mark.filterwarnings("ignore::urllib3.exceptions.InsecureRequestWarning")
+
+RESOURCES = "GET /cluster/resources"
+CONTENT = "GET /nodes/{node}/storage/{storage}/content"
+
+@pytest.fixture
+def restricted(fake):
+    """
+        Function to give the test the fake Proxmox API showing ops@pve the VMs 100 and 101 only
+    """
+    fake.permissions["ops@pve"] = { 100, 101 }
+    yield fake
+    fake.permissions.clear()
+
+def login(redmox, user):
+    response = redmox.client.post("/redfish/v1/SessionService/Sessions", json={ "UserName": user, "Password": "test" })
+    assert response.status_code == 200, response.get_data(as_text=True)
+    token = response.get_data(as_text=True).split("X-Auth-Token: ")[1].split()[0]
+    return dict(redmox.headers, **{ "X-Auth-Token": token })
+
+def members(response):
+    assert response.status_code == 200, response.get_data(as_text=True)
+    return sorted([ member["@odata.id"] for member in response.get_json()["Members"] ])
+
+def test_inventory_per_user(redmox, restricted):
+    ops = login(redmox, "ops@pve")
+    assert len(members(redmox.client.get("/redfish/v1/Systems", headers=redmox.headers))) == 4
+    assert members(redmox.client.get("/redfish/v1/Systems", headers=ops)) == [ "/redfish/v1/Systems/100", "/redfish/v1/Systems/101" ]
+    assert len(members(redmox.client.get("/redfish/v1/Systems", headers=redmox.headers))) == 4
+    assert redmox.client.get("/redfish/v1/Systems/102", headers=ops).status_code == 404
+
+def test_etag_per_user(redmox, restricted):
+    ops = login(redmox, "ops@pve")
+    response = redmox.client.get("/redfish/v1/Systems/102", headers=redmox.headers)
+    assert response.status_code == 200
+    response = redmox.client.get("/redfish/v1/Systems/102", headers=dict(ops, **{ "If-None-Match": response.headers["ETag"] }))
+    assert response.status_code == 404
+
+def test_isos_per_user(redmox, restricted):
+    ops = login(redmox, "ops@pve")
+    redmox.request("GET", "/redfish/v1/Managers/1/VirtualMedia")
+    assert redmox.client.get("/redfish/v1/Managers/1/VirtualMedia", headers=ops).status_code == 200
+    assert redmox.calls()[CONTENT] == 4
+
+def test_power_action_expires_every_user(redmox, restricted):
+    ops = login(redmox, "ops@pve")
+    redmox.client.get("/redfish/v1/Systems", headers=ops)
+    redmox.request("GET", "/redfish/v1/Systems")
+    redmox.request("POST", "/redfish/v1/Systems/100/Actions/ComputerSystem.Reset", { "ResetType": "On" })
+    redmox.calls()
+    redmox.client.get("/redfish/v1/Systems", headers=ops)
+    assert redmox.calls() == { RESOURCES: 1 }
+
+def test_subscriptions_per_user(redmox, restricted):
+    ops = login(redmox, "ops@pve")
+    response = redmox.client.post("/redfish/v1/EventService/Subscriptions", headers=ops, json={ "Destination": "http://127.0.0.1:9/events" })
+    assert response.status_code == 201
+    location = response.headers["Location"]
+    assert redmox.client.get(location, headers=redmox.headers).status_code == 404
+    assert members(redmox.client.get("/redfish/v1/EventService/Subscriptions", headers=redmox.headers)) == []
+    assert members(redmox.client.get("/redfish/v1/EventService/Subscriptions", headers=ops)) == [ location ]
+
+def test_events_per_user(redmox, restricted):
+    root_client = redmox.api.clients.recent()
+    ops = login(redmox, "ops@pve")
+    redmox.client.get("/redfish/v1/Systems", headers=ops)
+    ops_client = redmox.api.clients.recent()
+    root, mine = redmox.api.events.subscribe(root_client.scope), redmox.api.events.subscribe(ops_client.scope)
+    try:
+        ops_client.inventory.replace([ dict(vm, status="stopped") for vm in ops_client.inventory.vms ], ops_client.inventory.generation)
+        event = mine.next(1)
+        assert [ record["OriginOfCondition"]["@odata.id"] for record in event["records"] ] == [ "/redfish/v1/Systems/100", "/redfish/v1/Systems/101" ]
+        assert root.next(0.1) is None
+    finally:
+        redmox.api.events.unsubscribe(root)
+        redmox.api.events.unsubscribe(mine)
+
+def test_poller_refreshes_every_user(redmox, restricted):
+    ops = login(redmox, "ops@pve")
+    redmox.client.get("/redfish/v1/Systems", headers=ops)
+    redmox.request("GET", "/redfish/v1/Systems")
+    redmox.calls()
+    assert redmox.api.poller.poll() == 2
+    assert redmox.calls() == { RESOURCES: 2 }
+    assert redmox.client.get("/redfish/v1/Systems", headers=ops).status_code == 200
+    redmox.request("GET", "/redfish/v1/Systems")
+    assert redmox.calls() == {}
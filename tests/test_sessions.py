@@ -0,0 +1,42 @@
+"""
+    Credentials kept by the Redfish sessions
+
+    The SQLite backend shares the sessions between the workers, so it must
+    never hold the Proxmox password: the sessions keep the Proxmox ticket,
+    which Proxmox renews when it is given as the password of a new login.
+"""
+import sqlite3
+import pytest
+
+pytestmark = pytest.mark.filterwarnings("ignore::urllib3.exceptions.InsecureRequestWarning")
+
+TICKET = "POST /access/ticket"
+PASSWORD = "s3cret-password"
+
+@pytest.fixture
+def configs(configs, tmp_path):
+    configs["sessions"].update(backend="sqlite", path=str(tmp_path / "sessions.db"))
+    return configs
+
+def stored(redmox):
+    with sqlite3.connect(redmox.api.sessions.path) as db:
+        return [ row[0] for row in db.execute("SELECT data FROM sessions").fetchall() ]
+
+def test_password_not_stored(redmox):
+    response = redmox.client.post("/redfish/v1/SessionService/Sessions", json={ "UserName": "root@pam", "Password": PASSWORD })
+    assert response.status_code == 200
+    rows = stored(redmox)
+    assert len(rows) == 2
+    assert all([ PASSWORD not in row and '"Ticket": "PVE:root@pam:' in row for row in rows ])
+
+def test_other_worker_logs_in_with_ticket(redmox):
+    redmox.api.clients.discard(redmox.token)
+    assert redmox.request("GET", "/redfish/v1/Systems/100")[TICKET] == 1
+
+def test_renewed_ticket_stored(redmox):
+    session = redmox.api.sessions.get(redmox.token)
+    redmox.api.sessions.update(redmox.token, dict(session, Ticket="PVE:root@pam:65E00000::old"))
+    redmox.api.clients.discard(redmox.token)
+    redmox.request("GET", "/redfish/v1/Systems/100")
+    redmox.request("GET", "/redfish/v1/Systems/100")
+    assert redmox.api.sessions.get(redmox.token)["Ticket"] == session["Ticket"]
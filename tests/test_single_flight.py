@@ -0,0 +1,93 @@
+"""
+    Sharing of the identical Proxmox GETs running at the same time
+
+    The fake Proxmox API is given some latency so that the requests started
+    together are all in flight at once. Identical GETs of a user must then
+    reach it once, and everything else must reach it as many times as asked.
+"""
+import threading
+import pytest
+from proxmoxer import ResourceException
+
+from libs.pmoxlib import Proxmox, SingleFlight
+
+pytestmark = pytest.mark.filterwarnings("ignore::urllib3.exceptions.InsecureRequestWarning")
+
+RESOURCES = ("GET", "/api2/json/cluster/resources")
+STATUS = ("GET", "/api2/json/nodes/{node}/status")
+START = ("POST", "/api2/json/nodes/{node}/qemu/{vmid}/status/start")
+
+COUNT = 8
+
+@pytest.fixture
+def flights():
+    return SingleFlight()
+
+@pytest.fixture
+def slow(fake):
+    """
+        Function to give the test the fake Proxmox API answering after 0.3 seconds, it answers right away afterwards
+    """
+    fake.latency = 0.3
+    yield fake
+    fake.latency = 0
+
+def client(fake, flights, user="root@pam"):
+    return Proxmox("127.0.0.1", user, "test", port=fake.port, flights=flights, name="fake")
+
+def together(calls):
+    """
+        Function to start the calls at the same time, returns their results or the exceptions they raised
+    """
+    barrier = threading.Barrier(len(calls))
+    outcomes = [ None ] * len(calls)
+    def run(index, call):
+        barrier.wait()
+        try:
+            outcomes[index] = call()
+        except Exception as e:
+            outcomes[index] = e
+    threads = [ threading.Thread(target=run, args=(index, call)) for index, call in enumerate(calls) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+def test_identical_gets_shared(slow, flights):
+    pmox = client(slow, flights)
+    slow.reset_calls()
+    outcomes = together([ lambda: pmox.api.cluster.resources.get(type="vm") ] * COUNT)
+    assert all([ outcome == outcomes[0] for outcome in outcomes ])
+    assert len(outcomes[0]) == len(slow.vms)
+    assert slow.reset_calls() == { RESOURCES: 1 }
+    assert flights.status() == { "calls": 1, "coalesced": COUNT - 1, "in_flight": 0 }
+
+def test_leader_error_raised_to_waiters(slow, flights):
+    pmox = client(slow, flights)
+    slow.reset_calls()
+    outcomes = together([ lambda: pmox.api.nodes("pve9").status.get() ] * COUNT)
+    assert all([ isinstance(outcome, ResourceException) for outcome in outcomes ])
+    assert slow.reset_calls() == { STATUS: 1 }
+    assert flights.status() == { "calls": 1, "coalesced": COUNT - 1, "in_flight": 0 }
+
+def test_posts_not_shared(slow, flights):
+    pmox = client(slow, flights)
+    slow.reset_calls()
+    together([ lambda: pmox.api.nodes("pve1").qemu(100).status.start.post() ] * COUNT)
+    assert slow.reset_calls() == { START: COUNT }
+    assert flights.status()["coalesced"] == 0
+
+def test_different_params_not_shared(slow, flights):
+    pmox = client(slow, flights)
+    slow.reset_calls()
+    together([ lambda: pmox.api.cluster.resources.get(type="vm"), lambda: pmox.api.cluster.resources.get(type="node") ])
+    assert slow.reset_calls() == { RESOURCES: 2 }
+    assert flights.status()["coalesced"] == 0
+
+def test_different_users_not_shared(slow, flights):
+    root, ops = client(slow, flights), client(slow, flights, user="ops@pve")
+    slow.reset_calls()
+    together([ lambda: root.api.cluster.resources.get(type="vm"), lambda: ops.api.cluster.resources.get(type="vm") ])
+    assert slow.reset_calls() == { RESOURCES: 2 }
+    assert flights.status()["coalesced"] == 0
@@ -0,0 +1,106 @@
+"""
+    Behaviour of the Redfish routes while the Proxmox API stalls
+
+    The fake Proxmox API is stalled by giving it a latency over the upstream
+    timeout. Reads must then be answered from the last good data with a
+    Warning header, writes must fail fast with 503 and Retry-After, and the
+    circuit breaker must close again once the API answers.
+"""
+import time
+import pytest
+
+pytestmark = pytest.mark.filterwarnings("ignore::urllib3.exceptions.InsecureRequestWarning")
+
+READS = [
+    "/redfish/v1/Systems",
+    "/redfish/v1/Systems?$expand=*",
+    "/redfish/v1/Systems/100",
+    "/redfish/v1/Chassis/1U",
+    "/redfish/v1/Managers/1/VirtualMedia",
+    "/redfish/v1/Systems/100/VirtualMedia",
+]
+
+@pytest.fixture
+def configs(configs):
+    configs["cache"].update(inventory_ttl=0.2, iso_ttl=0.2, stale_wait=0.1)
+    configs["upstream"].update(timeout=0.3, breaker_threshold=1, breaker_reset=1)
+    return configs
+
+@pytest.fixture
+def outage(fake):
+    """
+        Function to give the test the fake Proxmox API to stall, it answers again afterwards
+    """
+    yield fake
+    fake.latency = 0
+
+def get(redmox, path):
+    return redmox.client.get(path, headers=redmox.headers)
+
+def warm(redmox):
+    for path in READS:
+        assert get(redmox, path).status_code == 200
+    time.sleep(0.3)
+
+def test_reads_served_stale(redmox, outage):
+    warm(redmox)
+    outage.latency = 2
+    for path in READS:
+        start = time.monotonic()
+        response = get(redmox, path)
+        assert response.status_code == 200, f"{path}: {response.get_data(as_text=True)}"
+        assert response.headers["Warning"].startswith('110 - "Response is Stale'), path
+        assert time.monotonic() - start < 1, path
+    assert redmox.api.breaker.state() == "open"
+
+def test_reads_served_stale_without_login(redmox, outage):
+    # A token whose client is not pooled, evicted or opened by another worker, logs in on its first Proxmox call only
+    warm(redmox)
+    outage.latency = 2
+    redmox.api.clients.discard(redmox.token)
+    for path in READS:
+        response = get(redmox, path)
+        assert response.status_code == 200, f"{path}: {response.get_data(as_text=True)}"
+        assert response.headers["Warning"].startswith('110 - "Response is Stale'), path
+    response = redmox.client.post("/redfish/v1/Systems/100/Actions/ComputerSystem.Reset", headers=redmox.headers, json={ "ResetType": "On" })
+    assert response.status_code == 503
+
+def test_stale_data_per_user(redmox, outage):
+    # The last configs and snapshot of root@pam are never served to another Proxmox user
+    warm(redmox)
+    response = redmox.client.post("/redfish/v1/SessionService/Sessions", json={ "UserName": "ops@pve", "Password": "test" })
+    ops = dict(redmox.headers, **{ "X-Auth-Token": response.get_data(as_text=True).split("X-Auth-Token: ")[1].split()[0] })
+    outage.latency = 2
+    assert get(redmox, "/redfish/v1/Systems/100").status_code == 200
+    response = redmox.client.get("/redfish/v1/Systems/100", headers=ops)
+    assert response.status_code == 503
+    assert "Warning" not in response.headers
+
+def test_writes_fail_fast(redmox, outage):
+    warm(redmox)
+    outage.latency = 2
+    get(redmox, "/redfish/v1/Systems")
+    redmox.calls()
+    for reset_type in [ "On", "ForceOff", "ForceRestart" ]:
+        response = redmox.client.post("/redfish/v1/Systems/100/Actions/ComputerSystem.Reset", headers=redmox.headers, json={ "ResetType": reset_type })
+        assert response.status_code == 503, reset_type
+        assert int(response.headers["Retry-After"]) >= 1
+        assert "Warning" not in response.headers
+    assert redmox.calls() == {}
+
+def test_no_stale_data(redmox, outage):
+    outage.latency = 2
+    response = get(redmox, "/redfish/v1/Systems")
+    assert response.status_code == 503
+    assert "Retry-After" in response.headers
+
+def test_breaker_closes(redmox, outage):
+    warm(redmox)
+    outage.latency = 2
+    assert "Warning" in get(redmox, "/redfish/v1/Systems").headers
+    outage.latency = 0
+    time.sleep(1.1)
+    response = get(redmox, "/redfish/v1/Systems")
+    assert response.status_code == 200
+    assert "Warning" not in response.headers
+    assert redmox.api.breaker.state() == "closed"
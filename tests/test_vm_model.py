@@ -0,0 +1,63 @@
+"""
+    Parity of the VM model with the former get_vm_info dict builder
+
+    VM.to_dict keeps the get_vm_info format, with two fixes over the former
+    builder: every network interface is listed, not only the last one, and
+    the tags are split on ';'.
+"""
+import copy
+import pytest
+
+from bench_vm_model import RECORD, CONFIG, legacy_vm_info
+from libs.vmmodel import VM
+
+MINIMAL_RECORD = { "vmid": 108, "status": "stopped" }
+MINIMAL_CONFIG = { "memory": "2048" }
+
+def fixed(legacy, record, config):
+    """
+        Function to apply the fixes of the model to the dict of the former builder
+    """
+    expected = copy.deepcopy(legacy)
+    if isinstance(record.get("tags"), str):
+        expected["tags"] = [ tag for tag in record["tags"].split(";") if tag ]
+    interfaces = [ key for key in config if key.startswith("net") ]
+    if interfaces:
+        # The former builder lists the interface of a config holding it alone
+        expected["network"]["interfaces"] = [ legacy_vm_info(record, { key: config[key] })["network"]["interfaces"][0] for key in interfaces ]
+    return expected
+
+@pytest.mark.parametrize("record, config", [
+    (RECORD, CONFIG),
+    (dict(RECORD, tags=""), { key: value for key, value in CONFIG.items() if key not in [ "net1", "digest" ] }),
+    (MINIMAL_RECORD, MINIMAL_CONFIG)
+], ids=[ "full", "single-interface", "minimal" ])
+def test_to_dict_matches_legacy(record, config):
+    assert VM(str(record["vmid"]), record, config).to_dict() == fixed(legacy_vm_info(record, config), record, config)
+
+def test_every_interface_listed():
+    interfaces = VM("107", RECORD, CONFIG).to_dict()["network"]["interfaces"]
+    assert interfaces == [
+        { "name": "net0", "virtio": "BC:24:11:00:00:01", "bridge": "vmbr0", "firewall": "1" },
+        { "name": "net1", "virtio": "BC:24:11:00:00:02", "bridge": "vmbr1", "tag": "20" }
+    ]
+    assert len(legacy_vm_info(RECORD, CONFIG)["network"]["interfaces"]) == 1
+
+def test_tags_split():
+    assert VM("107", RECORD, CONFIG).tags == [ "k8s", "worker" ]
+    assert VM("108", MINIMAL_RECORD, MINIMAL_CONFIG).tags == []
+
+def test_sections_shared_per_digest():
+    first = VM("107", RECORD, CONFIG)
+    second = VM("107", RECORD, dict(CONFIG))
+    assert first.sections() is second.sections()
+    # The dicts are copies, changing one leaves the shared sections as parsed
+    first.to_dict()["disk"]["list"][0]["status"] = "changed"
+    assert second.to_dict() == fixed(legacy_vm_info(RECORD, CONFIG), RECORD, CONFIG)
+
+def test_system_fields():
+    vm = VM("107", RECORD, CONFIG)
+    assert (vm.name, vm.status, vm.cores, vm.sockets, vm.memory_mb, vm.vmgenid) == (
+        "worker-107", "running", 4, 2, 16384, "c2f9a7a4-64a3-4b5e-9d1c-7e0c6b0b9a11"
+    )
+    assert vm.boot_order == [ "scsi0", "ide2", "net0" ]